@@ -166,9 +166,12 @@ def extractImage(files, ofile, oformat, height, width, zfact, latlon, verbose):
   createVRT( vfile, bands )
 
   # create the final vrt file with appropriate mask band defined
+  # the output is width x height pixels, with zfact > 1 gdal reads the
+  # overviews of the doqqs instead of every pixel
   cmd = ['gdal_translate', '-b', '1', '-b', '2', '-b', '3', '-b', '5',
          '-mask', '4', '-of', oformat, 
-         '-projwin',  str(ulx), str(uly), str(lrx), str(lry)] + \
+         '-projwin',  str(ulx), str(uly), str(lrx), str(lry),
+         '-outsize', str(width), str(height), '-r', 'average'] + \
          IMAGE_OPTS[oformat] + [vfile, ofile]
   if verbose: print ' '.join(cmd)
   subprocess.call(cmd, stdout=DEVNULL, stderr=subprocess.STDOUT)
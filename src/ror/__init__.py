@@ -22,5 +22,6 @@ from naipprocess import *
 from status import *
 from minboundingcircle import getCircle
 from segmentation import Segmentation, OptimalParams
+from segqueue import SegmentWorker
 from polygonstats import PolygonStats, addShapefileStats
 from optimalparameters import getOptimalParameters
@@ -48,6 +48,11 @@ CONFIG = {
     # 'projectHomeDir'/tmp/
     'tmpdirs':['/u/ror/buildings/tmp/'],
 
+    # jobs get the tmpdir on the disk with the fewest jobs that has room
+    # for them, see tmpalloc.py
+    'tmpalloc.minfree': 1024,   # MB to keep free on each tmp disk
+    'tmpalloc.wait': 3600,      # seconds a job waits for room before it is refused
+
     # Area Of Interest can be defined as:
     # bbox with [xmin, ymin, xmax, ymax]
     # or as US Census FIPS string like 'ss|ssccc|sscccnnnnn'
@@ -93,6 +98,8 @@ CONFIG = {
     'naip.doqq_dir': 'data/naip/doqqs',
     'naip.shapefile': 'data/naip/shapefile',
     'naip.shptable': 'naipbbox{0}',         # {0} - year
+    'naip.pipeline': 'subprocess',          # subprocess, inprocess or compare
+    'naip.cog': False,                      # write cloud optimized geotiffs
 
     # ----------------- OSM building data --------------------------
 
@@ -114,8 +121,36 @@ CONFIG = {
                         #       y = ramgeramp*x+ranger
     'seg.max-iter': 100,# (int) max number of iterations to convergence
     'seg.tilesize': 1024,    # size of tiles used in processing
+    'seg.tiled': None,  # None to segment the area as a single job, or
+                        # 'doqq' or int pixels to split the area into tiles
+                        # that are segmented in parallel with nproc processes
+    'seg.overlap': 128, # (int) pixels of overlap between tiles
+    'seg.inmemory': False, # connect the OTB applications in memory instead
+                        # of writing the intermediate rasters to tmpdir
+    'seg.cache': False, # keep smoothing and segmentation outputs in a cache
+                        # keyed on their input and parameters for reuse
+    'seg.cachedir': 'data/cache', # where the stage cache lives
+    'seg.cachesize': 102400, # (int) stage cache size budget in MB, least
+                        # recently used entries are evicted over this
+    'seg.autotune': False, # pick ram, tile sizes and ITK threads for each
+                        # stage from the free memory, cpus and image size
+    'seg.tuningdir': 'data/tuning', # where the per host calibration and
+                        # auto tuning choices are saved
     'seg.shapedir': 'data/segments',
+    'optimal.samples': 1, # (int) windows sampled across the area for the
+                        # optimal parameters, 1 is a window at the center
+    'optimal.cache': True, # keep the optimal parameters, semivariograms and
+                        # local variance summaries of each window in the
+                        # database and reuse them on later runs
+    'optimal.approx': False, # estimate the optimal parameters from random
+                        # pixel samples, fast but approximate
+    'optimal.chunkrows': 0, # (int) 0 computes the local variance for Hr on
+                        # the whole band at once, > 0 computes it in float32
+                        # chunks of this many rows to bound the memory, the
+                        # float chunks can give a slightly different Hr
     'seg.table': 'segments.y{0}_{1}', # {0}= year, {1}= jobname
+    'seg.loader': 'copy', # 'copy' to load segments with a binary COPY or
+                        # 'ogr2ogr' to load them with ogr2ogr
 
     # ---------------- end of config data ----------------------------
     'EOF': True
@@ -12,6 +12,9 @@
 
 import psycopg2
 from config import *
+from segqueue import createQueueTable
+from segunits import createUnitStateTable
+from optimalcache import createOptimalCacheTable
 
 def InitDB():
     try:
@@ -32,6 +35,9 @@ def InitDB():
     cur.execute("create schema if not exists search")
     cur.execute("create schema if not exists naip")
     cur.execute('alter database "%s" set search_path to data, census, naip, segments, training, search, public' % (CONFIG['dbname']))
+    createQueueTable( cur )
+    createUnitStateTable( cur )
+    createOptimalCacheTable( cur )
 
     conn.commit()
     conn.close()
@@ -0,0 +1,317 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import glob
+import time
+
+import otbApplication
+from stagecache import getCacheDir, inputSignature, cacheKey, cacheGet, cachePut, \
+                       cacheUnpin
+from tuning import autoTune, applyTuning
+from config import *
+
+# this probably will not work on Windows, except in the docker env.
+otbpath = os.environ.get('OTB_APPLICATION_PATH', None)
+if otbpath is None:
+    os.environ['OTB_APPLICATION_PATH']='/usr/lib/otb/applications/'
+
+
+def _setInputImage(app, key, img):
+    # img is either a filename or an in-memory image from another app
+    if isinstance(img, basestring):
+        app.SetParameterString(key, img)
+    else:
+        app.SetParameterInputImage(key, img)
+
+
+def stageParam(params, stage, key):
+    # per stage settings from the auto tuning override the global ones
+    return params.get('stages', {}).get(stage, {}).get(key, params[key])
+
+
+def smoothing(fin, fout, foutpos, spatialr, ranger, rangeramp, thres, maxiter, ram, write=True):
+    app = otbApplication.Registry.CreateApplication('MeanShiftSmoothing')
+    _setInputImage(app, 'in', fin)
+    if write:
+        app.SetParameterString('fout', fout)
+        app.SetParameterString('foutpos', foutpos)
+    app.SetParameterInt('spatialr', spatialr)
+    app.SetParameterFloat('ranger', ranger)
+    app.SetParameterFloat('rangeramp', rangeramp)
+    app.SetParameterFloat('thres', thres)
+    app.SetParameterInt('maxiter', maxiter)
+    app.SetParameterInt('ram', ram)
+    app.SetParameterInt('modesearch', 0)
+    if write:
+        app.ExecuteAndWriteOutput()
+    else:
+        app.Execute()
+    return app
+
+
+def segmentit(fin, finpos, fout, spatialr, ranger, minsize, tilesize, tmpdir, write=True):
+    debug = CONFIG.get('debug', False)
+
+    app = otbApplication.Registry.CreateApplication('LSMSSegmentation')
+    _setInputImage(app, 'in', fin)
+    _setInputImage(app, 'inpos', finpos)
+    # out is always set because it is used to name the tiles in tmpdir
+    app.SetParameterString('out', fout)
+    app.SetParameterString('tmpdir', tmpdir)
+    app.SetParameterInt('spatialr', spatialr)
+    app.SetParameterFloat('ranger', ranger)
+    app.SetParameterInt('minsize', minsize)
+    app.SetParameterInt('tilesizex', tilesize)
+    app.SetParameterInt('tilesizey', tilesize)
+    app.SetParameterInt('cleanup', 1 if debug else 0)
+    if write:
+        app.ExecuteAndWriteOutput()
+    else:
+        app.Execute()
+    return app
+
+
+def mergesmall(fin, finseg, fout, minsize, tilesize, write=True):
+    app = otbApplication.Registry.CreateApplication('LSMSSmallRegionsMerging')
+    _setInputImage(app, 'in', fin)
+    _setInputImage(app, 'inseg', finseg)
+    if write:
+        app.SetParameterString('out', fout)
+    app.SetParameterInt('minsize', minsize)
+    app.SetParameterInt('tilesizex', tilesize)
+    app.SetParameterInt('tilesizey', tilesize)
+    if write:
+        app.ExecuteAndWriteOutput()
+    else:
+        app.Execute()
+    return app
+
+
+def vectorize(fin, finseg, fout, tilesize):
+    app = otbApplication.Registry.CreateApplication('LSMSVectorization')
+    _setInputImage(app, 'in', fin)
+    _setInputImage(app, 'inseg', finseg)
+    app.SetParameterString('out', fout)
+    app.SetParameterInt('tilesizex', tilesize)
+    app.SetParameterInt('tilesizey', tilesize)
+    app.ExecuteAndWriteOutput()
+    return app
+
+
+def runLSMSInMemory( fin, fsegshp, tmpdir, prefix, params ):
+    '''
+    runLSMSInMemory( fin, fsegshp, tmpdir, prefix, params )
+
+    Same as runLSMS() but the OTB applications are connected in memory
+    so the smoothed, segmented and merged rasters are never written to
+    disk. LSMSSegmentation still writes its tiles to tmpdir, these are
+    removed when vectorization is done unless params['debug'] is set.
+
+    OTB only runs the smoothing when a later stage pulls on it, and it
+    recomputes the smoothing for each stage that reads it, so there is
+    no smoothing time, it is included in the segmentation and
+    vectorization times. This trades cpu for the disk I/O.
+    '''
+    spatialr  = params['spatialr']
+    ranger    = params['ranger']
+    minsize   = params['minsize']
+    delete    = params.get('delete', False)
+    debug     = params.get('debug', False)
+
+    fsegs = os.path.join(tmpdir, '{}-segs.tif'.format(prefix))
+
+    times = {}
+    t0 = time.time()
+
+    # keep a reference to every app so they are not deleted
+    # while the next app in the chain is still using their output
+    print 'Connecting LSMS applications in memory ...'
+    smooth = smoothing(fin, None, None, spatialr, ranger, params['rangeramp'],
+                       params['thresh'], params['maxiter'],
+                       stageParam(params, 'smoothing', 'ram'), write=False)
+    fsmooth = smooth.GetParameterOutputImage('fout')
+    fsmoothpos = smooth.GetParameterOutputImage('foutpos')
+
+    minsize1 = minsize if delete else 0
+    seg = segmentit(fsmooth, fsmoothpos, fsegs, spatialr, ranger, minsize1,
+                    stageParam(params, 'segmentation', 'tilesize'), tmpdir,
+                    write=False)
+    segout = seg.GetParameterOutputImage('out')
+
+    if not delete:
+        merge = mergesmall(fsmooth, segout, None, minsize,
+                           stageParam(params, 'merging', 'tilesize'), write=False)
+        segout = merge.GetParameterOutputImage('out')
+
+    t1 = time.time()
+    times['segmentation'] = t1 - t0
+    print "Segmentation time:", t1 - t0
+    t0 = t1
+
+    print 'Starting vectorization of segments ...'
+    vectorize(fsmooth, segout, fsegshp, stageParam(params, 'vectorization', 'tilesize'))
+
+    t1 = time.time()
+    times['vectorization'] = t1 - t0
+    print "Vectoriztion time:", t1 - t0
+
+    if not debug:
+        tiles = os.path.join(tmpdir, os.path.splitext(os.path.basename(fsegs))[0] + '_*')
+        for f in glob.glob( tiles ):
+            os.remove( f )
+
+    return times
+
+
+def runLSMS( fin, fsegshp, tmpdir, prefix, params ):
+    '''
+    runLSMS( fin, fsegshp, tmpdir, prefix, params )
+        fin     - input image or vrt to segment
+        fsegshp - output shapefile for the segment polygons
+        tmpdir  - directory to write the intermediate rasters in
+        prefix  - prefix for the intermediate file names, eg: tmp-1234
+        params  - dictionary of segmentation parameters with keys:
+                  spatialr, ranger, minsize, delete, thresh, rangeramp,
+                  maxiter, tilesize, ram, debug, inmemory, cache,
+                  autotune and optionally threads and stages
+
+    Run the LSMS chain of smoothing, segmentit, mergesmall and vectorize
+    on fin and write the segment polygons to fsegshp. The intermediate
+    rasters are removed unless params['debug'] is set. If
+    params['inmemory'] is set the chain is run by runLSMSInMemory().
+
+    If params['cache'] is set the outputs of smoothing and segmentit are
+    kept in the stage cache and reused by later runs with the same input
+    and parameters. The cache needs files so it disables inmemory.
+
+    If params['autotune'] is set and params has no 'stages' from an
+    earlier tuning, the ram, tile sizes and threads are picked by
+    autoTune(). params['threads'] sets the ITK thread count, ITK reads it
+    once so it only works before the first OTB application is run in
+    this process.
+
+    Returns a dictionary of the time in seconds spent in each stage.
+    '''
+    cache = params.get('cache', False)
+
+    if params.get('autotune', False) and not 'stages' in params:
+        params = applyTuning( params, autoTune( fin, params, 1 ) )
+
+    if params.get('threads', 0) > 0:
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(params['threads'])
+
+    if params.get('inmemory', False) and not cache:
+        return runLSMSInMemory( fin, fsegshp, tmpdir, prefix, params )
+
+    spatialr  = params['spatialr']
+    ranger    = params['ranger']
+    minsize   = params['minsize']
+    tilesize  = stageParam(params, 'segmentation', 'tilesize')
+    delete    = params.get('delete', False)
+    debug     = params.get('debug', False)
+
+    fsmooth    = os.path.join(tmpdir, '{}-smooth.tif'.format(prefix))
+    fsmoothpos = os.path.join(tmpdir, '{}-smoothpos.tif'.format(prefix))
+    fsegs      = os.path.join(tmpdir, '{}-segs.tif'.format(prefix))
+    fmerged    = os.path.join(tmpdir, '{}-merged.tif'.format(prefix))
+
+    times = {}
+    pinned = []
+    try:
+        t0 = time.time()
+
+        cached = None
+        if cache:
+            smoothKey = cacheKey( 'smoothing', inputSignature( fin ), spatialr,
+                                  ranger, params['rangeramp'], params['thresh'],
+                                  params['maxiter'] )
+            cached = cacheGet( smoothKey, ['smooth.tif', 'smoothpos.tif'] )
+
+        if cached is None:
+            print 'Starting smoothing ...'
+            smoothing(fin, fsmooth, fsmoothpos, spatialr, ranger, params['rangeramp'],
+                      params['thresh'], params['maxiter'],
+                      stageParam(params, 'smoothing', 'ram'))
+            if cache:
+                fsmooth, fsmoothpos = cachePut( smoothKey, [fsmooth, fsmoothpos],
+                                                ['smooth.tif', 'smoothpos.tif'] )
+                pinned.append( smoothKey )
+        else:
+            print 'Using cached smoothing {} ...'.format(smoothKey)
+            fsmooth, fsmoothpos = cached
+            pinned.append( smoothKey )
+
+        t1 = time.time()
+        times['smoothing'] = t1 - t0
+        print "Smoothing time:", t1 - t0
+        t0 = t1
+
+        if delete:
+            minsize1 = minsize
+            fsegs = fmerged
+        else:
+            minsize1 = 0
+
+        cached = None
+        if cache:
+            segKey = cacheKey( 'segmentation', smoothKey, spatialr, ranger,
+                               minsize1, tilesize )
+            cached = cacheGet( segKey, ['segs.tif'] )
+
+        if cached is None:
+            print 'Starting Segmentation ...'
+            segmentit(fsmooth, fsmoothpos, fsegs, spatialr, ranger, minsize1, tilesize, tmpdir)
+            if cache:
+                fsegs = cachePut( segKey, [fsegs], ['segs.tif'] )[0]
+                pinned.append( segKey )
+        else:
+            print 'Using cached segmentation {} ...'.format(segKey)
+            fsegs = cached[0]
+            pinned.append( segKey )
+
+        if delete:
+            fmerged = fsegs
+
+        t1 = time.time()
+        times['segmentation'] = t1 - t0
+        print "Segmentation time:", t1 - t0
+        t0 = t1
+
+        if not delete:
+            print 'Starting small area merging ...'
+            mergesmall(fsmooth, fsegs, fmerged, minsize,
+                       stageParam(params, 'merging', 'tilesize'))
+
+            t1 = time.time()
+            times['merging'] = t1 - t0
+            print "Merge small area time:", t1 - t0
+            t0 = t1
+
+        print 'Starting vectorization of segments ...'
+        vectorize(fsmooth, fmerged, fsegshp, stageParam(params, 'vectorization', 'tilesize'))
+
+        t1 = time.time()
+        times['vectorization'] = t1 - t0
+        print "Vectoriztion time:", t1 - t0
+
+        if not debug:
+            for f in (fsmooth, fsmoothpos, fsegs, fmerged):
+                # never remove the files that live in the cache
+                if not f.startswith( getCacheDir() ) and os.path.exists( f ):
+                    os.remove( f )
+    finally:
+        # let the cache evict the entries this run used
+        cacheUnpin( pinned )
+
+    return times
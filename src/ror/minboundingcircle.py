@@ -13,7 +13,9 @@
 
 import sys
 import math
+import time
 import random
+import numpy as np
 
 '''
 Welzl's Algorithm
@@ -29,137 +31,275 @@ Welzl's Algorithm
 * we compute it calling mc1(A, p), which calculates the
   smallest circle enclosing A = {p1, p2, ..., pi} with
   p = pi+1 on its boundary
+
+This is done with three nested loops instead of recursion, so there is
+no limit on the number of points, and a point that is outside of the
+circle is moved to the front of the list so it is tested first from
+then on. Duplicate points are simply inside the circle, three colinear
+points on the boundary use the circle of the two farthest apart.
+
+The points are moved so the first one is at the origin before the
+circle is computed, this keeps the precision when the coordinates are
+large, like meters in global mercator.
 '''
 
+# relative slack when testing if a point is inside a circle
+MEC_EPS = 1.0e-12
+
+# largest set getCircles() solves with numpy, the batch takes about k**3/6
+# numpy calls for sets of k points, so it only pays with more than about
+# 2*k**2 sets of that size and not at all for large sets
+MEC_VECTOR_MAX = 32
+
+
 def getCircle(points):
     '''
     [cx, cy, radius] = getCircle(points)
-    
+
     Returns list defining minimum bounding circle for a list of points
     or None on failure
     '''
-
-    # round the data to 6 significant decimal places
-    # and remove duplicate points
-    pnts = [list(y) for y in list(set((round(float(x[0]),6), round(float(x[1]),6)) for x in points))]
+    pnts = [(float(x[0]), float(x[1])) for x in points]
+    if len(pnts) == 0:
+        return None
 
     # algorithm calls for randomized insertion of pnts
     random.shuffle(pnts)
 
-    #return _mec(pnts, len(pnts), [])
-    bnd = [None, None, None]
-    try:
-        D = minidisk(pnts, len(pnts), bnd, 0)
-    except Exception, e:
-        print "EXCEPTION: " + str(e) + " (npts: " + str(len(points)) + ")"
-        D = None
-    return D
-
-
-def minidisk(pt, np, bnd, nb):
-    #print 'minidisk: np: {}, nb: {}'.format(np, nb)
-    if np == 1:
-        if nb == 0:
-            return _calcCircle1(pt[0])
-        elif nb == 1:
-            return _calcCircle2([pt[0], bnd[0]])
-    elif np == 0:
-        if nb == 1:
-            return _calcCircle1(bnd[0])
-        elif nb == 2:
-            return _calcCircle2([bnd[0], bnd[1]])
-    if nb == 3:
-        # if any of the points are coincident
-        # or the three points are colinear
-        # this causes _calcCircle3 to fail and return None
-        # Not sure how to recover from this! FIXME
-        # I think I'm dealing with this by converting the
-        # the polygon to a convex hull which should not have
-        # duplicate points (other than start and end points)
-        # and I'm filtering out duplicate points
-        # this is/should be getting done by the caller
-        return _calcCircle3([bnd[0], bnd[1], bnd[2]])
-
-    D = minidisk(pt, np-1, bnd, nb)
-    dx = pt[np-1][0]-D[0]
-    dy = pt[np-1][1]-D[1]
-    dist2 = dx*dx + dy*dy
-    if dist2 <= D[2]*D[2]:
-        return D
-    bnd[nb] = pt[np-1]
-    nb = nb + 1
-    return minidisk(pt, np-1, bnd, nb)
-
-
-def _calcCircle3(pnts):
-    p1x = pnts[0][0]
-    p1y = pnts[0][1]
-    p2x = pnts[1][0]
-    p2y = pnts[1][1]
-    p3x = pnts[2][0]
-    p3y = pnts[2][1]
-
-    dx = p1x-p2x
-    dy = p1y-p2y
-    a = math.sqrt(dx*dx + dy*dy)
-
-    dx = p2x-p3x
-    dy = p2y-p3y
-    b = math.sqrt(dx*dx + dy*dy)
-
-    dx = p3x-p1x
-    dy = p3y-p1y
-    c = math.sqrt(dx*dx + dy*dy)
-
-    s = (a + b + c)*0.5
-    denom = math.sqrt(s*(s-a)*(s-b)*(s-c))
-    #if denom == 0:
-    #    print 'denom==0'
-    #    print 'pnts:', pnts
-    #    print 'a: {}, b: {}, c: {}, s: {}'.format(a, b, c, s)
-    #    sys.exit(1)
-    r = a*b*c*0.25/denom
-
-    t1 = p1x*p1x + p1y*p1y
-    t2 = p2x*p2x + p2y*p2y
-    t3 = p3x*p3x + p3y*p3y
-    denom = 2.0*(p1x*(p2y-p3y) + p2x*(p3y-p1y) + p3x*(p1y-p2y))
-    #if denom == 0:
-    #    print 'denom==0'
-    #    print 'pnts:', pnts
-    #    print 't1: {}, t1: {}, t3: {}'.format(t1, t2, t3)
-    #    sys.exit(1)
-    
-    cx = (t1*(p2y-p3y) + t2*(p3y-p1y) + t3*(p1y-p2y))/denom
-    cy = (t1*(p3x-p2x) + t2*(p1x-p3x) + t3*(p2x-p1x))/denom
-
-    C = [cx, cy, r]
-    #print '_calcCircle3:', C
-    return [cx, cy, r]
-
-def _calcCircle2(pnts):
-    p1x = pnts[0][0]
-    p1y = pnts[0][1]
-    p2x = pnts[1][0]
-    p2y = pnts[1][1]
-
-    cx = (p1x+p2x)*0.5
-    cy = (p1y+p2y)*0.5
-
-    dx = p1x-p2x
-    dy = p1y-p2y
-
-    C = [cx, cy, math.sqrt( dx*dx + dy*dy )*0.5]
-    #print '_calcCircle2:', C
-    return C
-
-def _calcCircle1(pnts):
-    p1x = pnts[0]
-    p1y = pnts[1]
-
-    C = [p1x, p1y, 0.0]
-    #print '_calcCircle1:', C
-    return C
+    ox, oy = pnts[0]
+    D = _mec([(x - ox, y - oy) for x, y in pnts])
+    return [D[0] + ox, D[1] + oy, D[2]]
+
+
+def getCircles(offsets, coords):
+    '''
+    circles = getCircles(offsets, coords)
+        offsets - offsets into coords of each set of points, plus the end
+        coords  - (n, 2) array of the points of all the sets
+
+    Returns an (m, 3) array of [cx, cy, radius] of the minimum bounding
+    circle of each of the m sets of points, NaN for an empty set.
+
+    The sets of up to MEC_VECTOR_MAX points are solved together with
+    numpy, in buckets of about the same size, see _mecBatch(). Larger
+    sets and buckets of too few sets are solved one by one.
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    nsets = len(offsets) - 1
+    circles = np.empty((nsets, 3), dtype=np.float64)
+    circles.fill(np.nan)
+    if len(coords) == 0:
+        return circles
+
+    # move each set to its first point and shuffle the points of each set
+    counts = np.diff(offsets)
+    setid = np.repeat(np.arange(nsets), counts)
+    origin = coords[np.minimum(offsets[:-1], len(coords) - 1)]
+    order = np.argsort(setid + np.random.random_sample(len(coords)))
+    local = (coords - origin[setid])[order]
+
+    # buckets of sets with up to 1, 2, 4, 8, ... points
+    bucket = np.zeros(nsets, dtype=np.int64)
+    bucket[counts > 1] = np.ceil(np.log2(counts[counts > 1])).astype(np.int64)
+    batched = np.zeros(nsets, dtype=bool)
+    for bk in np.unique(bucket[(counts > 0) & (counts <= MEC_VECTOR_MAX)]):
+        sets = np.nonzero((bucket == bk) & (counts > 0) & (counts <= MEC_VECTOR_MAX))[0]
+        k = int(counts[sets].max())
+        if len(sets) < 2 * k * k:
+            continue
+        batched[sets] = True
+
+        # pad each set with its first point, which is always in the circle
+        idx = offsets[sets][:, None] + np.arange(k)
+        idx = np.where(np.arange(k) < counts[sets][:, None], idx, offsets[sets][:, None])
+        circles[sets] = _mecBatch(local[idx, 0], local[idx, 1])
+
+    # python floats are much faster than numpy scalars in the loops
+    single = np.nonzero((counts > 0) & ~batched)[0]
+    if len(single) > 0:
+        xs = local[:, 0].tolist()
+        ys = local[:, 1].tolist()
+        offs = offsets.tolist()
+        for i in single.tolist():
+            a = offs[i]
+            b = offs[i + 1]
+            circles[i] = _mec(zip(xs[a:b], ys[a:b]))
+    circles[:, :2] += origin
+
+    return circles
+
+
+def _mecBatch(xs, ys):
+    # minimum enclosing circles of the rows of the (m, k) arrays xs and
+    # ys as an (m, 3) array, incremental Welzl over the point index with
+    # every row that has a point outside of its circle at once
+    cx = xs[:, 0].copy()
+    cy = ys[:, 0].copy()
+    r2 = np.zeros(len(xs))
+    for i in range(1, xs.shape[1]):
+        dx = xs[:, i] - cx
+        dy = ys[:, i] - cy
+        rows = np.nonzero(dx*dx + dy*dy > r2 * (1.0 + MEC_EPS))[0]
+        if len(rows) == 0:
+            continue
+
+        # point i is on the boundary of the circle of points 0..i
+        ix = xs[rows, i]
+        iy = ys[rows, i]
+        bx = ix.copy()
+        by = iy.copy()
+        b2 = np.zeros(len(rows))
+        for j in range(i):
+            jx = xs[rows, j]
+            jy = ys[rows, j]
+            dx = jx - bx
+            dy = jy - by
+            out = np.nonzero(dx*dx + dy*dy > b2 * (1.0 + MEC_EPS))[0]
+            if len(out) == 0:
+                continue
+
+            # points i and j are on the boundary of the circle of points 0..j
+            ox, oy, o2 = _calcCircles2(ix[out], iy[out], jx[out], jy[out])
+            for k in range(j):
+                kx = xs[rows[out], k]
+                ky = ys[rows[out], k]
+                dx = kx - ox
+                dy = ky - oy
+                c = np.nonzero(dx*dx + dy*dy > o2 * (1.0 + MEC_EPS))[0]
+                if len(c) == 0:
+                    continue
+                ox[c], oy[c], o2[c] = _calcCircles3(ix[out][c], iy[out][c],
+                    jx[out][c], jy[out][c], kx[c], ky[c])
+            bx[out] = ox
+            by[out] = oy
+            b2[out] = o2
+        cx[rows] = bx
+        cy[rows] = by
+        r2[rows] = b2
+
+    return np.column_stack((cx, cy, np.sqrt(r2)))
+
+
+def _mec(pt):
+    # minimum enclosing circle of the list of points pt, iterative
+    # Welzl with move to front, pt is reordered in place
+    cx, cy = pt[0]
+    r2 = 0.0
+    for i in range(1, len(pt)):
+        px, py = pt[i]
+        dx = px - cx
+        dy = py - cy
+        if dx*dx + dy*dy <= r2 * (1.0 + MEC_EPS):
+            continue
+
+        # pt[i] is on the boundary of the circle of pt[0..i]
+        cx, cy, r2 = px, py, 0.0
+        for j in range(i):
+            qx, qy = pt[j]
+            dx = qx - cx
+            dy = qy - cy
+            if dx*dx + dy*dy <= r2 * (1.0 + MEC_EPS):
+                continue
+
+            # pt[i] and pt[j] are on the boundary of the circle of pt[0..j]
+            cx, cy, r2 = _calcCircle2(pt[i], pt[j])
+            for k in range(j):
+                sx, sy = pt[k]
+                dx = sx - cx
+                dy = sy - cy
+                if dx*dx + dy*dy <= r2 * (1.0 + MEC_EPS):
+                    continue
+                C = _calcCircle3(pt[i], pt[j], pt[k])
+                if C is None:
+                    C = max(_calcCircle2(pt[i], pt[j]), _calcCircle2(pt[j], pt[k]),
+                            _calcCircle2(pt[i], pt[k]), key=lambda c: c[2])
+                cx, cy, r2 = C
+
+        # move to front
+        pt.insert(0, pt.pop(i))
+
+    return [cx, cy, math.sqrt(r2)]
+
+
+def _calcCircle3(p1, p2, p3):
+    # circle through three points as [cx, cy, radius**2]
+    # or None if they are colinear
+    bx = p2[0] - p1[0]
+    by = p2[1] - p1[1]
+    cx = p3[0] - p1[0]
+    cy = p3[1] - p1[1]
+
+    denom = 2.0 * (bx*cy - by*cx)
+    scale = (bx*bx + by*by + cx*cx + cy*cy)
+    if abs(denom) <= MEC_EPS * scale:
+        return None
+
+    b2 = bx*bx + by*by
+    c2 = cx*cx + cy*cy
+    ux = (cy*b2 - by*c2) / denom
+    uy = (bx*c2 - cx*b2) / denom
+
+    x = p1[0] + ux
+    y = p1[1] + uy
+    dx = p1[0] - x
+    dy = p1[1] - y
+    return [x, y, dx*dx + dy*dy]
+
+
+def _calcCircle2(p1, p2):
+    # circle with p1 and p2 on its diameter as [cx, cy, radius**2]
+    x = (p1[0] + p2[0]) * 0.5
+    y = (p1[1] + p2[1]) * 0.5
+    dx = p1[0] - x
+    dy = p1[1] - y
+    return [x, y, dx*dx + dy*dy]
+
+
+def _calcCircles3(x1, y1, x2, y2, x3, y3):
+    # _calcCircle3() of arrays of points as arrays cx, cy, radius**2,
+    # colinear points use the largest circle of two of them
+    bx = x2 - x1
+    by = y2 - y1
+    cx = x3 - x1
+    cy = y3 - y1
+
+    denom = 2.0 * (bx*cy - by*cx)
+    b2 = bx*bx + by*by
+    c2 = cx*cx + cy*cy
+    ok = np.abs(denom) > MEC_EPS * (b2 + c2)
+    d = np.where(ok, denom, 1.0)
+    ux = (cy*b2 - by*c2) / d
+    uy = (bx*c2 - cx*b2) / d
+    x = x1 + ux
+    y = y1 + uy
+    dx = x1 - x
+    dy = y1 - y
+    r2 = dx*dx + dy*dy
+    if ok.all():
+        return x, y, r2
+
+    bad = np.nonzero(~ok)[0]
+    cands = [_calcCircles2(x1[bad], y1[bad], x2[bad], y2[bad]),
+             _calcCircles2(x2[bad], y2[bad], x3[bad], y3[bad]),
+             _calcCircles2(x1[bad], y1[bad], x3[bad], y3[bad])]
+    best = np.argmax(np.array([c[2] for c in cands]), axis=0)
+    for n in range(3):
+        sel = best == n
+        x[bad[sel]] = cands[n][0][sel]
+        y[bad[sel]] = cands[n][1][sel]
+        r2[bad[sel]] = cands[n][2][sel]
+    return x, y, r2
+
+
+def _calcCircles2(x1, y1, x2, y2):
+    # _calcCircle2() of arrays of points as arrays cx, cy, radius**2
+    x = (x1 + x2) * 0.5
+    y = (y1 + y2) * 0.5
+    dx = x1 - x
+    dy = y1 - y
+    return x, y, dx*dx + dy*dy
+
 
 def _test():
     p1 = [[1,0],[2,1],[1,2],[0,1],[.5,1.5],[1.5,1.5],[.5,.5],[1.5,.5]]
@@ -175,7 +315,29 @@ def _test():
     c = getCircle(pnts)
     print c
 
+    # colinear and duplicate points
+    print getCircle([[0,0],[1,1],[2,2],[2,2],[3,3]]), 'expected: [1.5, 1.5, 2.1213...]'
+
+    # the batch has to agree with getCircle
+    sets = [p1, pnts, [[5,5]], [[0,0],[4,0],[2,0]]]
+    offsets = np.cumsum([0] + [len(p) for p in sets])
+    coords = np.array([p for s in sets for p in s], dtype=np.float64)
+    circles = getCircles(offsets, coords)
+    for s, c in zip(sets, circles):
+        expected = getCircle(s)
+        if max([abs(a - b) for a, b in zip(c, expected)]) > 1e-9:
+            print 'ERROR: getCircles(): %s, expected: %s' % (list(c), expected)
+
+    # speed of the batch on many small sets
+    n = 100000
+    k = 12
+    coords = np.random.normal(size=(n * k, 2)) * 10.0 + 1.0e6
+    t0 = time.time()
+    getCircles(np.arange(0, n * k + 1, k), coords)
+    t1 = time.time() - t0
+    print 'getCircles() of %d sets of %d points: %.1f sec, %.1f sec per million' % (
+        n, k, t1, t1 * 1.0e6 / n)
+
 
 if __name__ == '__main__':
     _test()
-
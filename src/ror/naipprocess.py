@@ -12,15 +12,24 @@
 
 
 import os
+import re
 import sys
+import time
+import errno
+import shutil
+import socket
 import getopt
 import glob
+import traceback
 import psycopg2
 from osgeo import gdal
 import subprocess
-from multiprocessing import Process, cpu_count
+from multiprocessing import Process, Queue, Pool
+from Queue import Empty
 from config import *
-from utils import getDatabase, runCommand
+from utils import getDatabase, runCommand, getNumCpus
+from tuning import getFreeMemory, loadHostTuning, saveHostTuning, TUNE_MEM_FRACTION
+from tmpalloc import getTmpdirs, allocateTmpdir, releaseTmpdir
 
 
 
@@ -75,36 +84,146 @@ def createVRT(vrtfile, bands):
 
         
 
-def processDOQQ(row, procn, year):
+# ways to convert a DOQQ, see processDOQQ()
+NAIP_PIPELINES = ('subprocess', 'inprocess', 'compare')
 
+NAIP_OVERVIEWS = [2, 4, 8, 16, 32, 64, 128]
+
+NAIP_CREATE_OPTIONS = ['TILED=YES', 'JPEG_QUALITY=90', 'COMPRESS=JPEG', 'INTERLEAVE=BAND']
+
+# cloud optimized geotiff with the same compression, the COG driver
+# writes the overviews and mask overviews in the same pass
+NAIP_COG_OPTIONS = ['COMPRESS=JPEG', 'QUALITY=90', 'BLOCKSIZE=512', 'RESAMPLING=AVERAGE']
+
+# the COG driver is new in gdal 3.1
+COG_GDAL_VERSION = 3010000
+
+# a DOQQ still running after this long is from a dead worker, whatever
+# host it ran on, see reconcileNaip()
+NAIP_STALE_HOURS = 6
+
+# the warped DOQQ covers more pixels than the source
+NAIP_WARP_GROWTH = 1.2
+
+# tmp files and dirs the workers make in the tmpdirs, see tmpPrefix(),
+# the groups are the host and pid of the worker
+NAIP_TMP_RE = re.compile(r'^naip-(.+)-(\d+)-(?:[12]-m_.*\.(?:tif|vrt)|inproc-.+|bench)$')
+
+# smallest GDAL_CACHEMAX and warp memory in MB we give a worker
+MIN_NAIP_CACHE = 64
+
+# MB to split between the workers if the free memory is not known
+NAIP_DEFAULT_MEMORY = 2048
+
+# largest source files opened to size the /vsimem of the workers
+NAIP_VSIMEM_SAMPLE = 10
+
+
+def getNaipBudget(cpus=0, memory=0, nproc=0, threads=0, vsimem=0):
+    '''
+    getNaipBudget(cpus=0, memory=0, nproc=0, threads=0, vsimem=0)
+        cpus    - total cpus to use, 0=all cpus
+        memory  - total MB to use, 0=a share of the free memory
+        nproc   - worker processes, 0=from threads or the benchmark
+        threads - gdal threads of each worker, 0=from nproc or the benchmark
+        vsimem  - MB each worker holds in /vsimem, see getVsimemMB()
+
+    Split a cpu and memory budget between the worker processes and the
+    gdal threads of each. If neither nproc nor threads is given the split
+    is the fastest one of naip-process --benchmark on this host, or one
+    worker per cpu. vsimem comes off the share of the memory of each
+    worker, with fewer workers if what is left is too small for the
+    caches. Each worker gets half of the rest as GDAL_CACHEMAX and a
+    quarter for the warp buffer. Returns a dictionary with cpus, memory,
+    nproc, threads, vsimem, cachemax and warpmem.
+    '''
+    autothreads = threads <= 0
+    if cpus <= 0:
+        cpus = getNumCpus()
+    if memory <= 0:
+        free = getFreeMemory()
+        memory = int(free * TUNE_MEM_FRACTION) if not free is None else NAIP_DEFAULT_MEMORY
+
+    if nproc > 0 and threads <= 0:
+        threads = max(1, cpus / nproc)
+    elif threads > 0 and nproc <= 0:
+        nproc = max(1, cpus / threads)
+    elif nproc <= 0:
+        best = loadHostTuning().get('naip', {}).get('best')
+        threads = 1 if best is None else max(1, min(best['threads'], cpus))
+        nproc = max(1, cpus / threads)
+
+    if nproc * threads > cpus:
+        print "WARNING: {} processes x {} threads > {} cpus!".format(nproc, threads, cpus)
+
+    # the in process pipeline keeps the warped DOQQ in /vsimem
+    if vsimem > 0 and memory / nproc - vsimem < 2 * MIN_NAIP_CACHE:
+        fit = max(1, memory / (vsimem + 2 * MIN_NAIP_CACHE))
+        if fit < nproc:
+            print "WARNING: {} MB fits only {} processes with {} MB of /vsimem each!".format(
+                memory, fit, vsimem)
+            nproc = fit
+            if autothreads:
+                threads = max(1, cpus / nproc)
+
+    share = memory / nproc - vsimem
+    return { 'cpus': cpus, 'memory': memory, 'nproc': nproc, 'threads': threads,
+             'vsimem': vsimem, 'cachemax': max(MIN_NAIP_CACHE, share / 2),
+             'warpmem': max(MIN_NAIP_CACHE, share / 4) }
+
+
+def _creationOptions(budget, cog):
+    # creation options of the target
+    copts = list(NAIP_COG_OPTIONS if cog else NAIP_CREATE_OPTIONS)
+    if not budget is None:
+        copts.append( 'NUM_THREADS={}'.format(budget['threads']) )
+    return copts
+
+
+def _gdalConfigArgs(budget):
+    # --config options of the budget for the gdal command line tools
+    if budget is None:
+        return []
+    return ['--config', 'GDAL_CACHEMAX', str(budget['cachemax']),
+            '--config', 'GDAL_NUM_THREADS', str(budget['threads'])]
+
+
+def processDOQQ(row, procn, year, pipeline=None, budget=None, targetdir=None, cog=None):
+    '''
+    processDOQQ(row, procn, year, pipeline=None, budget=None, targetdir=None, cog=None)
+
+    Warp the source DOQQ of row to naip.projection and write it JPEG
+    compressed with its alpha as an internal mask and overviews to the
+    doqq directory. pipeline is one of NAIP_PIPELINES, defaults to
+    naip.pipeline in the config. 'subprocess' runs the gdal command line
+    tools through tmp files, 'inprocess' uses the gdal bindings and keeps
+    the warped image in /vsimem and 'compare' runs both and prints the
+    time of each. The target is written to a partial name, see
+    partialName(), and only renamed once validateDOQQ() passes, so a
+    worker that dies never leaves a half written target behind. The
+    tmpdir comes from allocateTmpdir(), procn is the worker number.
+    budget is the threads and memory of the worker from
+    getNaipBudget() or None for the gdal defaults. targetdir replaces
+    the doqq directory, eg: for benchmarks. With cog, default naip.cog
+    in the config, the target is a cloud optimized geotiff written in a
+    single pass with the same bands and mask. Returns False if the source
+    file does not exist.
+    '''
     outSrs = CONFIG.get('naip.projection', 'EPSG:4326')
+    if pipeline is None:
+        pipeline = CONFIG.get('naip.pipeline', 'subprocess')
+    if cog is None:
+        cog = CONFIG.get('naip.cog', False)
 
     # setup out paths
     verbose = CONFIG.get('verbose', False)
-    home = CONFIG['projectHomeDir']
-    downl = CONFIG['naip.download']
-    doqqs = CONFIG['naip.doqq_dir']
-    d_source = os.path.join( home, downl, year )
-    d_target = os.path.join( home, doqqs, year )
-
-    # each proc rotates through the tmpdirs if multiple defined
-    tmpdirs = CONFIG.get('tmpdirs', [os.path.join(home, 'tmp')])
-    tmpdir = tmpdirs[procn%len(tmpdirs)]
-
-    # make sure the tmpdir path exists
-    try:
-        if not os.path.exists(tmpdir):
-            os.makedirs(tmpdir)
-    except:
-        pass
 
-    filename = row[0]
-    name = filename[:26] + '.tif'
-    subdir = filename[2:7]
-    f_source = os.path.join(d_source, subdir, name)
-    f_target = os.path.join(d_target, subdir, name)
+    f_source = getSourceFile(row, year)
+    f_target = getTargetFile(row, year)
+    if not targetdir is None:
+        f_target = os.path.join(targetdir, os.path.basename(f_target))
     if not os.path.exists( f_source ):
-        print "WARNING: {} does not exist!".format( filepath )
+        print "WARNING: {} does not exist!".format( f_source )
         return False
 
     # make sure the target path exists
@@ -114,8 +233,136 @@ def processDOQQ(row, procn, year):
     except:
         pass
 
-    tempfile1 = os.path.join(tmpdir, str(os.getpid()) + '-1-' + name)
-    tempfile2 = os.path.join(tmpdir, str(os.getpid()) + '-2-' + name)
+    # the tmpdir on the least loaded disk with room for the warped image,
+    # the inprocess pipeline does not use one
+    alloc = None
+    tmpdir = None
+    if pipeline != 'inprocess':
+        alloc = allocateTmpdir(estimateTmpBytes(f_source, pipeline),
+            'naip-process {} worker {}'.format(os.path.basename(f_source), procn),
+            prefix=tmpPrefix() + '-')
+        tmpdir = alloc['tmpdir']
+
+    f_partial = partialName(f_target)
+    try:
+        if pipeline == 'subprocess':
+            processDOQQSubprocess(f_source, f_partial, tmpdir, outSrs, verbose, budget, cog)
+        elif pipeline == 'inprocess':
+            processDOQQInProcess(f_source, f_partial, outSrs, verbose, budget, cog)
+        elif pipeline == 'compare':
+            compareDOQQPipelines(f_source, f_partial, tmpdir, outSrs, verbose, budget, cog)
+        else:
+            raise ValueError("unknown naip pipeline '{}'!".format(pipeline))
+
+        error = validateDOQQ(f_partial, cog)
+        if not error is None:
+            raise RuntimeError("{} is not valid: {}".format(os.path.basename(f_target), error))
+        os.rename(f_partial, f_target)
+    finally:
+        releaseTmpdir(alloc)
+        if os.path.exists(f_partial):
+            os.remove(f_partial)
+
+    return True
+
+
+def estimateWarpBytes(f_source):
+    '''Return the bytes of f_source warped uncompressed with an alpha band.'''
+    ds = gdal.Open(f_source)
+    if ds is None:
+        return 0
+    nbytes = ds.RasterXSize * ds.RasterYSize * (ds.RasterCount + 1) * NAIP_WARP_GROWTH
+    ds = None
+    return int(nbytes)
+
+
+def estimateTmpBytes(f_source, pipeline):
+    '''
+    estimateTmpBytes(f_source, pipeline)
+
+    Return the bytes of tmp disk processDOQQ() needs for f_source. The
+    subprocess pipeline writes the warped image to the tmpdir, compare
+    also writes the compressed in process output to it and the inprocess
+    pipeline keeps it all in memory, see getVsimemMB().
+    '''
+    if pipeline == 'inprocess':
+        return 0
+    nbytes = estimateWarpBytes(f_source)
+    if pipeline == 'compare':
+        nbytes *= 1.25
+    return int(nbytes)
+
+
+def getVsimemMB(rows, year, pipeline):
+    '''
+    getVsimemMB(rows, year, pipeline)
+
+    Return the MB of /vsimem a worker of pipeline holds for the largest
+    DOQQ of rows, 0 for the subprocess pipeline. Only the largest source
+    files are opened.
+    '''
+    if pipeline == 'subprocess':
+        return 0
+    largest = sortBySourceSize(rows, year)[:NAIP_VSIMEM_SAMPLE]
+    nbytes = max([estimateWarpBytes(getSourceFile(row, year)) for row in largest] + [0])
+    return (nbytes + 1048575) / 1048576
+
+
+def tmpPrefix():
+    '''Return naip-<host>-<pid>, the prefix of the tmp names of this worker.'''
+    return 'naip-{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def partialName(f_target):
+    '''Return the name f_target is written to before it is validated.'''
+    return '{}.partial-{}-{}'.format(f_target, socket.gethostname(), os.getpid())
+
+
+def validateDOQQ(fname, cog=False):
+    '''
+    validateDOQQ(fname, cog=False)
+
+    Return None if fname is a complete DOQQ of the working set or what is
+    wrong with it. It has to open with 5 bands, an internal mask and
+    overviews, be a cloud optimized geotiff with cog, and the last block
+    of each band and its smallest overview have to decode, a truncated
+    file fails on those.
+    '''
+    if not os.path.exists(fname) or os.path.getsize(fname) == 0:
+        return 'missing or empty'
+    ds = gdal.Open(fname)
+    if ds is None:
+        return 'does not open'
+    if ds.RasterCount != 5:
+        return '{} bands instead of 5'.format(ds.RasterCount)
+
+    band = ds.GetRasterBand(1)
+    if not band.GetMaskFlags() & gdal.GMF_PER_DATASET:
+        return 'no mask'
+    if band.GetOverviewCount() == 0:
+        return 'no overviews'
+    if cog and ds.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') != 'COG':
+        return 'not a cloud optimized geotiff'
+
+    bx, by = band.GetBlockSize()
+    x = (ds.RasterXSize - 1) / bx * bx
+    y = (ds.RasterYSize - 1) / by * by
+    for n in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(n)
+        if band.ReadAsArray(x, y, ds.RasterXSize - x, ds.RasterYSize - y) is None:
+            return 'the last block of band {} does not decode'.format(n)
+        ovr = band.GetOverview(band.GetOverviewCount() - 1)
+        if ovr is None or ovr.ReadAsArray() is None:
+            return 'the overview of band {} does not decode'.format(n)
+
+    return None
+
+
+def processDOQQSubprocess(f_source, f_target, tmpdir, outSrs, verbose, budget=None,
+                          cog=False):
+    name = os.path.basename(f_source)
+    tempfile1 = os.path.join(tmpdir, tmpPrefix() + '-1-' + name)
+    tempfile2 = os.path.join(tmpdir, tmpPrefix() + '-2-' + name)
 
     '''
     # I don't think we have collars so lets not do this now
@@ -128,8 +375,12 @@ def processDOQQ(row, procn, year):
     '''
 
     # gdalwarp source file to outSrs
-    cmd = ['gdalwarp', '-t_srs', outSrs, '-dstalpha', '-co', 'TILED=YES',
-           f_source, tempfile1]
+    cmd = ['gdalwarp', '-t_srs', outSrs, '-dstalpha', '-co', 'TILED=YES']
+    if not budget is None:
+        cmd += ['-multi', '-wo', 'NUM_THREADS={}'.format(budget['threads']),
+                # in bytes, gdalwarp reads -wm 10000 and up as bytes
+                '-wm', str(budget['warpmem'] * 1048576)]
+    cmd += _gdalConfigArgs(budget) + [f_source, tempfile1]
     runCommand( cmd, verbose )
 
     vrtfile = tempfile2.replace('.tif', '.vrt')
@@ -146,21 +397,25 @@ def processDOQQ(row, procn, year):
     if verbose:
         print "vrtfile:", vrtfile, "f_target:", f_target
 
-    # gdal_translate jpeg compress it to target
-    cmd = ['gdal_translate', '-co', 'TILED=YES', '-co', 'JPEG_QUALITY=90',
-           '-co', 'COMPRESS=JPEG', '-co', 'INTERLEAVE=BAND',
-           # '-mask', str(mask), '-co', 'ALPHA=YES',
+    # gdal_translate jpeg compress it to target, the target may not
+    # have a .tif extension, see partialName()
+    cmd = ['gdal_translate', '-of', 'COG' if cog else 'GTiff']
+    for co in _creationOptions(budget, cog):
+        cmd += ['-co', co]
+    cmd += _gdalConfigArgs(budget)
+    cmd += [# '-mask', str(mask), '-co', 'ALPHA=YES',
            '-mask', str(mask),
            '--config', 'GDAL_TIFF_INTERNAL_MASK', 'YES', vrtfile, f_target]
     runCommand( cmd, verbose )
 
-    # gdaladdo to target
-    cmd = ['gdaladdo', '-clean', '-r', 'average', f_target,
-           '2', '4', '8', '16', '32', '64', '128']
-    runCommand( cmd, verbose )
+    # gdaladdo to target, the cog already has them
+    if not cog:
+        cmd = ['gdaladdo', '-clean', '-r', 'average'] + _gdalConfigArgs(budget) + \
+              [f_target] + [str(n) for n in NAIP_OVERVIEWS]
+        runCommand( cmd, verbose )
 
     # remove tmpfiles
-    rmglob = os.path.join(tmpdir, str(os.getpid()) + '*')
+    rmglob = os.path.join(tmpdir, tmpPrefix() + '-[12]-*')
     if verbose:
         print "rm {}".format( rmglob )
 
@@ -168,18 +423,130 @@ def processDOQQ(row, procn, year):
         for f in glob.glob( rmglob ):
             os.remove( f )
 
-    return True
+
+def processDOQQInProcess(f_source, f_target, outSrs, verbose, budget=None, cog=False):
+    '''
+    processDOQQInProcess(f_source, f_target, outSrs, verbose, budget=None, cog=False)
+
+    Same output as processDOQQSubprocess() but with the gdal bindings.
+    The source is warped once into an uncompressed tiff in /vsimem, about
+    1.25 times the size of the source, and translated from there to the
+    target with the same band order and mask as the vrt of createVRT(),
+    so nothing but the target is written to disk. The overviews are
+    built on the target before it is closed, or by the COG driver with
+    cog. The warped image is in addition to the memory of the budget.
+    '''
+    fwarp = '/vsimem/naip-{}-{}'.format(os.getpid(), os.path.basename(f_target))
+
+    wopts = {}
+    if not budget is None:
+        gdal.SetCacheMax( budget['cachemax'] * 1048576 )
+        gdal.SetConfigOption( 'GDAL_NUM_THREADS', str(budget['threads']) )
+        wopts = { 'multithread': True,
+                  'warpOptions': ['NUM_THREADS={}'.format(budget['threads'])],
+                  'warpMemoryLimit': budget['warpmem'] * 1048576 }
+
+    if verbose:
+        print "gdal.Warp {} -> {}".format(f_source, fwarp)
+    ds = gdal.Warp( fwarp, f_source, format='GTiff', dstSRS=outSrs, dstAlpha=True,
+                    creationOptions=['TILED=YES'], **wopts )
+    if ds is None:
+        gdal.Unlink( fwarp )
+        raise RuntimeError("gdal.Warp of {} failed!".format(f_source))
+    ds = None
+
+    # warped bands are R, G, B, IR, Alpha, write R, G, B, Alpha, IR and
+    # make the mask from the alpha like '-mask 4' on the vrt does
+    gdal.SetConfigOption( 'GDAL_TIFF_INTERNAL_MASK', 'YES' )
+    try:
+        if verbose:
+            print "gdal.Translate {} -> {}".format(fwarp, f_target)
+        ds = gdal.Translate( f_target, fwarp, format='COG' if cog else 'GTiff',
+                             bandList=[1, 2, 3, 5, 4], maskBand=5,
+                             creationOptions=_creationOptions(budget, cog) )
+        if ds is None:
+            raise RuntimeError("gdal.Translate to {} failed!".format(f_target))
+        ds = None
+
+        if cog:
+            return
+
+        ds = gdal.Open( f_target, gdal.GA_Update )
+        if ds is None or ds.BuildOverviews( 'AVERAGE', NAIP_OVERVIEWS ) != 0:
+            raise RuntimeError("building the overviews of {} failed!".format(f_target))
+        ds = None
+    finally:
+        gdal.SetConfigOption( 'GDAL_TIFF_INTERNAL_MASK', None )
+        gdal.Unlink( fwarp )
+
+
+def compareDOQQPipelines(f_source, f_target, tmpdir, outSrs, verbose, budget=None,
+                         cog=False):
+    '''
+    compareDOQQPipelines(f_source, f_target, tmpdir, outSrs, verbose, budget=None,
+                         cog=False)
+
+    Convert the DOQQ with both pipelines and print the seconds of each.
+    The subprocess output goes to f_target and the in process output to
+    tmpdir, it is removed after its size is compared. The pipeline that
+    runs first alternates by DOQQ so neither one always gets the source
+    from the os file cache.
+    '''
+    # not -1- or -2-, the subprocess pipeline removes those when it is done
+    f_inproc = os.path.join(tmpdir, '{}-inproc-{}'.format(tmpPrefix(),
+                                                          os.path.basename(f_target)))
+
+    runs = [('subprocess', lambda: processDOQQSubprocess(f_source, f_target, tmpdir,
+                                                          outSrs, verbose, budget, cog)),
+            ('inprocess', lambda: processDOQQInProcess(f_source, f_inproc, outSrs,
+                                                       verbose, budget, cog))]
+    if hash(os.path.basename(f_source)) % 2:
+        runs.reverse()
+
+    secs = {}
+    for name, run in runs:
+        t0 = time.time()
+        run()
+        secs[name] = time.time() - t0
+
+    size = os.path.getsize( f_target )
+    isize = os.path.getsize( f_inproc )
+    os.remove( f_inproc )
+
+    print "{0} subprocess {1:.1f} sec, inprocess {2:.1f} sec ({3:.2f}x), size {4:.1f} MB vs {5:.1f} MB".format(
+        os.path.basename(f_target)[:26], secs['subprocess'], secs['inprocess'],
+        secs['subprocess'] / max(secs['inprocess'], 0.001), size / 1048576.0, isize / 1048576.0)
+
+    return secs
 
 
+def getSourceFile(row, year):
+    home = CONFIG['projectHomeDir']
+    downl = CONFIG['naip.download']
+    filename = row[0]
+    return os.path.join( home, downl, year, filename[2:7], filename[:26] + '.tif' )
 
-def processNaipFromQuery(nproc, procn, limit, year):
+
+def getTargetFile(row, year):
+    home = CONFIG['projectHomeDir']
+    doqqs = CONFIG['naip.doqq_dir']
+    filename = row[0]
+    return os.path.join( home, doqqs, year, filename[2:7], filename[:26] + '.tif' )
+
+
+def addStatusColumns(cur, year):
+    # per DOQQ status written by the workers, processed stays null on
+    # failure so the next run picks the DOQQ up again
+    for col in ('status text', 'error text', 'worker text', 'seconds float8',
+                'updated timestamp'):
+        sql = 'alter table naipfetched{0} add column if not exists {1}'.format(year, col)
+        cur.execute( sql )
+
+
+def getNaipWorkFromQuery(limit, year):
     conn, cur = getDatabase()
     verbose = CONFIG.get('verbose', False)
 
-    clause = ''
-    if nproc > 1:
-        clause = " and a.gid % {0} = {1} ".format(nproc, procn)
-
     clause2 = ''
     if limit > 0:
         clause2 = " limit {0} ".format(limit)
@@ -188,34 +555,25 @@ def processNaipFromQuery(nproc, procn, limit, year):
         from naipbbox{0} a
         left outer join naipfetched{0} b on a.gid=b.gid
         where b.gid is not null and b.processed is null
-        {1}
         order by a.gid
-        {2}
-        """.format(year, clause, clause2)
+        {1}
+        """.format(year, clause2)
 
     if verbose:
-        print 'proc: {}, sql: {}'.format(procn, sql)
+        print 'sql: {}'.format(sql)
 
     cur.execute( sql )
     rows = cur.fetchall()
-
-    if verbose:
-        print 'proc: {}, count: {}'.format(procn, len(rows))
-
-    for row in rows:
-        if processDOQQ( row, procn, year ):
-            sql = 'update naipfetched{0} set processed=true where gid={1}'.format(year, row[1])
-            cur.execute( sql )
-
-    conn.commit()
     conn.close()
 
+    return rows
 
 
-def processNaipFromList(files, procn, year):
+def getNaipWorkFromList(files, year):
     conn, cur = getDatabase()
     table = CONFIG['naip.shptable'].format(year)
 
+    rows = []
     for f in files:
         parts = os.path.split(f)              # "path", "file"
         fname = os.path.splitext(parts[1])[0] # "file", "ext"
@@ -224,29 +582,387 @@ def processNaipFromList(files, procn, year):
                  where filename like '{1}%'""".format(table, fname)
 
         cur.execute( sql )
-        rows = cur.fetchall()
+        rows.extend( cur.fetchall() )
+
+    conn.close()
+
+    return rows
+
+
+def _pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _workerAlive(worker, age):
+    # worker is host:pid, we can only look for the pid on this host
+    host, pid = worker.rsplit(':', 1)
+    if host == socket.gethostname():
+        return _pidAlive(int(pid))
+    return age < NAIP_STALE_HOURS * 3600
+
+
+def removeStaleTmpFiles():
+    '''
+    removeStaleTmpFiles()
+
+    Remove the tmp files and benchmark dirs of dead naip-process workers
+    from the tmpdirs, only the names of NAIP_TMP_RE are looked at. The
+    tmpdirs can be shared by several hosts, a worker of another host is
+    dead if its file was not changed for NAIP_STALE_HOURS, see
+    _workerAlive(). Returns (number of files removed, bytes freed).
+    '''
+    nfiles = 0
+    nbytes = 0
+    for tmpdir in getTmpdirs():
+        for f in glob.glob( os.path.join(tmpdir, 'naip-*') ):
+            m = NAIP_TMP_RE.match( os.path.basename(f) )
+            if m is None:
+                continue
+            try:
+                age = time.time() - os.path.getmtime( f )
+            except OSError:
+                continue
+            if _workerAlive('{}:{}'.format(m.group(1), m.group(2)), age):
+                continue
+            try:
+                if os.path.isdir( f ):
+                    for dirpath, dirs, files in os.walk( f ):
+                        nbytes += sum([os.path.getsize(os.path.join(dirpath, x)) for x in files])
+                    shutil.rmtree( f )
+                else:
+                    nbytes += os.path.getsize( f )
+                    os.remove( f )
+                nfiles += 1
+            except OSError, e:
+                print "WARNING: could not remove {}: {}".format(f, str(e))
+
+    return (nfiles, nbytes)
+
+
+def reconcileNaip(year, validate=False):
+    '''
+    reconcileNaip(year, validate=False)
+
+    Clean up after naip-process workers that died and requeue only the
+    DOQQs they left unfinished, run before the work is queued. It removes
+    the stale tmp files, see removeStaleTmpFiles(), and the partial
+    targets of dead workers, requeues the DOQQs that are still running
+    in the naipfetched table for a dead worker and the processed DOQQs
+    whose target is missing, or with validate is not valid. Unprocessed
+    DOQQs whose target is valid, eg: the worker died right after the
+    rename, are marked processed. A worker is dead if its pid is gone on
+    this host, or on another host if it was not updated for
+    NAIP_STALE_HOURS. Returns the number of DOQQs requeued.
+    '''
+    nfiles, nbytes = removeStaleTmpFiles()
+
+    # partial targets of dead workers, see partialName()
+    npartial = 0
+    home = CONFIG['projectHomeDir']
+    pattern = os.path.join( home, CONFIG['naip.doqq_dir'], year, '*', '*.partial-*' )
+    for f in glob.glob( pattern ):
+        host, pid = f.rsplit('.partial-', 1)[1].rsplit('-', 1)
+        if _workerAlive('{}:{}'.format(host, pid), time.time() - os.path.getmtime(f)):
+            continue
+        os.remove( f )
+        npartial += 1
+
+    conn, cur = getDatabase()
+    sql = """select a.filename, a.gid, b.processed, b.status, b.worker,
+            extract(epoch from now() - b.updated)
+        from naipbbox{0} a join naipfetched{0} b on a.gid=b.gid
+        order by a.gid""".format(year)
+    cur.execute( sql )
+    rows = cur.fetchall()
+
+    requeue = []
+    finished = []
+    for filename, gid, processed, status, worker, age in rows:
+        f_target = getTargetFile((filename, gid), year)
+        if status == 'running' and not worker is None and _workerAlive(worker, age or 0):
+            continue
+        if processed:
+            if not os.path.exists( f_target ):
+                requeue.append( (gid, 'target is missing') )
+            elif validate:
+                error = validateDOQQ( f_target )
+                if not error is None:
+                    requeue.append( (gid, 'target is not valid: ' + error) )
+        elif status == 'running':
+            requeue.append( (gid, 'worker {} died'.format(worker)) )
+        elif os.path.exists( f_target ) and validateDOQQ( f_target ) is None:
+            finished.append( gid )
+
+    for gid, error in requeue:
+        sql = """update naipfetched{0} set processed=null, status='requeued',
+            error=%s, updated=now() where gid=%s""".format(year)
+        cur.execute( sql, (error, gid) )
+    for gid in finished:
+        sql = """update naipfetched{0} set processed=true, status='done',
+            error=null, updated=now() where gid=%s""".format(year)
+        cur.execute( sql, (gid,) )
+    conn.close()
+
+    print "Reconciled {} DOQQs: removed {} stale tmp files ({:.1f} MB) and {} partial targets, requeued {}, found {} finished".format(
+        len(rows), nfiles, nbytes / 1048576.0, npartial, len(requeue), len(finished))
+
+    return len(requeue)
 
-        for row in rows:
-            if processDOQQ( row, procn, year ):
-                sql = 'update naipfetched{0} set processed=true where gid={1}'.format(year, row[1])
-                cur.execute( sql )
 
-    conn.commit()
+def naipWorker(work, done, procn, year, pipeline=None, budget=None, cog=None):
+    '''
+    naipWorker(work, done, procn, year, pipeline=None, budget=None, cog=None)
+
+    Process that takes (filename, gid) rows from the work queue until it
+    gets None, processes each DOQQ and writes its status back to the
+    naipfetched table. Puts (row, ok, seconds) on the done queue for
+    each row.
+    '''
+    conn, cur = getDatabase()
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    while True:
+        row = work.get()
+        if row is None:
+            break
+
+        sql = """update naipfetched{0} set status='running', error=null,
+            worker=%s, updated=now() where gid=%s""".format(year)
+        cur.execute( sql, (worker, row[1]) )
+
+        t0 = time.time()
+        error = None
+        try:
+            ok = processDOQQ( row, procn, year, pipeline, budget, None, cog )
+            if not ok:
+                error = 'source file does not exist'
+        except Exception, e:
+            ok = False
+            error = str(e) or traceback.format_exc()
+        secs = time.time() - t0
+
+        if ok:
+            sql = """update naipfetched{0} set processed=true, status='done',
+                seconds=%s, updated=now() where gid=%s""".format(year)
+            cur.execute( sql, (secs, row[1]) )
+        else:
+            print "ERROR: {} failed: {}".format(row[0], error)
+            sql = """update naipfetched{0} set status='failed', error=%s,
+                seconds=%s, updated=now() where gid=%s""".format(year)
+            cur.execute( sql, (error, secs, row[1]) )
+
+        done.put( (row, ok, secs) )
+
     conn.close()
 
 
+def _fmtEta(secs):
+    if secs < 3600:
+        return '{:.1f} min'.format(secs / 60.0)
+    return '{:.1f} hours'.format(secs / 3600.0)
+
+
+def sortBySourceSize(rows, year):
+    '''Return rows sorted by the size of their source file, largest first.'''
+    def size(row):
+        f = getSourceFile(row, year)
+        return os.path.getsize(f) if os.path.exists(f) else 0
+
+    return sorted(rows, key=size, reverse=True)
+
+
+def runNaipWorkers(rows, nproc, year, pipeline=None, budget=None, cog=None):
+    '''
+    runNaipWorkers(rows, nproc, year, pipeline=None, budget=None, cog=None)
+
+    Process the DOQQs in rows with nproc worker processes that pull the
+    next DOQQ from a shared queue as soon as they are free, so a slow
+    DOQQ or disk does not leave the other workers idle at the end. The
+    largest source files are queued first. Prints the progress and ETA
+    over all the workers and returns the number of DOQQs that failed.
+    '''
+    rows = sortBySourceSize(rows, year)
+    nproc = max(1, min(nproc, len(rows)))
+
+    work = Queue()
+    done = Queue()
+    for row in rows:
+        work.put( row )
+    for m in range(nproc):
+        work.put( None )
+
+    processes = []
+    for m in range(nproc):
+        p = Process( target=naipWorker, args=(work, done, m, year, pipeline, budget, cog) )
+        p.start()
+        processes.append(p)
+
+    t0 = time.time()
+    failed = 0
+    n = 0
+    while n < len(rows):
+        try:
+            row, ok, secs = done.get( True, 10 )
+        except Empty:
+            if not any([p.is_alive() for p in processes]):
+                print "ERROR: all workers exited with {} DOQQs left!".format(len(rows) - n)
+                failed += len(rows) - n
+                break
+            continue
+        n += 1
+        if not ok:
+            failed += 1
+        elapsed = time.time() - t0
+        eta = elapsed / n * (len(rows) - n)
+        print "{0} {1} in {2:.0f} sec ({3} of {4}, {5:.0f}%, {6} failed, ETA {7})".format(
+            row[0][:26], 'done' if ok else 'FAILED', secs, n, len(rows),
+            100.0 * n / len(rows), failed, _fmtEta(eta))
+
+    # wait for the processes to all finish
+    for p in processes:
+        p.join()
+
+    print "Processed {} DOQQs in {} with {} failed".format(
+        len(rows), _fmtEta(time.time() - t0), failed)
+
+    return failed
+
+
+
+def getNaipSplits(cpus):
+    '''Return the (nproc, threads) splits of cpus to benchmark.'''
+    splits = []
+    n = 1
+    while n < cpus:
+        splits.append( (n, cpus / n) )
+        n *= 2
+    splits.append( (cpus, 1) )
+    return splits
+
+
+def _benchmarkDOQQ(job):
+    # pool worker of benchmarkNaipSplits()
+    row, procn, year, pipeline, budget, targetdir, cog = job
+    t0 = time.time()
+    try:
+        ok = processDOQQ( row, procn, year, pipeline, budget, targetdir, cog )
+    except Exception, e:
+        print "ERROR: {} failed: {}".format(row[0], str(e))
+        ok = False
+    return (row, ok, time.time() - t0)
+
+
+def benchmarkNaipSplits(rows, cpus, memory, year, pipeline, cog=None):
+    '''
+    benchmarkNaipSplits(rows, cpus, memory, year, pipeline, cog=None)
+        rows     - (filename, gid) of the DOQQs to process in each run
+        cpus     - total cpus to split, 0=all cpus
+        memory   - total MB to split, 0=a share of the free memory
+        year     - naip year of the DOQQs
+        pipeline - one of NAIP_PIPELINES, see processDOQQ()
+        cog      - write cloud optimized geotiffs, see processDOQQ()
+
+    Process rows once for each split of cpus between worker processes
+    and gdal threads, see getNaipSplits(), and print the wall time and
+    DOQQs per hour of each. The outputs go to a tmpdir and are removed
+    after each run, the naipfetched table is not changed. The fastest
+    split is saved for the host and used by getNaipBudget(). Returns the
+    benchmark record or None if every run failed.
+    '''
+    budget = getNaipBudget(cpus, memory, 1, 1)
+    cpus = budget['cpus']
+    memory = budget['memory']
+    rows = sortBySourceSize(rows, year)
+    vsimem = getVsimemMB(rows, year, pipeline)
+
+    targetdir = os.path.join(getTmpdirs()[0], tmpPrefix() + '-bench')
+    if not os.path.exists(targetdir):
+        os.makedirs(targetdir)
+
+    results = []
+    for nproc, threads in getNaipSplits(cpus):
+        # with fewer DOQQs than workers the extra workers would sit idle
+        if nproc > len(rows):
+            continue
+        budget = getNaipBudget(cpus, memory, nproc, threads, vsimem)
+        if budget['nproc'] < nproc:
+            print "Skipping {} processes, their /vsimem does not fit in {} MB".format(
+                nproc, memory)
+            continue
+        print "Benchmarking {} processes x {} threads on {} DOQQs ...".format(
+            nproc, threads, len(rows))
+
+        jobs = [(row, n, year, pipeline, budget, targetdir, cog)
+                for n, row in enumerate(rows)]
+        t0 = time.time()
+        pool = Pool( nproc )
+        done = pool.map( _benchmarkDOQQ, jobs, 1 )
+        pool.close()
+        pool.join()
+        secs = time.time() - t0
+
+        for f in glob.glob( os.path.join(targetdir, '*') ):
+            os.remove( f )
+
+        results.append({ 'nproc': nproc, 'threads': threads,
+                         'cachemax': budget['cachemax'], 'seconds': secs,
+                         'failed': len([d for d in done if not d[1]]),
+                         'doqqsperhour': len(rows) * 3600.0 / max(secs, 0.001) })
+
+    os.rmdir( targetdir )
+
+    ok = [r for r in results if r['failed'] == 0]
+    if len(ok) == 0:
+        print "ERROR: every benchmark run failed!"
+        return None
+    best = min(ok, key=lambda r: r['seconds'])
+
+    print
+    print " Procs | Threads | Cache MB |  Seconds | DOQQs/hour "
+    print "-------+---------+----------+----------+------------"
+    for r in results:
+        print " {0:5d} | {1:7d} | {2:8d} | {3:8.1f} | {4:10.1f} {5}".format(r['nproc'],
+            r['threads'], r['cachemax'], r['seconds'], r['doqqsperhour'],
+            '*' if r is best else ('failed' if r['failed'] > 0 else ''))
+    print "-------+---------+----------+----------+------------"
+
+    record = { 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'cpus': cpus,
+               'memory': memory, 'pipeline': pipeline, 'cog': bool(cog),
+               'doqqs': len(rows),
+               'results': results,
+               'best': { 'nproc': best['nproc'], 'threads': best['threads'] } }
+
+    host = loadHostTuning()
+    host['naip'] = record
+    saveHostTuning( host )
+
+    return record
+
 
 def ProcessNaip( argv ):
     try:
-        opts, args = getopt.getopt(argv, "y:n:l:f", ['year', 'nproc', 'limit', 'files'])
+        opts, args = getopt.getopt(argv, "y:n:l:fp:t:c:m:b", ['year', 'nproc', 'limit',
+                                   'files', 'pipeline=', 'threads=', 'cpus=', 'memory=',
+                                   'benchmark', 'cog', 'validate'])
     except:
         return True # error occurred
 
     verbose = CONFIG.get('verbose', False)
     year = CONFIG['year']
     nproc = CONFIG.get('nproc', 1)
+    threads = 0
+    cpus = 0
+    memory = 0
+    benchmark = False
+    cog = CONFIG.get('naip.cog', False)
+    validate = False
     limit = 0
     dofiles = False
+    pipeline = CONFIG.get('naip.pipeline', 'subprocess')
 
     for opt, arg in opts:
         if opt in ('-y', '--year'):
@@ -257,31 +973,53 @@ def ProcessNaip( argv ):
             limit = int(arg)
         elif opt in ('-f', '--files'):
             dofiles = True
+        elif opt in ('-p', '--pipeline'):
+            pipeline = arg
+        elif opt in ('-t', '--threads'):
+            threads = int(arg)
+        elif opt in ('-c', '--cpus'):
+            cpus = int(arg)
+        elif opt in ('-m', '--memory'):
+            memory = int(arg)
+        elif opt in ('-b', '--benchmark'):
+            benchmark = True
+        elif opt == '--cog':
+            cog = True
+        elif opt == '--validate':
+            validate = True
 
     if dofiles and len(args) == 0:
         print "ERROR: the -f|--files requires a list of files to process!"
         return True
 
+    if not pipeline in NAIP_PIPELINES:
+        print "ERROR: -p|--pipeline must be one of {}!".format(', '.join(NAIP_PIPELINES))
+        return True
+
+    if cog and int(gdal.VersionInfo()) < COG_GDAL_VERSION:
+        print "ERROR: --cog requires gdal 3.1 or newer, this is {}!".format(
+            gdal.VersionInfo('RELEASE_NAME'))
+        return True
+
     if limit < 0:
         print "ERROR: -l|--limit value must be greater than 0!"
         return True
 
-    ncpu = CONFIG.get('ncpu', 1) # get a good default number
-    try:
-        ncpu = cpu_count()
-    except NotImplementedError:
-        pass
-
+    ncpu = getNumCpus()
     if nproc > ncpu:
         print "WARNING: nproc: ({}) > ncpu ({})!".format(nproc, ncpu)
 
-    if nproc == 0:
-        nproc = ncpu
+    budget = getNaipBudget(cpus, memory, nproc, threads)
+    nproc = budget['nproc']
 
     if verbose:
         print '----------------------------------'
         print 'NAIP year: {}'.format(year)
         print 'Num Procs: {}'.format(nproc)
+        print 'Threads: {}'.format(budget['threads'])
+        print 'GDAL_CACHEMAX: {} MB'.format(budget['cachemax'])
+        print 'Pipeline: {}'.format(pipeline)
+        print 'COG: {}'.format(cog)
         if limit > 0:
             print 'Limit: {}'.format(limit)
         if dofiles:
@@ -290,32 +1028,40 @@ def ProcessNaip( argv ):
             print 'Processing files from database.'
         print '----------------------------------'
 
-    processes = []
+    conn, cur = getDatabase()
+    addStatusColumns(cur, year)
+    conn.close()
+
+    if not benchmark:
+        reconcileNaip(year, validate)
 
     # we process a list of files here
     if dofiles:
-        if len(args) < nproc:
-            nproc = len(args)
-
-        n = int(len(args)/nproc + 0.5)
-
-        for m in range(nproc):
-            p = Process( target=processNaipFromList,
-                         args=(args[m*n:(m+1)*n], m, year) )
-            p.start()
-            processes.append(p)
+        rows = getNaipWorkFromList(args, year)
 
     # we process files from a DB query here
     else:
+        # enough DOQQs to keep every worker of every split busy
+        if benchmark and limit == 0:
+            limit = budget['cpus']
+        rows = getNaipWorkFromQuery(limit, year)
 
-        for m in range(nproc):
-            p = Process( target=processNaipFromQuery,
-                         args=(nproc, m, limit, year) )
-            p.start()
-            processes.append(p)
+    if len(rows) == 0:
+        print "No DOQQs to process!"
+        return False
 
-    # wait for the processes to all finish
-    for p in processes:
-        p.join()
+    if benchmark:
+        benchmarkNaipSplits(rows, budget['cpus'], budget['memory'], year, pipeline, cog)
+        return False
+
+    vsimem = getVsimemMB(rows, year, pipeline)
+    if vsimem > 0:
+        budget = getNaipBudget(budget['cpus'], budget['memory'], nproc, threads, vsimem)
+        nproc = budget['nproc']
 
+    print "Using {} processes x {} threads of {} cpus, GDAL_CACHEMAX {} MB per process".format(
+        nproc, budget['threads'], budget['cpus'], budget['cachemax'])
+    if vsimem > 0:
+        print "Each process holds up to {} MB of /vsimem for the warped DOQQ".format(vsimem)
 
+    runNaipWorkers(rows, nproc, year, pipeline, budget, cog)
@@ -0,0 +1,116 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import json
+
+from optimalparameters import getOptimalFromDetail
+from config import *
+
+'''
+Cache of the optimal parameters of the windows we have analysed. A row
+is keyed by the naip year, the window bounds in map units, the bands,
+boxy and the local variance chunking, and holds the hs/hr/M results
+with the raw semivariogram curves and local variance summaries they
+came from, see getOptimalParameters( ..., detail ). The results can be
+recomputed from the curves without reading any pixels. The table is
+created by initdb or once by the process that starts a sample, never by
+its pool workers, concurrent create table can fail in PostgreSQL.
+'''
+
+OPTIMAL_CACHE_TABLE = 'segments.optimalcache'
+
+
+def createOptimalCacheTable( cur ):
+    cur.execute('''create table if not exists {} (
+        year text not null,
+        bounds text not null,
+        bands text not null,
+        boxy boolean not null,
+        chunkrows integer not null,
+        xmin float8,
+        ymin float8,
+        xmax float8,
+        ymax float8,
+        params text,
+        detail text,
+        seconds float8,
+        updated timestamp default now(),
+        primary key (year, bounds, bands, boxy, chunkrows))'''.format(OPTIMAL_CACHE_TABLE))
+
+
+def boundsKey( bounds ):
+    '''Return the text key of [xmin, ymin, xmax, ymax] bounds.'''
+    return ','.join(['{:.7f}'.format(v) for v in bounds])
+
+
+def bandsKey( bands ):
+    return ','.join([str(b) for b in sorted(bands)])
+
+
+def getCachedOptimal( cur, year, bounds, bands, boxy, chunkrows ):
+    '''
+    getCachedOptimal( cur, year, bounds, bands, boxy, chunkrows )
+
+    Return (optimal parameters, detail) of the window or None if it is
+    not in the cache. The table has to exist, see createOptimalCacheTable().
+    '''
+    sql = '''select params, detail from {} where year = %s and bounds = %s
+        and bands = %s and boxy = %s and chunkrows = %s'''.format(OPTIMAL_CACHE_TABLE)
+    cur.execute( sql, (str(year), boundsKey(bounds), bandsKey(bands), bool(boxy),
+                       int(chunkrows)) )
+    row = cur.fetchone()
+    if row is None:
+        return None
+
+    return (json.loads(row[0]), json.loads(row[1]))
+
+
+def saveCachedOptimal( cur, year, bounds, bands, boxy, chunkrows, opt, detail, seconds ):
+    # the table has to exist, see createOptimalCacheTable()
+    sql = '''insert into {} (year, bounds, bands, boxy, chunkrows, xmin, ymin,
+            xmax, ymax, params, detail, seconds, updated)
+        values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, now())
+        on conflict (year, bounds, bands, boxy, chunkrows) do update set
+            params = excluded.params, detail = excluded.detail,
+            seconds = excluded.seconds, updated = now()'''.format(OPTIMAL_CACHE_TABLE)
+    cur.execute( sql, (str(year), boundsKey(bounds), bandsKey(bands), bool(boxy),
+                       int(chunkrows), bounds[0], bounds[1], bounds[2], bounds[3],
+                       json.dumps(opt), json.dumps(detail), seconds) )
+
+
+def getCachedWindows( cur, year, bands, boxy, chunkrows, bbox ):
+    '''
+    getCachedWindows( cur, year, bands, boxy, chunkrows, bbox )
+
+    Return the cached windows whose center is in bbox [xmin, ymin, xmax,
+    ymax] as a list of (window, optimal parameters, seconds) like
+    sampleOptimalParameters(). The parameters are recomputed from the
+    stored curves, see getOptimalFromDetail().
+    '''
+    createOptimalCacheTable( cur )
+    sql = '''select xmin, ymin, xmax, ymax, detail, seconds from {}
+        where year = %s and bands = %s and boxy = %s and chunkrows = %s
+          and (xmin + xmax) / 2 between %s and %s
+          and (ymin + ymax) / 2 between %s and %s
+        order by ymax desc, xmin'''.format(OPTIMAL_CACHE_TABLE)
+    cur.execute( sql, (str(year), bandsKey(bands), bool(boxy), int(chunkrows),
+                       bbox[0], bbox[2], bbox[1], bbox[3]) )
+
+    results = []
+    for row in cur:
+        win = { 'n': len(results), 'bounds': list(row[:4]), 'cached': True,
+                'x': (row[0] + row[2]) / 2.0, 'y': (row[1] + row[3]) / 2.0 }
+        results.append( (win, getOptimalFromDetail( boxy, json.loads(row[4]) ), row[5]) )
+
+    return results
@@ -13,6 +13,7 @@
 
 import sys
 import math
+import time
 import numpy as np
 from scipy import ndimage
 from scipy.stats import norm
@@ -26,6 +27,9 @@ except:
 
 #gdal.UseExceptions()
 
+# range parameters for search [2, 100, 2] => 2 through 100 by 2
+OPTIMAL_DRANGE = [2, 100, 2]
+
 
 def semivariogram( ds, band, lag ):
     '''
@@ -100,12 +104,85 @@ def semivariogram( ds, band, lag ):
     return [sumw/Nh2, sumh/Nh2, (sumw/Nh2+sumh/Nh2)/2.0]
 
 
+# max bytes of the fft of a block of columns in _lagSums()
+SV_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def _lagSums( data, lags ):
+    '''
+    Return the sum of (data[i+lag,j] - data[i,j])**2 over i < height-lag
+    and j < width-lag for each lag. The cross terms of all lags come from
+    one fft autocorrelation of each column and the squared terms from
+    cumulative sums of the first and last rows, done in blocks of columns
+    to bound the memory.
+    '''
+    height, width = data.shape
+    lags = np.asarray(lags, dtype=np.int64)
+    maxlag = int(lags.max())
+    sums = np.zeros(len(lags), dtype=np.float64)
+
+    # pad so the circular correlation does not wrap for lags <= maxlag
+    nfft = 1 << int(math.ceil(math.log(height + maxlag, 2)))
+    block = max(1, SV_BLOCK_BYTES // (16 * nfft))
+    for c0 in range(0, width, block):
+        cols = data[:, c0:c0+block]
+        f = np.fft.rfft( cols, n=nfft, axis=0 )
+        acf = np.fft.irfft( f * f.conj(), n=nfft, axis=0 )[lags, :]
+        f = None
+
+        sqr = cols * cols
+        total = sqr.sum(axis=0)
+        head = np.vstack([np.zeros((1, cols.shape[1])), np.cumsum(sqr[:maxlag], axis=0)])
+        tail = np.vstack([np.zeros((1, cols.shape[1])), np.cumsum(sqr[:-maxlag-1:-1], axis=0)])
+
+        # sum over i < height-lag of data[i]**2 + data[i+lag]**2 - 2*data[i]*data[i+lag]
+        pairs = 2.0 * total - head[lags, :] - tail[lags, :] - 2.0 * acf
+        keep = np.arange(c0, c0 + cols.shape[1])[np.newaxis, :] < (width - lags)[:, np.newaxis]
+        sums += (pairs * keep).sum(axis=1)
+
+    return sums
+
+
+def semivariogramCurve( band, lags ):
+    '''
+    semivariogramCurve( band, lags )
+
+    Return an array with a row of [Horizontal variance, Vertical variance,
+    Average of Horizontal and Vertical variances] for each lag in lags,
+    see semivariogram(). The band is read once and all the lags are
+    computed in one pass with fft autocorrelations. Lags that are not
+    smaller than the image are NaN.
+    '''
+    width = band.XSize
+    height = band.YSize
+    data = band.ReadAsArray( 0, 0, width, height ).astype(np.float64)
+
+    # the differences do not change with an offset, and the autocorrelation
+    # is more precise around zero
+    data -= data.mean()
+
+    lags = np.asarray(lags, dtype=np.int64)
+    curve = np.empty((len(lags), 3), dtype=np.float64)
+    curve.fill(np.nan)
+    ok = lags < min(width, height)
+    if not ok.any():
+        return curve
+
+    Nh2 = 2.0 * (width - lags[ok]) * (height - lags[ok])
+    curve[ok, 0] = _lagSums( data, lags[ok] ) / Nh2
+    curve[ok, 1] = _lagSums( data.T, lags[ok] ) / Nh2
+    curve[ok, 2] = (curve[ok, 0] + curve[ok, 1]) / 2.0
+
+    return curve
+
+
 def getOptimalSV( b, data, drange, verbose, plotit ):
     '''
     getOptimalSV( b, data, drange, verbose, plotit )
 
         b       - band number (used for title on plots
-        data    - synthetic variance for each successive lag
+        data    - synthetic variance for each successive lag, an array
+                  from semivariogramCurve() or a list of rows
         drange  - [start, end, step] the range of lag values
         verbose - bool flag to trigger additional prints
         plotit  - bool flag to generate and display plots
@@ -116,38 +193,25 @@ def getOptimalSV( b, data, drange, verbose, plotit ):
     Hongyue Cai, Longxiang Li, Cheng Qiao, and Jinyang Du
 
     '''
-    optw = None
-    opth = None
-    opta = None
-    minw = None
-    minh = None
-    mins = None
-    y = []
-    for i in range(1,len(data)):
-        #print data[i], data[i-1]
-        dw = data[i][0] - data[i-1][0]
-        dh = data[i][1] - data[i-1][1]
-        da = data[i][2] - data[i-1][2]
-        y.append(da)
-        if optw is None and dw <= 0.0:
-            optw = i*drange[2]+drange[0]
-        if minw is None or dw < minw[0]:
-            minw = [dw, i*drange[2]+drange[0]]
-        if opth is None and dh <= 0.0:
-            opth = i*drange[2]+drange[0]
-        if minh is None or dh < minh[0]:
-            minh = [dh, i*drange[2]+drange[0]]
-        if opta is None and da <= 0.0:
-            opta = i*drange[2]+drange[0]
-        if mins is None or da < mins[0]:
-            mins = [da, i*drange[2]+drange[0]]
-
-    if optw is None and not minw is None:
-        optw = minw[1]
-    if opth is None and not minh is None:
-        opth = minh[1]
-    if opta is None and not mins is None:
-        opta = mins[1]
+    data = np.asarray(data, dtype=np.float64).reshape(-1, 3)
+    if len(data) < 2:
+        return [None, None, None]
+
+    # increase of each semivariance from one lag to the next
+    diff = np.diff(data, axis=0)
+    lags = np.arange(1, len(data)) * drange[2] + drange[0]
+
+    # the first lag where the semivariance stops increasing,
+    # or where it increases the least
+    opt = []
+    for k in range(3):
+        stop = np.flatnonzero(diff[:, k] <= 0.0)
+        if len(stop) > 0:
+            opt.append(int(lags[stop[0]]))
+        elif np.isnan(diff[:, k]).all():
+            opt.append(None)
+        else:
+            opt.append(int(lags[np.nanargmin(diff[:, k])]))
 
     if plotit:
         x = range(drange[0], drange[1], drange[2])
@@ -155,20 +219,22 @@ def getOptimalSV( b, data, drange, verbose, plotit ):
         plt.xlabel('Lag (h)(pixel)')
         plt.ylabel('Increase of synthetic semivariance')
         plt.title('Band {}'.format(b))
-        plt.plot(x,y,'r')
+        plt.plot(x,diff[:, 2],'r')
         plt.show()
 
-    return [optw, opth, opta]
+    return opt
 
 
-def getOptimalHs( ds, useBands, drange, verbose, plotit ):
+def getOptimalHs( ds, useBands, drange, verbose, plotit, detail=None ):
     '''
-    getOptimalHs( ds, useBands, drange, verbose, plotit )
+    getOptimalHs( ds, useBands, drange, verbose, plotit, detail=None )
         ds       - gdal dataset reference for the image
         useBands - list of bands to evaluate
         drange   - [start, end, step] for lags to evaluate
         verbose  - bool flag to turn on additional prints
         plotit   - bool flag to generate and display plots
+        detail   - optional dictionary, the semivariogram curve of each
+                   band is added to detail['sv'] keyed by band number
 
     Compute the optimal spatial bandwidth based on the semivariogram
     of the image.
@@ -196,11 +262,10 @@ def getOptimalHs( ds, useBands, drange, verbose, plotit ):
             print "STATS({}): min: {}, max: {}, mean: {}, stddev: {}".format(
                 b, stats[0], stats[1], stats[2], stats[3] )
 
-        # create a slot we can add sv data to
-        data.append([])
-        for lag in range(drange[0], drange[1], drange[2]):
-            sv = semivariogram( ds, band, lag )
-            data[ii].append(sv)
+        # all the lags at once, the band is only read once
+        data.append( semivariogramCurve( band, range(drange[0], drange[1], drange[2]) ) )
+        if not detail is None:
+            detail.setdefault('sv', {})[str(b)] = data[ii].tolist()
 
         opt = getOptimalSV( b1, data[ii], drange, verbose, plotit )
         opt_hs.append(opt[2])
@@ -209,9 +274,9 @@ def getOptimalHs( ds, useBands, drange, verbose, plotit ):
 
         if plotit:
             x = range(drange[0], drange[1], drange[2])
-            y1 = [ y[0] for y in data[ii] ]
-            y2 = [ y[1] for y in data[ii] ]
-            y3 = [ y[2] for y in data[ii] ]
+            y1 = data[ii][:, 0]
+            y2 = data[ii][:, 1]
+            y3 = data[ii][:, 2]
             plt.xlabel('Lag (h)(pixel)')
             plt.ylabel('Semivariance')
             plt.title('Band {}'.format(b1))
@@ -227,14 +292,104 @@ def getOptimalHs( ds, useBands, drange, verbose, plotit ):
     return (hs_min, hs_max, hs_avg)
 
 
-def getOptimalHr( ds, useBands, winsize, verbose, plotit ):
+def _chunkVariance( data, winsize ):
     '''
-    getOptimalHr( ds, useBands, winsize, verbose, plotit )
-        ds       - gdal dataset image reference
-        useBands - list of bands to consider
-        winsize  - window size for local variance
-        verbose  - bool flag to print messages
-        plotit   - bool flag to generate and show plots
+    Return the float32 variance in a winsize box around each pixel of
+    data, which already has the halo rows and columns around it, from
+    summed-area tables. The tables are float64 so they are exact for
+    integer pixel values.
+    '''
+    rows = data.shape[0] - winsize + 1
+    cols = data.shape[1] - winsize + 1
+    n = float(winsize * winsize)
+
+    sums = []
+    for v in (data, data * data):
+        sat = np.zeros((v.shape[0] + 1, v.shape[1] + 1), dtype=np.float64)
+        np.cumsum( v, axis=0, dtype=np.float64, out=sat[1:, 1:] )
+        np.cumsum( sat[1:, 1:], axis=1, out=sat[1:, 1:] )
+        sums.append( sat[winsize:, winsize:] - sat[:rows, winsize:]
+                     - sat[winsize:, :cols] + sat[:rows, :cols] )
+        sat = None
+
+    var = (sums[1] - sums[0] * sums[0] / n) / n
+    return np.maximum(var, 0.0).astype(np.float32)
+
+
+def localVarianceStats( band, winsize, chunkrows, nbins=64 ):
+    '''
+    localVarianceStats( band, winsize, chunkrows, nbins=64 )
+        band      - gdal band to evaluate
+        winsize   - window size for local variance
+        chunkrows - number of rows of the local variance image per chunk
+        nbins     - number of bins in the histogram
+
+    Compute the local variance image of band in chunks of rows with a
+    halo of winsize rows around them, reflected at the edges of the image
+    like ndimage.uniform_filter(), and stream it into a running mean,
+    variance and histogram so the full image is never in memory.
+    Returns (mu, sigma, counts, edges) where mu and sigma are what
+    norm.fit() returns for the whole local variance image.
+    '''
+    width = band.XSize
+    height = band.YSize
+    before = winsize // 2
+    after = (winsize - 1) // 2
+
+    # the local variance is at most a quarter of the squared range
+    vmin, vmax = band.ComputeRasterMinMax( False )
+    edges = np.linspace( 0.0, max(1.0, (vmax - vmin) ** 2 / 4.0), nbins + 1 )
+    counts = np.zeros( nbins, dtype=np.int64 )
+
+    num = 0
+    mean = 0.0
+    m2 = 0.0
+    for r0 in range(0, height, chunkrows):
+        r1 = min(height, r0 + chunkrows)
+        y0 = max(0, r0 - before)
+        y1 = min(height, r1 + after)
+        data = band.ReadAsArray( 0, y0, width, y1 - y0 ).astype(np.float32)
+        data = np.pad( data, ((before - (r0 - y0), after - (y1 - r1)), (before, after)),
+                       'symmetric' )
+        lv = _chunkVariance( data, winsize )
+        data = None
+
+        # merge the chunk into the running mean and variance
+        n = lv.size
+        cmean = float(lv.mean(dtype=np.float64))
+        cm2 = float(((lv - cmean) ** 2).sum(dtype=np.float64))
+        delta = cmean - mean
+        mean += delta * n / (num + n)
+        m2 += cm2 + delta * delta * num * n / (num + n)
+        num += n
+
+        counts += np.histogram( lv, edges )[0]
+
+    return (mean, math.sqrt(m2 / num), counts, edges)
+
+
+def _addLVDetail( detail, b, winsize, mu, sigma, counts, edges ):
+    detail.setdefault('lv', {})[str(b)] = { 'winsize': winsize,
+        'mu': float(mu), 'sigma': float(sigma),
+        'counts': [int(c) for c in counts], 'edges': [float(e) for e in edges] }
+
+
+def getOptimalHr( ds, useBands, winsize, verbose, plotit, chunkrows=0, detail=None ):
+    '''
+    getOptimalHr( ds, useBands, winsize, verbose, plotit, chunkrows=0, detail=None )
+        ds        - gdal dataset image reference
+        useBands  - list of bands to consider
+        winsize   - window size for local variance
+        verbose   - bool flag to print messages
+        plotit    - bool flag to generate and show plots
+        chunkrows - 0 to compute the local variance of the whole band
+                    at once, or rows per chunk, see localVarianceStats().
+                    The chunks are float while the whole band is int with
+                    truncated window means, so the two can give a slightly
+                    different hr
+        detail    - optional dictionary, the mu, sigma and histogram of
+                    the local variance of each band are added to
+                    detail['lv'] keyed by band number
 
     Compute the optimal spectral resolution for the given windsize
     that was returned from getOptimalHs function. This is done by
@@ -256,6 +411,22 @@ def getOptimalHr( ds, useBands, winsize, verbose, plotit ):
         if band is None or not b in useBands:
             continue
 
+        if chunkrows > 0:
+            mu, sigma, counts, edges = localVarianceStats( band, winsize, chunkrows )
+            opt_hr.append( math.sqrt(mu) )
+            if not detail is None:
+                _addLVDetail( detail, b, winsize, mu, sigma, counts, edges )
+            if verbose:
+                print "Band {}: local variance mean: {}, stddev: {}".format(b1, mu, sigma)
+
+            if plotit:
+                plt.hist( edges[:-1], edges, weights=counts, normed=1 )
+                y = mlab.normpdf( edges, mu, sigma )
+                plt.plot(edges, y, 'r--', linewidth=2)
+                plt.title("Histogram of Band {} Local Variance".format(b1))
+                plt.show()
+            continue
+
         img = np.array( band.ReadAsArray().astype(np.int) )
 
         data = [] # the LV image
@@ -287,6 +458,9 @@ def getOptimalHr( ds, useBands, winsize, verbose, plotit ):
         (mu, sigma) = norm.fit(tmp.ravel())
 
         opt_hr.append( math.sqrt(mu) )
+        if not detail is None:
+            counts, edges = np.histogram( tmp.ravel(), 64 )
+            _addLVDetail( detail, b, winsize, mu, sigma, counts, edges )
 
         if plotit:
             bits_per_pixel = 8
@@ -308,14 +482,18 @@ def getOptimalHr( ds, useBands, winsize, verbose, plotit ):
 
 
 
-def getOptimalParameters( boxy, infile, useBands, verbose, plotit ):
+def getOptimalParameters( boxy, infile, useBands, verbose, plotit, chunkrows=None, detail=None ):
     '''
-    getOptimalParameters( boxy, infile, useBands, verbose, plotit )
-        boxy     - bool flag if segments are boxy (square or rectangle)
-        infile   - name of input file to evaluate
-        useBands - list of bands to consider
-        verbose  - bool flag to print messages
-        plotit   - bool flag t0 generate and display plots
+    getOptimalParameters( boxy, infile, useBands, verbose, plotit, chunkrows=None, detail=None )
+        boxy      - bool flag if segments are boxy (square or rectangle)
+        infile    - name of input file to evaluate
+        useBands  - list of bands to consider
+        verbose   - bool flag to print messages
+        plotit    - bool flag t0 generate and display plots
+        chunkrows - rows per chunk of the local variance, see getOptimalHr(),
+                    default: config optimal.chunkrows
+        detail    - optional dictionary to add the semivariogram curves and
+                    local variance summaries to, see getOptimalFromDetail()
 
     returns a dictionary of results with keys for:
         hs_min, hs_max, hs_avg - spatial resolution
@@ -329,38 +507,299 @@ def getOptimalParameters( boxy, infile, useBands, verbose, plotit ):
         import matplotlib.pyplot as plt
         import matplotlib.mlab as mlab
 
+    if chunkrows is None:
+        chunkrows = CONFIG.get('optimal.chunkrows', 0)
+
     ds = gdal.Open( infile )
 
+    if not detail is None:
+        detail['drange'] = list(OPTIMAL_DRANGE)
+        detail['chunkrows'] = chunkrows
+
+    hs = getOptimalHs( ds, useBands, OPTIMAL_DRANGE, verbose, plotit, detail )
+    hr = getOptimalHr( ds, useBands, hs[2], verbose, plotit, chunkrows, detail )
+
+    ds = None
+
+    return _optimalDict( boxy, hs, hr )
+
+
+def _optimalDict( boxy, hs, hr ):
+    hs_min, hs_max, hs_avg = hs
+    hr_min, hr_max, hr_avg = hr
+
     factor = 4
     if boxy: factor = 2
 
-    # range parameters for search [2, 100, 2] => 2 through 100 by 2
-    drange = [2, 100, 2]
-
-    hs_min, hs_max, hs_avg = getOptimalHs( ds, useBands, drange, verbose, plotit )
-    hr_min, hr_max, hr_avg = getOptimalHr( ds, useBands, hs_avg, verbose, plotit )
     M_min = int(round(hs_min**2/factor))
     M_max = int(round(hs_max**2/factor))
     M_avg = int(round(hs_avg**2/factor))
 
-    ds = None
-
     return { 'hs_min': hs_min, 'hs_max': hs_max, 'hs_avg': hs_avg,
              'hr_min': hr_min, 'hr_max': hr_max, 'hr_avg': hr_avg,
              'M_min':  M_min, 'M_max':  M_max, 'M_avg':  M_avg }
 
 
+def getOptimalFromDetail( boxy, detail ):
+    '''
+    getOptimalFromDetail( boxy, detail )
+
+    Return the same dictionary as getOptimalParameters() from the detail
+    it filled in, without reading any pixels.
+    '''
+    drange = detail['drange']
+    bands = sorted(detail['sv'].keys(), key=int)
+
+    opt_hs = [getOptimalSV( int(b) + 1, detail['sv'][b], drange, False, False )[2]
+              for b in bands]
+    opt_hr = [math.sqrt(detail['lv'][b]['mu']) for b in detail['lv']]
+
+    hs = [int(round(min(opt_hs))), int(round(max(opt_hs))),
+          int(round(sum(opt_hs)/len(opt_hs)))]
+    hr = [int(round(min(opt_hr))), int(round(max(opt_hr))),
+          int(round(sum(opt_hr)/len(opt_hr)))]
+
+    return _optimalDict( boxy, hs, hr )
+
+
+# approximate mode, see getApproxOptimalParameters()
+APPROX_PAIRS = 2048     # random pixel pairs per lag per batch
+APPROX_ROWS = 16        # random rows of local variance per batch
+APPROX_MIN_BATCHES = 4
+APPROX_MIN_HS_BATCHES = 16  # fewer batches give a too narrow bootstrap of hs
+APPROX_MAX_BATCHES = 64
+APPROX_TOL = 0.05       # relative 95% confidence half width to stop at
+APPROX_Z = 1.96
+APPROX_BOOTSTRAP = 200  # resamples of the batches for the confidence of hs
+
+
+def _approxSVBatch( data, lags, npairs, rng ):
+    # semivariogram curve like semivariogramCurve() from npairs random
+    # pixels paired with the pixel at each lag. The same pixels are used
+    # for every lag so the noise mostly cancels in the increase from one
+    # lag to the next that getOptimalSV() looks at, a pixel only counts
+    # at the lags semivariogramCurve() pairs it at
+    height, width = data.shape
+    i = rng.randint(0, height, npairs)[np.newaxis, :]
+    j = rng.randint(0, width, npairs)[np.newaxis, :]
+    il = i + lags[:, np.newaxis]
+    jl = j + lags[:, np.newaxis]
+    valid = ((il < height) & (jl < width)).astype(np.float64)
+    n = np.maximum(valid.sum(axis=1), 1.0)
+    a = data[i, j]
+    dw = data[np.minimum(il, height - 1), j] - a
+    dh = data[i, np.minimum(jl, width - 1)] - a
+
+    curve = np.empty((len(lags), 3), dtype=np.float64)
+    curve[:, 0] = (dw * dw * valid).sum(axis=1) / n / 2.0
+    curve[:, 1] = (dh * dh * valid).sum(axis=1) / n / 2.0
+    curve[:, 2] = (curve[:, 0] + curve[:, 1]) / 2.0
+    return curve
+
+
+def _approxLVBatch( data, winsize, nrows, rng ):
+    # mean local variance of each of nrows random rows of winsize boxes
+    height, width = data.shape
+    n = float(winsize * winsize)
+    means = []
+    for r in rng.randint(0, height - winsize + 1, nrows):
+        block = data[r:r+winsize, :].astype(np.float64)
+        s1 = np.concatenate([[0.0], np.cumsum(block.sum(axis=0))])
+        s2 = np.concatenate([[0.0], np.cumsum((block * block).sum(axis=0))])
+        b1 = s1[winsize:] - s1[:-winsize]
+        b2 = s2[winsize:] - s2[:-winsize]
+        means.append( np.maximum((b2 - b1 * b1 / n) / n, 0.0).mean() )
+    return means
+
+
+def _bootstrapCI( curves, hs, drange, rng ):
+    # 95% confidence half width of hs, the optimal average lag of the
+    # mean of the batch curves, from the hs of APPROX_BOOTSTRAP resamples
+    # of the batches with replacement
+    nb = len(curves)
+    boot = []
+    for k in range(APPROX_BOOTSTRAP):
+        pick = rng.randint(0, nb, nb)
+        h = getOptimalSV( 0, curves[pick].mean(axis=0), drange, False, False )[2]
+        if not h is None:
+            boot.append( h )
+    if len(boot) == 0:
+        return 0.0
+    lo, hi = np.percentile( boot, [2.5, 97.5] )
+    return max(hs - lo, hi - hs, 0.0)
+
+
+def approxOptimalHs( data, drange, tol, rng ):
+    '''
+    approxOptimalHs( data, drange, tol, rng )
+
+    Return (hs, ci, curve, npairs) for one band from batches of random
+    pixel pairs, where hs is the optimal average lag of getOptimalSV()
+    on the mean curve of the batches and ci is the 95% confidence half
+    width of that hs from a bootstrap of the batches. Stops when hs did
+    not change over the last 3 batches and ci is within tol of hs or one
+    lag step, after at least APPROX_MIN_HS_BATCHES batches.
+    '''
+    lags = np.arange(drange[0], drange[1], drange[2])
+    lags = lags[lags < min(data.shape)]
+
+    curves = []
+    hist = []
+    ci = None
+    while len(curves) < APPROX_MAX_BATCHES:
+        curves.append( _approxSVBatch( data, lags, APPROX_PAIRS, rng ) )
+        total = np.array(curves)
+        hist.append( getOptimalSV( 0, total.mean(axis=0), drange, False, False )[2] )
+        ci = None
+        if len(curves) >= APPROX_MIN_HS_BATCHES and len(set(hist[-3:])) == 1:
+            ci = _bootstrapCI( total, hist[-1], drange, rng )
+            if ci <= max(tol * hist[-1], drange[2]):
+                break
+
+    if ci is None:
+        ci = _bootstrapCI( total, hist[-1], drange, rng )
+
+    return (hist[-1], ci, total.mean(axis=0), len(curves) * APPROX_PAIRS * len(lags))
+
+
+def approxOptimalHr( data, winsize, tol, rng ):
+    '''
+    approxOptimalHr( data, winsize, tol, rng )
+
+    Return (hr, ci, mu) for one band where mu is the mean local variance
+    of batches of random rows of winsize boxes, hr = sqrt(mu) and ci is
+    its 95% confidence half width from the spread of the row means.
+    The boxes do not cross the edges of the image. Stops when ci is
+    within tol of hr.
+    '''
+    winsize = max(1, min(winsize, min(data.shape)))
+    means = []
+    while len(means) < APPROX_MAX_BATCHES * APPROX_ROWS:
+        means.extend( _approxLVBatch( data, winsize, APPROX_ROWS, rng ) )
+        mu = float(np.mean(means))
+        hr = math.sqrt(mu)
+        se = np.std(means) / math.sqrt(len(means))
+        ci = APPROX_Z * se / (2.0 * hr) if hr > 0.0 else 0.0
+        if len(means) >= APPROX_MIN_BATCHES * APPROX_ROWS and ci <= tol * hr:
+            break
+
+    return (hr, ci, mu)
+
+
+def getApproxOptimalParameters( boxy, infile, useBands, verbose, tol=APPROX_TOL, seed=None ):
+    '''
+    getApproxOptimalParameters( boxy, infile, useBands, verbose, tol=APPROX_TOL, seed=None )
+        boxy     - bool flag if segments are boxy (square or rectangle)
+        infile   - name of input file to evaluate
+        useBands - list of bands to consider
+        verbose  - bool flag to print messages
+        tol      - relative confidence half width to stop sampling at
+        seed     - seed of the random samples, for repeatable results
+
+    Fast approximate version of getOptimalParameters() for interactive
+    tuning. Each band is read once and the semivariogram and the local
+    variance are estimated from random pixel pairs and random rows of
+    boxes, see approxOptimalHs() and approxOptimalHr(), instead of every
+    pixel. Returns the same dictionary plus 'ci' with the 95% confidence
+    half width of each hs and hr value.
+    '''
+    t0 = time.time()
+    rng = np.random.RandomState( seed )
+    ds = gdal.Open( infile )
+    drange = OPTIMAL_DRANGE
+
+    data = {}
+    hs = {}
+    for b in range(ds.RasterCount):
+        band = ds.GetRasterBand( b + 1 )
+        if band is None or not b in useBands:
+            continue
+        data[b] = band.ReadAsArray().astype(np.float32)
+        hs[b] = approxOptimalHs( data[b], drange, tol, rng )
+    ds = None
+
+    opt_hs = [hs[b][0] for b in sorted(hs)]
+    hs_avg = int(round(sum(opt_hs)/len(opt_hs)))
+
+    hr = {}
+    for b in sorted(data):
+        hr[b] = approxOptimalHr( data[b], hs_avg, tol, rng )
+        if verbose:
+            print "Band {}: hs: {} +/- {:.1f} ({} pairs), hr: {:.1f} +/- {:.2f}".format(
+                b + 1, hs[b][0], hs[b][1], hs[b][3], hr[b][0], hr[b][1])
+    opt_hr = [hr[b][0] for b in sorted(hr)]
+
+    opt = _optimalDict( boxy,
+        [int(round(min(opt_hs))), int(round(max(opt_hs))), hs_avg],
+        [int(round(min(opt_hr))), int(round(max(opt_hr))),
+         int(round(sum(opt_hr)/len(opt_hr)))] )
+
+    # the min and max come from a single band, the avg of independent bands
+    ci = {}
+    for key, est in (('hs', hs), ('hr', hr)):
+        bands = sorted(est)
+        vals = [est[b][0] for b in bands]
+        ci[key + '_min'] = est[bands[int(np.argmin(vals))]][1]
+        ci[key + '_max'] = est[bands[int(np.argmax(vals))]][1]
+        ci[key + '_avg'] = math.sqrt(sum([est[b][1]**2 for b in bands])) / len(bands)
+    opt['ci'] = ci
+
+    if verbose:
+        print "Approximate optimal parameters in {:.2f} sec".format(time.time() - t0)
+
+    return opt
+
+
+def _test():
+    # the approximate hs of smoothed noise images with its confidence
+    # against the exact hs of semivariogramCurve()
+    drange = OPTIMAL_DRANGE
+    size = 768
+    fy = np.fft.fftfreq(size)[:, np.newaxis]
+    fx = np.fft.fftfreq(size)[np.newaxis, :]
+    err = False
+    for sigma in (3.0, 8.0):
+        rng = np.random.RandomState( 1 )
+        g = np.exp(-2.0 * (math.pi * sigma)**2 * (fx*fx + fy*fy))
+        img = np.real(np.fft.ifft2(np.fft.fft2(rng.normal(size=(size, size))) * g))
+        img = np.clip((img - img.mean()) / img.std() * 30.0 + 120.0, 0, 255).astype(np.float32)
+
+        ds = gdal.GetDriverByName('MEM').Create( '', size, size, 1, gdal.GDT_Float32 )
+        ds.GetRasterBand(1).WriteArray( img )
+        exact = getOptimalSV( 1, semivariogramCurve( ds.GetRasterBand(1), range(*drange) ),
+                              drange, False, False )[2]
+        ds = None
+
+        for seed in range(3):
+            hs, ci, curve, npairs = approxOptimalHs( img, drange, APPROX_TOL,
+                                                     np.random.RandomState( seed ) )
+            print 'sigma %.0f seed %d: hs %d +/- %.1f, exact %d' % (sigma, seed, hs, ci, exact)
+            if abs(hs - exact) > ci:
+                print 'ERROR: the exact hs is outside the confidence interval!'
+                err = True
+
+    if err:
+        print 'Unit tests generated errors!'
+    else:
+        print 'Unit tests passed!'
+
+
 def Usage():
     print """
 Usage: optimalparameters.py options"
 where options:
     [-h|--help]
+    [-t|--test]            - check the quick hs against the exact one
     [-f|--file infile]     - optional file to evaluate
     [-i|--isboxy=1|0]      - are objects square|rectangle or not, default: 1
                              1 - objects are squares or rectangles
                              0 - objects are not squares or rectangles
     [-b|--bands 0,1,2,4]   - which bands to use, zero based numbers
                              default: 0,1,2,4  (R,G,B,IR)
+    [-c|--chunk rows]      - compute the local variance in chunks of rows
+                             to bound the memory, default: whole band
+    [-q|--quick]           - fast approximate parameters from random pixel
+                             samples with confidence intervals
     [-p|--plots]           - display graph plots of data
     [-v|--verbose]         - print debug info
 """
@@ -376,9 +815,11 @@ def Main( argv ):
     useBands = [0,1,2,4]
     infile = None
     area = None
+    chunkrows = None
+    quick = False
 
     try:
-        opts, args = getopt.getopt(argv, "hf:i:b:pv", ['help', 'file', 'isboxy', 'bands', 'plots', 'verbose'])
+        opts, args = getopt.getopt(argv, "htf:i:b:c:qpv", ['help', 'test', 'file', 'isboxy', 'bands', 'chunk', 'quick', 'plots', 'verbose'])
     except:
         Usage()
 
@@ -388,12 +829,19 @@ def Main( argv ):
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             Usage()
+        elif opt in ('-t', '--test'):
+            _test()
+            return
         elif opt in ('-f', '--file'):
             infile = arg
         elif opt in ('-i', '--isboxy'):
             boxy = arg != '0'
         elif opt in ('-b', '--bands'):
             bands = [int(i) for i in arg.split(',')]
+        elif opt in ('-c', '--chunk'):
+            chunkrows = int(arg)
+        elif opt in ('-q', '--quick'):
+            quick = True
         elif opt in ('-p', '--plot', '--plots'):
             plotit = True
         elif opt in ('-v', '--verbose'):
@@ -403,7 +851,10 @@ def Main( argv ):
         print "\nERROR: file is required"
         Usage()
 
-    opt = getOptimalParameters( boxy, infile, useBands, verbose, plotit )
+    if quick:
+        opt = getApproxOptimalParameters( boxy, infile, useBands, verbose )
+    else:
+        opt = getOptimalParameters( boxy, infile, useBands, verbose, plotit, chunkrows )
 
     print "   Optimal Parameters    "
     print "    |  Hs  |  Hr  |   M  "
@@ -412,6 +863,10 @@ def Main( argv ):
     print "max |  {0:2d}  |  {1:2d}  | {2:4d} ".format(opt['hs_max'], opt['hr_max'], opt['M_max'])
     print "avg |  {0:2d}  |  {1:2d}  | {2:4d} ".format(opt['hs_avg'], opt['hr_avg'], opt['M_avg'])
     print "----+------+------+------"
+    if 'ci' in opt:
+        ci = opt['ci']
+        print "95% confidence: hs +/- {:.1f}/{:.1f}/{:.1f}, hr +/- {:.2f}/{:.2f}/{:.2f} (min/max/avg)".format(
+            ci['hs_min'], ci['hs_max'], ci['hs_avg'], ci['hr_min'], ci['hr_max'], ci['hr_avg'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,335 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import math
+import time
+import json
+from multiprocessing import Pool
+from osgeo import gdal
+import numpy as np
+
+from utils import getNumCpus, getDatabase
+from optimalparameters import getOptimalParameters, getApproxOptimalParameters
+from optimalcache import getCachedOptimal, saveCachedOptimal, createOptimalCacheTable
+from tiledsegmentation import tileHasData, getCoverage
+from config import *
+
+'''
+Estimate the optimal segmentation parameters from many windows spread
+over an area instead of a single window at its center. The image is
+split into a grid of strata with about the same number of pixels and a
+window is taken from the center of each stratum that has data. The
+windows are read straight from the area vrt, each one through a small
+vrt in /vsimem, and evaluated in a process pool. Windows of a naip year
+are looked up in and saved to the optimal parameter cache, see
+optimalcache.py, unless optimal.cache is False in the config.
+'''
+
+# keys of the dictionary returned by getOptimalParameters()
+OPTIMAL_KEYS = ['hs_min', 'hs_max', 'hs_avg', 'hr_min', 'hr_max', 'hr_avg',
+                'M_min', 'M_max', 'M_avg']
+
+# scale of the MAD to the standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+
+
+def getSampleWindows( width, height, nwin, size ):
+    '''
+    getSampleWindows( width, height, nwin, size )
+
+    Return a list of about nwin windows of size x size pixels, one at the
+    center of each cell of a grid of strata over the image. A single
+    window is at the center of the image.
+    '''
+    size = min(size, width, height)
+    nx = max(1, int(round(math.sqrt(nwin * float(width) / height))))
+    ny = max(1, int(math.ceil(nwin / float(nx))))
+
+    windows = []
+    for j in range(ny):
+        for i in range(nx):
+            cx = int((i + 0.5) * width / nx)
+            cy = int((j + 0.5) * height / ny)
+            xoff = min(max(0, cx - size/2), width - size)
+            yoff = min(max(0, cy - size/2), height - size)
+            windows.append({ 'n': len(windows), 'xoff': xoff, 'yoff': yoff,
+                             'xsize': size, 'ysize': size })
+    return windows
+
+
+def getWindowCenter( win, gt ):
+    '''Return [x, y] of the center of the window in map units.'''
+    px = win['xoff'] + win['xsize'] / 2.0
+    py = win['yoff'] + win['ysize'] / 2.0
+    return [gt[0] + px*gt[1] + py*gt[2], gt[3] + px*gt[4] + py*gt[5]]
+
+
+def getWindowBounds( win, gt ):
+    '''Return the window as [xmin, ymin, xmax, ymax] in map units.'''
+    xa = gt[0] + win['xoff']*gt[1]
+    xb = gt[0] + (win['xoff'] + win['xsize'])*gt[1]
+    ya = gt[3] + win['yoff']*gt[5]
+    yb = gt[3] + (win['yoff'] + win['ysize'])*gt[5]
+    return [min(xa, xb), min(ya, yb), max(xa, xb), max(ya, yb)]
+
+
+def optimalWindow( job ):
+    '''
+    optimalWindow( job )
+        job - (fin, win, boxy, bands, chunkrows, year, approx)
+
+    Pool worker that computes the optimal parameters of a window of fin.
+    The window is a vrt in /vsimem so only its pixels are read from fin.
+    If year is not None the window is looked up in the cache by its
+    'bounds' first and saved to it after. With approx the parameters are
+    estimated with getApproxOptimalParameters() and are not cached.
+    Returns (win, optimal parameters or None if it failed, seconds),
+    win['cached'] is True if the parameters came from the cache.
+    '''
+    fin, win, boxy, bands, chunkrows, year, approx = job
+    t0 = time.time()
+
+    if chunkrows is None:
+        chunkrows = CONFIG.get('optimal.chunkrows', 0)
+    usecache = not year is None and not approx and CONFIG.get('optimal.cache', True)
+
+    # a cache error only costs the time to compute the window
+    if usecache:
+        try:
+            conn, cur = getDatabase()
+            cached = getCachedOptimal( cur, year, win['bounds'], bands, boxy, chunkrows )
+            conn.close()
+        except Exception, e:
+            print "WARNING: window {} cache lookup failed: {}".format(win['n'], str(e))
+            cached = None
+        if not cached is None:
+            win['cached'] = True
+            return (win, cached[0], time.time() - t0)
+
+    fwin = '/vsimem/optimal-{}-w{}.vrt'.format(os.getpid(), win['n'])
+    detail = {}
+    try:
+        gdal.Translate( fwin, fin, format='VRT',
+                        srcWin=[win['xoff'], win['yoff'], win['xsize'], win['ysize']] )
+        if approx:
+            opt = getApproxOptimalParameters( boxy, fwin, bands, False )
+        else:
+            opt = getOptimalParameters( boxy, fwin, bands, False, False, chunkrows, detail )
+    except Exception, e:
+        print "ERROR: window {} failed: {}".format(win['n'], str(e))
+        opt = None
+
+    for f in (fwin, fwin + '.aux.xml'):
+        gdal.Unlink( f )
+
+    secs = time.time() - t0
+    if usecache and not opt is None:
+        try:
+            conn, cur = getDatabase()
+            saveCachedOptimal( cur, year, win['bounds'], bands, boxy, chunkrows, opt, detail, secs )
+            conn.close()
+        except Exception, e:
+            print "WARNING: window {} cache save failed: {}".format(win['n'], str(e))
+
+    return (win, opt, secs)
+
+
+def aggregateParameters( results ):
+    '''
+    aggregateParameters( results )
+
+    Return a dictionary with the 'median' and 'mad' (median absolute
+    deviation scaled to a standard deviation) of each optimal parameter
+    over the windows of results, and 'outliers', the window numbers more
+    than 3 MADs from the median of hs_avg or hr_avg.
+    '''
+    opts = [r[1] for r in results if not r[1] is None]
+    agg = { 'n': len(opts), 'median': {}, 'mad': {}, 'outliers': [] }
+    if len(opts) == 0:
+        return agg
+
+    for k in OPTIMAL_KEYS:
+        v = np.array([o[k] for o in opts], dtype=np.float64)
+        med = float(np.median(v))
+        agg['median'][k] = med
+        agg['mad'][k] = MAD_SCALE * float(np.median(np.abs(v - med)))
+
+    for win, opt, secs in results:
+        if opt is None:
+            continue
+        for k in ('hs_avg', 'hr_avg'):
+            if abs(opt[k] - agg['median'][k]) > 3.0 * agg['mad'][k] > 0.0:
+                agg['outliers'].append( win['n'] )
+                break
+
+    return agg
+
+
+def selectParameters( opt, select ):
+    '''Return (spatialr, ranger, minsize) of opt for select min|max|avg.'''
+    return ( int(round(opt['hs_' + select])),
+             float(opt['hr_' + select]),
+             int(round(opt['M_' + select])) )
+
+
+def sampleOptimalParameters( fin, nwin, size, boxy, bands, nproc, chunkrows=None, year=None,
+                             approx=False ):
+    '''
+    sampleOptimalParameters( fin, nwin, size, boxy, bands, nproc, chunkrows=None, year=None,
+                             approx=False )
+        fin       - image or area vrt, see createVrtForAOI()
+        nwin      - number of windows to sample
+        size      - pixel size of the windows
+        boxy      - bool flag if segments are boxy (square or rectangle)
+        bands     - list of bands to consider
+        nproc     - number of windows to evaluate at the same time, 0=all cpus
+        chunkrows - rows per chunk of the local variance, see getOptimalHr()
+        year      - naip year of fin to cache the windows under, or None
+        approx    - use the fast approximate estimates, see optimalWindow()
+
+    Run getOptimalParameters() over about nwin windows of fin, see
+    getSampleWindows(), skipping the windows without data. Returns
+    (results, aggregate) where results is a list of (window, optimal
+    parameters, seconds) sorted by window number, each window also has
+    its center 'x', 'y' in map units, and aggregate is from
+    aggregateParameters().
+    '''
+    ds = gdal.Open( fin )
+    gt = ds.GetGeoTransform()
+    coverage = getCoverage( ds )
+    windows = [w for w in getSampleWindows( ds.RasterXSize, ds.RasterYSize, nwin, size )
+               if tileHasData( ds, w, coverage )]
+    ds = None
+
+    if len(windows) == 0:
+        print "ERROR: no windows with data to sample!"
+        return ([], aggregateParameters([]))
+
+    for w in windows:
+        w['x'], w['y'] = getWindowCenter( w, gt )
+        w['bounds'] = getWindowBounds( w, gt )
+
+    if nproc == 0:
+        nproc = getNumCpus()
+    nproc = min(nproc, len(windows))
+
+    print "Sampling optimal parameters in {} windows of {} pixels with {} processes ...".format(
+        len(windows), windows[0]['xsize'], nproc)
+
+    # create the cache table here once, the workers racing to create it
+    # can fail on the first run
+    if not year is None and not approx and CONFIG.get('optimal.cache', True):
+        conn, cur = getDatabase()
+        createOptimalCacheTable( cur )
+        conn.close()
+
+    jobs = [(fin, w, boxy, bands, chunkrows, year, approx) for w in windows]
+    results = []
+    if nproc == 1:
+        for job in jobs:
+            results.append( optimalWindow( job ) )
+    else:
+        pool = Pool( nproc )
+        for r in pool.imap_unordered( optimalWindow, jobs ):
+            results.append( r )
+            print "Window {} done ({} of {})".format(r[0]['n'], len(results), len(jobs))
+        pool.close()
+        pool.join()
+
+    results.sort(key=lambda r: r[0]['n'])
+
+    return (results, aggregateParameters( results ))
+
+
+def printSampleResults( results, agg ):
+    print "    Optimal Parameters by Window"
+    print " win |      x      |      y      |  Hs  |  Hr  |   M  |  sec "
+    print "-----+-------------+-------------+------+------+------+------"
+    for win, opt, secs in results:
+        if opt is None:
+            print " {0:3d} | {1:11.5f} | {2:11.5f} |    failed          | {3:4.0f} ".format(
+                win['n'], win['x'], win['y'], secs)
+            continue
+        print " {0:3d} | {1:11.5f} | {2:11.5f} |  {3:2d}  |  {4:2d}  | {5:4d} | {6:4.0f} {7}".format(
+            win['n'], win['x'], win['y'], opt['hs_avg'], opt['hr_avg'], opt['M_avg'], secs,
+            '*' if win['n'] in agg['outliers'] else '')
+    print "-----+-------------+-------------+------+------+------+------"
+    if len(agg['outliers']) > 0:
+        print " * outlier, more than 3 MADs from the median"
+    for win, opt, secs in results:
+        if not opt is None and 'ci' in opt:
+            print " {0:3d} | 95% confidence: hs +/- {1:.1f}, hr +/- {2:.2f}".format(
+                win['n'], opt['ci']['hs_avg'], opt['ci']['hr_avg'])
+    ncached = len([r for r in results if r[0].get('cached', False)])
+    if ncached > 0:
+        print " {} of {} windows came from the cache".format(ncached, len(results))
+
+    if agg['n'] == 0:
+        return
+
+    med = agg['median']
+    mad = agg['mad']
+    print
+    print "   Median (MAD) over {} windows".format(agg['n'])
+    print "    |      Hs      |      Hr      |       M      "
+    print "----+--------------+--------------+--------------"
+    for s in ('min', 'max', 'avg'):
+        print "{0} | {1:5.1f} ({2:4.1f}) | {3:5.1f} ({4:4.1f}) | {5:5.0f} ({6:4.0f}) ".format(s,
+            med['hs_'+s], mad['hs_'+s], med['hr_'+s], mad['hr_'+s], med['M_'+s], mad['M_'+s])
+    print "----+--------------+--------------+--------------"
+
+
+def writeParameterGrid( fgrid, fin, results, agg ):
+    '''
+    writeParameterGrid( fgrid, fin, results, agg )
+
+    Write the optimal parameters of each window with its center in map
+    units and the aggregate to the json file fgrid, see loadParameterGrid().
+    '''
+    ds = gdal.Open( fin )
+    srs = ds.GetProjection()
+    ds = None
+
+    grid = { 'source': fin, 'srs': srs, 'aggregate': agg, 'windows': [] }
+    for win, opt, secs in results:
+        if opt is None or win['n'] in agg['outliers']:
+            continue
+        w = dict(win)
+        w.update(opt)
+        grid['windows'].append( w )
+
+    fh = open( fgrid, 'wb' )
+    json.dump( grid, fh, indent=2, sort_keys=True )
+    fh.close()
+
+
+def loadParameterGrid( fgrid ):
+    '''Return the parameter grid written by writeParameterGrid().'''
+    fh = open( fgrid, 'rb' )
+    grid = json.load( fh )
+    fh.close()
+    if len(grid.get('windows', [])) == 0:
+        raise RuntimeError("parameter grid {} has no windows!".format(fgrid))
+    return grid
+
+
+def gridParameters( grid, x, y, select ):
+    '''
+    gridParameters( grid, x, y, select )
+
+    Return (spatialr, ranger, minsize) of the window of grid nearest to
+    the point x, y in map units for select min|max|avg.
+    '''
+    win = min(grid['windows'], key=lambda w: (w['x'] - x)**2 + (w['y'] - y)**2)
+    return selectParameters( win, select )
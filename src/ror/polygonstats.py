@@ -11,11 +11,35 @@
 --------------------------------------------------------------------
 '''
 
+import os
+import sys
 import math
+import numpy as np
+from multiprocessing import Pool, cpu_count
 from osgeo import ogr, osr
-from minboundingcircle import getCircle
+from minboundingcircle import getCircle, getCircles
 
-class PolygonStats:
+# names of the metrics in the order of getAllStatsList()
+STATS_FIELDS = ['area', 'perim', 'para', 'compact', 'compact2', 'smooth',
+                'shape', 'frac', 'circle']
+
+# record type of the arrays returned by getBatchStats()
+STATS_DTYPE = np.dtype([(f, np.float64) for f in STATS_FIELDS])
+
+# marks a lazy value that was not computed yet, None is a valid result
+_NOT_COMPUTED = object()
+
+# metrics that need the minimum bounding circle
+CIRCLE_FIELDS = ('compact', 'smooth', 'circle')
+
+# smallest FID range given to a worker and features per write transaction
+STATS_MIN_RANGE = 1000
+STATS_BATCH = 10000
+
+# radius of the sphere of global mercator (EPSG:3857) in meters
+MERCATOR_RADIUS = 6378137.0
+
+class PolygonStats(object):
     """
     Class PolygonStats
 
@@ -27,15 +51,17 @@ class PolygonStats:
 
     from polygonstats import PolygonStats
     s = PolygonStats('POLYGON ((0 0,1 0,1 1,0 1,0 0))')
+
+    The area, perimeter, convex hull and minimum bounding circle are
+    computed the first time a metric needs them. Pass metrics, a list of
+    names from STATS_FIELDS, to only compute those, the other metrics
+    return None.
+
+    s = PolygonStats(geom, metrics=['area', 'compact2'])
     """
-    _geom = None
-    _area = None
-    _perim = None
-    _bbarea = None
-    _bbperim = None
-    _circle = None # [x, y, radius]
-
-    def __init__(self, geom_in):
+    __slots__ = ('_geom', '_metrics', '_area', '_perim', '_hull', '_circle')
+
+    def __init__(self, geom_in, metrics=None):
         if type(geom_in) is str:
             self._geom = ogr.CreateGeometryFromWkt(geom_in)
         elif type(geom_in) is ogr.Geometry:
@@ -46,23 +72,44 @@ class PolygonStats:
         if self._geom.GetGeometryType() != 3:
             raise RuntimeError("Geometry is not a POLYGON!")
 
-        # initialize attributes
-        self._area = self._geom.Area()
-        self._perim = ogr.ForceToMultiLineString(self._geom).Length()
-        xmin, xmax, ymin, ymax = self._geom.GetEnvelope()
-        dx = xmax - xmin
-        dy = ymax - ymin
-        self._bbperm = 2.0*(dx + dy)
-        self._bbarea = dx * dy
-        #self._circle = getCircle(self._geom.GetGeometryRef(0).GetPoints())
-        # we hit python recursion limits on big polygons, so
-        # changed this to use the convex hull of the polygon which
-        # will give the same result with far less points
-        # when computing the minimum bounding circle of the polygon
-        chull = self._geom.ConvexHull()
-        chullref = chull.GetGeometryRef(0)
-        chullpts = chullref.GetPoints()
-        self._circle = getCircle(chullpts)
+        if not metrics is None:
+            unknown = set(metrics) - set(STATS_FIELDS)
+            if len(unknown) > 0:
+                raise RuntimeError("Unknown metrics: {}!".format(', '.join(sorted(unknown))))
+            metrics = frozenset(metrics)
+        self._metrics = metrics
+
+        self._area = None
+        self._perim = None
+        self._hull = None
+        self._circle = _NOT_COMPUTED
+
+    def _wants(self, metric):
+        return self._metrics is None or metric in self._metrics
+
+    def _getArea(self):
+        if self._area is None:
+            self._area = self._geom.Area()
+        return self._area
+
+    def _getPerim(self):
+        if self._perim is None:
+            self._perim = ogr.ForceToMultiLineString(self._geom).Length()
+        return self._perim
+
+    def _getHull(self):
+        # the convex hull of the polygon gives the same minimum bounding
+        # circle with far less points
+        if self._hull is None:
+            chull = self._geom.ConvexHull()
+            self._hull = chull.GetGeometryRef(0).GetPoints()
+        return self._hull
+
+    def _getCircle(self):
+        # [x, y, radius] or None on failure
+        if self._circle is _NOT_COMPUTED:
+            self._circle = getCircle(self._getHull())
+        return self._circle
 
     def getPoints(self):
         """Return a list of points from a polygon geometry"""
@@ -73,13 +120,17 @@ class PolygonStats:
         """Return polygon area (FRAGSTATS P4 AREA)
            AREA > 0, without limit.
         """
-        return self._area
+        if not self._wants('area'):
+            return None
+        return self._getArea()
 
     def perim(self):
         """Return polygon perimeter (FRAGSTATS P5 PERIM)
            PERIM > 0, without limit.
         """
-        return self._perim
+        if not self._wants('perim'):
+            return None
+        return self._getPerim()
 
     def para(self):
         """Return polygon perimeter-area ratio (FRAGSTATS P7 PARA)
@@ -90,8 +141,10 @@ class PolygonStats:
         example, holding shape constant, an increase in patch size will
         cause a decrease in the perimeter-area ratio.
         """
-        if self._area > 0.0:
-            return self._perim / self._area
+        if not self._wants('para'):
+            return None
+        if self._getArea() > 0.0:
+            return self._getPerim() / self._getArea()
         else:
             return 0.0
 
@@ -100,10 +153,10 @@ class PolygonStats:
         to the area of the minimum circumscribed circle.
         0 <= COMPACT <= 1, COMPACT = 1 is maximum compactness, ie: a circle
         """
-        if self._circle is None:
+        if not self._wants('compact') or self._getCircle() is None:
             return None
         else:
-            return self._area / (2.0 * math.pi * self._circle[2])
+            return self._getArea() / (2.0 * math.pi * self._getCircle()[2])
 
     def compact2(self):
         """
@@ -114,17 +167,19 @@ class PolygonStats:
         0 <= COMPACT2 <= 1, COMPACT2 = 1 is maximum compactness, ie: a circle
         http://en.wikipedia.org/wiki/Compactness_measure_of_a_shape
         """
-        return 4.0 * math.pi * self._area / math.pow(self._perim, 2.0)
+        if not self._wants('compact2'):
+            return None
+        return 4.0 * math.pi * self._getArea() / math.pow(self._getPerim(), 2.0)
 
     def smooth(self):
         """Return polygon smoothness metric. A ratio of polygon perimeter
         to the perimeter of the minimum circumscribed circle.
         1 <= SMOOTH, without limit. Perimeter complexity increases with SMOOTH.
         """
-        if self._circle is None:
+        if not self._wants('smooth') or self._getCircle() is None:
             return None
         else:
-            return self._perim / (math.pi * math.pow(self._circle[2], 2.0))
+            return self._getPerim() / (math.pi * math.pow(self._getCircle()[2], 2.0))
 
     def shape(self):
         """Return polygon shape index (FRAGSTATS P2 SHAPE)
@@ -133,27 +188,31 @@ class PolygonStats:
         Based on Shape Index from FRAGSTATS ver 4.2 (pg. 104)
         http://www.umass.edu/landeco/research/fragstats/documents/fragstats.help.4.2.pdf
         """
-        return 0.25 * self._perim / math.sqrt(self._area)
+        if not self._wants('shape'):
+            return None
+        return 0.25 * self._getPerim() / math.sqrt(self._getArea())
 
 
     def frac(self):
         """Return polygon fractal dimension index (FRAGSTATS P9 FRAC)
         1 <= FRAC <= 2, shape complexity increases with FRAC.
         """
-        perim = self._perim / 4.0
-        if self._area <= 1 or perim < 1:
+        if not self._wants('frac'):
+            return None
+        perim = self._getPerim() / 4.0
+        if self._getArea() <= 1 or perim < 1:
             return 1.0
         else:
-            return 2.0 * math.log(perim) / math.log(self._area)
+            return 2.0 * math.log(perim) / math.log(self._getArea())
 
     def circle(self):
         """Return polygon circluarity ratio (FRAGSTATS P11 CIRCLE)
         0 <= CIRCLE < 1, and overall measure of shape elongation.
         """
-        if self._circle is None:
+        if not self._wants('circle') or self._getCircle() is None:
             return None
         else:
-            return 1.0 - self._area / (math.pi * math.pow(self._circle[2], 2))
+            return 1.0 - self._getArea() / (math.pi * math.pow(self._getCircle()[2], 2))
 
     def getAllStatsList(self):
         """
@@ -187,66 +246,365 @@ class PolygonStats:
                  'circle':   self.circle() }
 
 
-def addShapefileStats(shapefile):
-    '''Read a polygon shapefile, compute stats, and add them to the shapefile.'''
-    # open the shapefile
-    driver = ogr.GetDriverByName('ESRI Shapefile')
-    dataSource = driver.Open(shapefile, 1)
-    if dataSource is None:
-        print "ERROR: could not open '{}' as shapefile!".format(shapefile)
-        sys.exit(1)
+def getGeometryArrays(geoms):
+    """
+    (coords, rings, polys) = getGeometryArrays(geoms)
+
+    Flatten a list or iterator of OGR polygons into the arrays used by
+    getBatchStats().
+        coords - (n, 2) float64 array of the vertices of every ring
+        rings  - offsets into coords of each ring, plus the end
+        polys  - offsets into rings of each polygon, plus the end, the
+                 first ring of a polygon is its exterior ring
+    """
+    parts = []
+    rings = [0]
+    polys = [0]
+    for geom in geoms:
+        if geom.GetGeometryType() != 3:
+            raise RuntimeError("Geometry is not a POLYGON!")
+        for i in range(geom.GetGeometryCount()):
+            ring = geom.GetGeometryRef(i)
+            pts = np.array(ring.GetPoints() or [], dtype=np.float64).reshape(-1, ring.GetCoordinateDimension())
+            parts.append(pts[:, :2])
+            rings.append(rings[-1] + len(pts))
+        polys.append(len(rings) - 1)
+
+    if len(parts) == 0:
+        coords = np.zeros((0, 2), dtype=np.float64)
+    else:
+        coords = np.concatenate(parts)
+
+    return (coords, np.array(rings, dtype=np.int64), np.array(polys, dtype=np.int64))
+
+
+def _sumSegments(values, offsets):
+    # sum values[offsets[i]:offsets[i+1]] one value after the other from
+    # the first like the loops of OGR, 0.0 for empty ranges. np.sum and
+    # np.add.reduceat sum pairwise which differs in the last bits, so
+    # this loops over the position in the ranges, longest ranges first
+    counts = np.diff(offsets)
+    order = np.argsort(-counts, kind='mergesort')
+    starts = offsets[:-1][order]
+    negcounts = -counts[order]
+    acc = np.zeros(len(counts), dtype=np.float64)
+    for k in range(counts.max() if len(counts) > 0 else 0):
+        # the ranges with more than k values
+        n = np.searchsorted(negcounts, -k, side='left')
+        acc[:n] += values[starts[:n] + k]
+    sums = np.empty(len(counts), dtype=np.float64)
+    sums[order] = acc
+    return sums
+
+
+def getBatchStats(coords, rings, polys, metrics=None):
+    """
+    stats = getBatchStats(coords, rings, polys, metrics=None)
+
+    Compute the metrics of PolygonStats for many polygons at once, see
+    getGeometryArrays() for the arrays. Returns a structured array of
+    STATS_DTYPE with a record per polygon. With metrics, a list of names
+    from STATS_FIELDS, the other metrics are left NaN and the bounding
+    circles are skipped unless a metric needs them. The metrics are computed with
+    the same formulas and in the same order of operations as OGR and
+    PolygonStats so they match getAllStatsList(), except a metric that
+    would be None there is NaN here.
+
+    The minimum bounding circles of the exterior rings are computed
+    with getCircles(), they can differ from the ones of the convex hulls
+    used by PolygonStats in the last bits.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    rings = np.asarray(rings, dtype=np.int64)
+    polys = np.asarray(polys, dtype=np.int64)
+    npoly = len(polys) - 1
+    x = coords[:, 0]
+    y = coords[:, 1]
+
+    # ring area like OGR, sum of x[i] * (y[i+1] - y[i-1]) wrapping
+    # around at the ends of the ring
+    idx = np.arange(len(coords))
+    counts = np.diff(rings)
+    rstart = np.repeat(rings[:-1], counts)
+    rend = np.repeat(rings[1:], counts)
+    nxt = np.where(idx + 1 == rend, rstart, idx + 1)
+    prv = np.where(idx == rstart, rend - 1, idx - 1)
+    ringarea = 0.5 * np.abs(_sumSegments(x * (y[nxt] - y[prv]), rings))
+
+    # the holes are subtracted from the exterior ring
+    sign = -np.ones(len(rings) - 1, dtype=np.float64)
+    sign[polys[:-1][polys[:-1] < len(rings) - 1]] = 1.0
+    area = _sumSegments(sign * ringarea, polys)
+
+    # ring length, drop the segments that join one ring to the next
+    dx = x[1:] - x[:-1]
+    dy = y[1:] - y[:-1]
+    seglen = np.sqrt(dx * dx + dy * dy)[idx[1:] != rstart[1:]]
+    segoffs = np.concatenate([[0], np.cumsum(np.maximum(counts - 1, 0))])
+    ringlen = _sumSegments(seglen, segoffs)
+    perim = _sumSegments(ringlen, polys)
+
+    radius = np.empty(npoly, dtype=np.float64)
+    radius.fill(np.nan)
+    if metrics is None or len(set(metrics) & set(CIRCLE_FIELDS)) > 0:
+        # the points of the exterior ring of each polygon
+        hasext = polys[1:] > polys[:-1]
+        isext = np.zeros(len(rings) - 1, dtype=bool)
+        isext[polys[:-1][hasext]] = True
+        extcounts = counts[polys[:-1][hasext]]
+        ringid = np.repeat(np.arange(len(rings) - 1), counts)
+        extoffs = np.concatenate([[0], np.cumsum(extcounts)])
+        radius[hasext] = getCircles(extoffs, coords[isext[ringid]])[:, 2]
+
+    stats = np.empty(npoly, dtype=STATS_DTYPE)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats['area'] = area
+        stats['perim'] = perim
+        stats['para'] = np.where(area > 0.0, perim / area, 0.0)
+        stats['compact'] = area / (2.0 * math.pi * radius)
+        stats['compact2'] = 4.0 * math.pi * area / perim ** 2.0
+        stats['smooth'] = perim / (math.pi * radius ** 2.0)
+        stats['shape'] = 0.25 * perim / np.sqrt(area)
+        perim4 = perim / 4.0
+        stats['frac'] = np.where((area <= 1) | (perim4 < 1), 1.0,
+                                 2.0 * np.log(perim4) / np.log(area))
+        stats['circle'] = 1.0 - area / (math.pi * radius ** 2)
+
+    if not metrics is None:
+        for name in STATS_FIELDS:
+            if not name in metrics:
+                stats[name] = np.nan
+
+    return stats
+
+
+def _geometries(layer, start, end):
+    # yield the geometries while their feature is still alive
+    layer.SetNextByIndex(start)
+    for fid in range(start, end):
+        feature = layer.GetNextFeature()
+        yield feature.GetGeometryRef()
+
+
+def getMercatorSRS():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def toMercator(coords, srs_s):
+    """
+    coords = toMercator(coords, srs_s)
+
+    Reproject an (n, 2) array of coordinates in srs_s into global
+    mercator (EPSG:3857) in one call. Longitude and latitude on WGS84
+    use the closed form of the spherical mercator, anything else goes
+    through TransformPoints() on the whole array.
+    """
+    if len(coords) == 0:
+        return coords
+
+    if srs_s.IsGeographic() and srs_s.GetAttrValue('DATUM') == 'WGS_1984':
+        unit = srs_s.GetAngularUnits()
+        lon = coords[:, 0] * unit
+        lat = coords[:, 1] * unit
+        out = np.empty_like(coords)
+        out[:, 0] = MERCATOR_RADIUS * lon
+        out[:, 1] = MERCATOR_RADIUS * np.log(np.tan(math.pi / 4.0 + lat / 2.0))
+        return out
+
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs_s = srs_s.Clone()
+        srs_s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(srs_s, getMercatorSRS())
+    pts = transform.TransformPoints(coords.tolist())
+    return np.array(pts, dtype=np.float64)[:, :2]
+
+
+def _readStats(job):
+    """
+    (start, stats) = _readStats(job)
+        job - (shapefile, start, end, metrics)
 
+    Pool worker that computes the stats of the features with FIDs start
+    to end - 1 of the shapefile, with the coordinates reprojected into
+    global mercator (EPSG:3857) to get meters and meters**2.
+    """
+    shapefile, start, end, metrics = job
+    dataSource = ogr.Open(shapefile)
     layer = dataSource.GetLayer()
-    layer.CreateField(ogr.FieldDefn("area",     ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("perim",    ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("para",     ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("compact",  ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("compact2", ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("smooth",   ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("shape",    ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("frac",     ogr.OFTReal))
-    layer.CreateField(ogr.FieldDefn("circle",   ogr.OFTReal))
-
-    # reproject the geometry into global mercator (EPSG:3857)
-    # some units are in meters and meters**2 perimeter and areas
 
+    # we only need the geometry, this keeps OGR from reading the dbf
+    defn = layer.GetLayerDefn()
+    layer.SetIgnoredFields([defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())])
+
+    # reproject the whole range at once, not a geometry at a time
+    coords, rings, polys = getGeometryArrays(_geometries(layer, start, end))
+    coords = toMercator(coords, layer.GetSpatialRef())
+    stats = getBatchStats(coords, rings, polys, metrics)
+    dataSource = None
+
+    return (start, stats)
+
+
+def benchStats(shapefile, limit=100000):
+    """
+    benchStats(shapefile, limit=100000)
+
+    Time the stats of the first limit features of a shapefile with the
+    old feature at a time loop, clone, Transform() and PolygonStats,
+    against the batched reprojection and getBatchStats(), and report
+    the largest relative difference of each metric.
+    """
+    import time
+
+    dataSource = ogr.Open(shapefile)
+    layer = dataSource.GetLayer()
+    count = min(limit, layer.GetFeatureCount())
     srs_s = layer.GetSpatialRef()
-    srs_t = osr.SpatialReference()
-    srs_t.ImportFromEPSG(3857)
-    transform = osr.CoordinateTransformation(srs_s, srs_t)
-
-    for feature in layer:
-        # clone the geometry so we don't change the projection 
-        # of the source shape file data, only the data we use
-        # to compute the stats with
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs_s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(srs_s, getMercatorSRS())
+
+    t0 = time.time()
+    old = []
+    layer.SetNextByIndex(0)
+    for fid in range(count):
+        feature = layer.GetNextFeature()
         geom = feature.GetGeometryRef().Clone()
         geom.Transform(transform)
-        ps = PolygonStats( geom )
-        stats = ps.getAllStatsList()
-        if not stats[0] is None:
-            feature.SetField("area",     stats[0])
-        if not stats[1] is None:
-            feature.SetField("perim",    stats[1])
-        if not stats[2] is None:
-            feature.SetField("para",     stats[2])
-        if not stats[3] is None:
-            feature.SetField("compact",  stats[3])
-        if not stats[4] is None:
-            feature.SetField("compact2", stats[4])
-        if not stats[5] is None:
-            feature.SetField("smooth",   stats[5])
-        if not stats[6] is None:
-            feature.SetField("shape",    stats[6])
-        if not stats[7] is None:
-            feature.SetField("frac",     stats[7])
-        if not stats[8] is None:
-            feature.SetField("circle",   stats[8])
-        layer.SetFeature(feature)
+        old.append(PolygonStats(geom).getAllStatsList())
         feature = None
+    t1 = time.time()
+    print "Feature loop:       {:8.2f} sec, {:10.0f} features/sec".format(t1 - t0, count / max(t1 - t0, 0.001))
+
+    t0 = time.time()
+    stats = _readStats((shapefile, 0, count, None))[1]
+    t1 = time.time()
+    print "Batched reprojection: {:6.2f} sec, {:10.0f} features/sec".format(t1 - t0, count / max(t1 - t0, 0.001))
+
+    old = np.array([[np.nan if v is None else v for v in row] for row in old], dtype=np.float64)
+    for i, name in enumerate(STATS_FIELDS):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diff = np.abs(stats[name] - old[:, i]) / np.maximum(np.abs(old[:, i]), 1e-300)
+        print "    {:8s} max relative difference: {:.3g}".format(name, np.nanmax(diff) if count > 0 else 0.0)
 
     dataSource = None
 
 
+def addShapefileStats(shapefile, nproc=1, metrics=None):
+    """
+    addShapefileStats(shapefile, nproc=1, metrics=None)
+
+    Read a polygon shapefile, compute stats, and add them to the shapefile.
+    The features are split into FID ranges that nproc worker processes
+    compute the stats of, 0=all cpus. This process writes the stats into
+    the dbf as the ranges come back, STATS_BATCH features per transaction.
+    With metrics, a list of names from STATS_FIELDS, only those fields
+    are added.
+    """
+    # add the fields to the dbf, we never touch the geometry so we
+    # open the dbf on its own to keep SetFeature from rewriting it
+    fdbf = os.path.splitext(shapefile)[0] + '.dbf'
+    dataSource = ogr.Open(fdbf, 1)
+    if dataSource is None:
+        print "ERROR: could not open '{}' as shapefile!".format(shapefile)
+        sys.exit(1)
+
+    if metrics is None:
+        metrics = STATS_FIELDS
+    names = [name for name in STATS_FIELDS if name in metrics]
+
+    layer = dataSource.GetLayer()
+    for name in names:
+        layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+    count = layer.GetFeatureCount()
+
+    if nproc == 0:
+        nproc = cpu_count()
+    step = max(STATS_MIN_RANGE, int(math.ceil(count / (4.0 * nproc))))
+    jobs = [(shapefile, i, min(i + step, count), names) for i in range(0, count, step)]
+
+    if nproc > 1 and len(jobs) > 1:
+        pool = Pool(min(nproc, len(jobs)))
+        results = pool.imap_unordered(_readStats, jobs)
+    else:
+        pool = None
+        results = (_readStats(job) for job in jobs)
+
+    n = 0
+    for start, stats in results:
+        for i in range(len(stats)):
+            if n % STATS_BATCH == 0:
+                layer.StartTransaction()
+            feature = layer.GetFeature(start + i)
+            for name in names:
+                value = stats[name][i]
+                if not np.isnan(value):
+                    feature.SetField(name, float(value))
+            layer.SetFeature(feature)
+            feature = None
+            n += 1
+            if n % STATS_BATCH == 0:
+                layer.CommitTransaction()
+    if n % STATS_BATCH != 0:
+        layer.CommitTransaction()
+
+    if not pool is None:
+        pool.close()
+        pool.join()
+
+    dataSource = None
+
+
+
+def benchPolygonStats(n=100000, metrics=None):
+    """
+    benchPolygonStats(n=100000, metrics=None)
+
+    Time building PolygonStats for n random 32 sided polygons and getting
+    their stats with getAllStatsList(), and measure the memory they hold,
+    then scale both to a million polygons.
+    """
+    import time
+    import random
+    import resource
+
+    random.seed(1)
+    wkts = []
+    for i in range(n):
+        cx = random.uniform(0, 1000)
+        cy = random.uniform(0, 1000)
+        pts = []
+        for k in range(32):
+            a = 2.0 * math.pi * k / 32
+            r = random.uniform(5, 10)
+            pts.append('%f %f' % (cx + r * math.cos(a), cy + r * math.sin(a)))
+        pts.append(pts[0])
+        wkts.append('POLYGON ((%s))' % ','.join(pts))
+    geoms = [ogr.CreateGeometryFromWkt(w) for w in wkts]
+    wkts = None
+
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    objs = [PolygonStats(g, metrics) for g in geoms]
+    t1 = time.time()
+    for ps in objs:
+        ps.getAllStatsList()
+    t2 = time.time()
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    scale = 1.0e6 / n
+    print "PolygonStats for {} polygons, metrics: {}".format(n, ','.join(metrics or STATS_FIELDS))
+    print "    create:   {:8.2f} sec per million".format((t1 - t0) * scale)
+    print "    stats:    {:8.2f} sec per million".format((t2 - t1) * scale)
+    print "    instance: {:8d} bytes, {:.1f} MB per million".format(
+        sys.getsizeof(objs[0]), sys.getsizeof(objs[0]) * 1.0e6 / 1048576)
+    # stats add the cached hull and circle to the instances
+    print "    max rss growth: {:.1f} MB per million".format((rss1 - rss0) / 1024.0 * scale)
+
 
 def runTests():
     """Run unit tests."""
@@ -288,6 +646,35 @@ def runTests():
             'circle':   0.43411575789548307 }
     err = err or run_test('POLYGON ((0 0,3 0,3 3,0 3,0 0), (1 1,2 1,2 2,1 2,1 1))', test)
 
+    # the batch engine has to match PolygonStats bit for bit, only the
+    # bounding circles can differ in the last bits since the points come
+    # in another order
+    # the rings of more than 8 vertices catch a sum in another order
+    polys = ['POLYGON ((0 0,1 0,1 1,0 1,0 0))',
+             'POLYGON ((0 0,3 0,3 3,0 3,0 0), (1 1,2 1,2 2,1 2,1 1))',
+             'POLYGON ((500223.457 4410567.891,500265.486 4410605.948,500245.653 4410638.441,'
+             '500175.668 4410620.102,500163.086 4410636.530,500157.667 4410695.564,'
+             '500123.457 4410704.891,500092.172 4410684.649,500078.178 4410646.316,'
+             '500071.246 4410620.102,500011.047 4410632.791,499970.513 4410608.872,'
+             '500023.457 4410567.891,500050.471 4410548.334,500033.304 4410515.841,'
+             '500034.246 4410478.680,500051.786 4410443.752,500094.204 4410458.718,'
+             '500123.457 4410504.891,500149.785 4410469.633,500200.778 4410433.966,'
+             '500212.668 4410478.680,500203.824 4410521.491,500207.358 4410545.410,'
+             '500223.457 4410567.891), (500100 4410550,500140 4410550,500140 4410590,'
+             '500100 4410590,500100 4410550))']
+    stats = getBatchStats(*getGeometryArrays([ogr.CreateGeometryFromWkt(p) for p in polys]))
+    for i, poly in enumerate(polys):
+        expected = PolygonStats( poly ).getAllStatsList()
+        for k, v in zip(STATS_FIELDS, expected):
+            if k in CIRCLE_FIELDS:
+                bad = abs(stats[k][i] - v) > 1e-12 * max(1.0, abs(v))
+            else:
+                bad = stats[k][i] != v
+            if bad:
+                print 'Batch error for %s:' % (poly)
+                print '    %s: = %.17f, expected: %.17f' % (k, stats[k][i], v)
+                err = True
+
     if err:
         print 'Unit tests generated errors!'
     else:
@@ -300,7 +687,13 @@ Usage: polygonstats.py options
     options:
         [-h|--help]  - display help info
         [-t|--test]  - run unit tests
-        file.shp     - add polygon stats to shapfile
+        [-n|--nproc n] file.shp - add polygon stats to shapfile using
+                       n processes, 0=all cpus, default: 1
+        [-b|--bench] file.shp [limit] - time the stats of the first limit
+                       features, default 100000, with the feature loop
+                       and with the batched reprojection
+        [-B|--bench-class] [n] [metric,...] - time and memory of PolygonStats
+                       for n polygons, default 100000, scaled to a million
 '''
 
 
@@ -314,8 +707,22 @@ if __name__ == '__main__':
     elif len(sys.argv) == 2 and sys.argv[1] in ('-t', '--test'):
         runTests()
 
+    elif len(sys.argv) in (2, 3, 4) and sys.argv[1] in ('-B', '--bench-class'):
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        metrics = sys.argv[3].split(',') if len(sys.argv) > 3 else None
+        benchPolygonStats( n, metrics )
+
     elif len(sys.argv) == 2:
         addShapefileStats( sys.argv[1] )
+
+    elif len(sys.argv) == 4 and sys.argv[1] in ('-n', '--nproc'):
+        addShapefileStats( sys.argv[3], int(sys.argv[2]) )
+
+    elif len(sys.argv) in (3, 4) and sys.argv[1] in ('-b', '--bench'):
+        if len(sys.argv) == 4:
+            benchStats( sys.argv[2], int(sys.argv[3]) )
+        else:
+            benchStats( sys.argv[2] )
     else:
         Usage()
 
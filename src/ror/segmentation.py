@@ -19,17 +19,22 @@ import re
 import getopt
 from osgeo import gdal, ogr
 
-from utils import getDatabase, runCommand
+from utils import getDatabase, runCommand, getNumCpus
 from polygonstats import PolygonStats, addShapefileStats
 from optimalparameters import getOptimalParameters
-import otbApplication
+from lsms import runLSMS
+from tiledsegmentation import runTiledSegmentation
+from segsweep import parseSweepArg, sweepSegmentation
+from segmentloader import loadShapefileCopy
+from tuning import calibrate, recordStageTimes
+from segplan import planSegmentation, getAreaPixels, estimateStageBytes
+from optimalsample import sampleOptimalParameters, printSampleResults, \
+                          writeParameterGrid, selectParameters, optimalWindow, \
+                          aggregateParameters, getWindowCenter, getWindowBounds
+from optimalcache import getCachedWindows, createOptimalCacheTable
+from tmpalloc import getTmpdirs, allocateTmpdir
 from config import *
 
-# this probably will not work on Windows, except in the docker env.
-otbpath = os.environ.get('OTB_APPLICATION_PATH', None)
-if otbpath is None:
-    os.environ['OTB_APPLICATION_PATH']='/usr/lib/otb/applications/'
-
 
 def getDoqqsForArea( year, areaOfInterest ):
     verbose = CONFIG.get('verbose', False)
@@ -103,6 +108,12 @@ def getDoqqsForArea( year, areaOfInterest ):
 
 
 def createVrtForAOI( fvrt, year, area ):
+    # get a list of doqqs the intersect our area of interest
+    files = getDoqqsForArea( year, area )
+    createVrtForFiles( fvrt, files )
+
+
+def createVrtForFiles( fvrt, files ):
     verbose = CONFIG.get('verbose', False)
 
     # temp file to write doqqs into
@@ -111,9 +122,7 @@ def createVrtForAOI( fvrt, year, area ):
     # temp file for intermeadiate vrt
     fvrtvrt = fvrt + '.vrt'
 
-    # get a list of doqqs the intersect our area of interest
-    # and write them to a temp file
-    files = getDoqqsForArea( year, area )
+    # write the list of doqqs to a temp file
     fh = open( fvrtin, 'wb' )
     for f in files:
         fh.write( f + "\n" )
@@ -129,57 +138,25 @@ def createVrtForAOI( fvrt, year, area ):
     runCommand(cmd, verbose)
 
 
-def smoothing(fin, fout, foutpos, spatialr, ranger, rangeramp, thres, maxiter, ram):
-    app = otbApplication.Registry.CreateApplication('MeanShiftSmoothing')
-    app.SetParameterString('in', fin)
-    app.SetParameterString('fout', fout)
-    app.SetParameterString('foutpos', foutpos)
-    app.SetParameterInt('spatialr', spatialr)
-    app.SetParameterFloat('ranger', ranger)
-    app.SetParameterFloat('rangeramp', rangeramp)
-    app.SetParameterFloat('thres', thres)
-    app.SetParameterInt('maxiter', maxiter)
-    app.SetParameterInt('ram', ram)
-    app.SetParameterInt('modesearch', 0)
-    app.ExecuteAndWriteOutput()
-
-
-def segmentit(fin, finpos, fout, spatialr, ranger, minsize, tilesize, tmpdir):
-    debug = CONFIG.get('debug', False)
-
-    app = otbApplication.Registry.CreateApplication('LSMSSegmentation')
-    app.SetParameterString('in', fin)
-    app.SetParameterString('inpos', finpos)
-    app.SetParameterString('out', fout)
-    app.SetParameterString('tmpdir', tmpdir)
-    app.SetParameterInt('spatialr', spatialr)
-    app.SetParameterFloat('ranger', ranger)
-    app.SetParameterInt('minsize', minsize)
-    app.SetParameterInt('tilesizex', tilesize)
-    app.SetParameterInt('tilesizey', tilesize)
-    app.SetParameterInt('cleanup', 1 if debug else 0)
-    app.ExecuteAndWriteOutput()
-
-
-def mergesmall(fin, finseg, fout, minsize, tilesize):
-    app = otbApplication.Registry.CreateApplication('LSMSSmallRegionsMerging')
-    app.SetParameterString('in', fin)
-    app.SetParameterString('inseg', finseg)
-    app.SetParameterString('out', fout)
-    app.SetParameterInt('minsize', minsize)
-    app.SetParameterInt('tilesizex', tilesize)
-    app.SetParameterInt('tilesizey', tilesize)
-    app.ExecuteAndWriteOutput()
-
-
-def vectorize(fin, finseg, fout, tilesize):
-    app = otbApplication.Registry.CreateApplication('LSMSVectorization')
-    app.SetParameterString('in', fin)
-    app.SetParameterString('inseg', finseg)
-    app.SetParameterString('out', fout)
-    app.SetParameterInt('tilesizex', tilesize)
-    app.SetParameterInt('tilesizey', tilesize)
-    app.ExecuteAndWriteOutput()
+def estimateSegmentTmpBytes( year, area, infile, usetif, params ):
+    '''
+    estimateSegmentTmpBytes( year, area, infile, usetif, params )
+
+    Return the tmp bytes of running the LSMS chain over area, or over
+    infile if it is not None, see estimateStageBytes(). With usetif the
+    area is also copied to a tif in the tmpdir.
+    '''
+    if infile is None:
+        mpix = getAreaPixels( year, area )[0]
+    else:
+        ds = gdal.Open( infile )
+        mpix = ds.RasterXSize * ds.RasterYSize / 1.0e6
+        ds = None
+
+    nbytes = sum(estimateStageBytes( mpix, 4, params, None ).values())
+    if usetif:
+        nbytes += mpix * 1.0e6 * 4
+    return nbytes
 
 
 def loadsegments(fsegshp, year, job):
@@ -189,6 +166,11 @@ def loadsegments(fsegshp, year, job):
     dsn = 'PG:' + CONFIG['dsn']
 
     table = CONFIG.get('seg.table', 'segments.y{0}_{1}').format(year, job)
+
+    if CONFIG.get('seg.loader', 'copy') == 'copy':
+        loadShapefileCopy( fsegshp, table, epsg )
+        return
+
     conn, cur = getDatabase()
 
     sql = 'drop table if exists {} cascade'.format(table)
@@ -210,7 +192,16 @@ def UsageOP():
 Usage: ror_cli optimal-params options
     [-l|--latlog lat,lon]   - center location to use
     [-s|--size 512]         - pixel size of window to check default: 512
-    [-a|--area bbox]        - small bbox of area to check
+    [-a|--area bbox]        - area to check, fips code or bbox
+    [-n|--samples n]        - number of windows to sample across --area
+                              default: config optimal.samples or 1
+    [-g|--grid file]        - write the parameters of each window to a
+                              json grid for segment --tiled --paramgrid
+    [-c|--cached]           - only aggregate the windows of --area that
+                              are in the optimal parameter cache, this
+                              does not read any pixels
+    [-q|--quick]            - fast approximate parameters from random
+                              pixel samples with confidence intervals
     [-i|--isboxy 1|0]       - are objects square|rectangle or not
     [-b|--bands 0,1,2,4]    - which bands to use, zero based numbers
                               default: 0,1,2,4  (R,G,B,IR)
@@ -225,9 +216,9 @@ Usage: ror_cli optimal-params options
 
 def OptimalParams( argv ):
     try:
-        opts, args = getopt.getopt(argv, "l:s:a:i:b:y:pvh",
-            ['latlon', 'size', 'area', 'isboxy', 'bands', 'year',
-             'plots', 'verbose', 'help', 'debug'])
+        opts, args = getopt.getopt(argv, "l:s:a:n:g:cqi:b:y:pvh",
+            ['latlon', 'size', 'area', 'samples', 'grid', 'cached', 'quick', 'isboxy',
+             'bands', 'year', 'plots', 'verbose', 'help', 'debug'])
     except getopt.GetoptError:
         print 'ERROR in optimal-params options!'
         print 'args:', argv
@@ -237,6 +228,11 @@ def OptimalParams( argv ):
     verbose   = CONFIG.get('verbose', False)
     area      = CONFIG.get('areaOfInterest', None)
     year      = CONFIG.get('year', None)
+    nproc     = CONFIG.get('nproc', 1)
+    samples   = CONFIG.get('optimal.samples', 1)
+    fgrid     = None
+    cached    = False
+    quick     = CONFIG.get('optimal.approx', False)
     latlon    = None
     size      = 512
     boxy      = True
@@ -252,6 +248,14 @@ def OptimalParams( argv ):
             area = arg
         elif opt in ('-y', '--year'):
             year = str(int(arg))
+        elif opt in ('-n', '--samples'):
+            samples = int(arg)
+        elif opt in ('-g', '--grid'):
+            fgrid = arg
+        elif opt in ('-c', '--cached'):
+            cached = True
+        elif opt in ('-q', '--quick'):
+            quick = True
         elif opt in ('-i', '--isboxy'):
             boxy = arg != '0'
         elif opt in ('-b', '--bands'):
@@ -280,18 +284,21 @@ def OptimalParams( argv ):
         print "\nERROR: either area or latlon must be defined!"
         error = True
 
+    if samples < 1:
+        print "\nERROR: argument samples must be > 0 !"
+        error = True
+
     if error:
         return True
 
     print 'verbose:', verbose
     print 'debug:', debug
 
+    # only the area vrt goes in the tmpdir, the windows are read through
+    # /vsimem, the allocation ends with the process
     pid        = str(os.getpid())
-    home       = CONFIG['projectHomeDir']
-    tmpdirs    = CONFIG.get('tmpdirs', [os.path.join(home, 'tmp')])
-    tmpdir     = tmpdirs[0]
+    tmpdir     = allocateTmpdir( 0, 'optimal-params {}'.format(pid) )['tmpdir']
     vrtin      = os.path.join(tmpdir, 'tmp-{}-areaofinterest.vrt'.format(pid))
-    foptimal   = os.path.join(tmpdir, 'tmp-{}-optimal.tif'.format(pid))
 
     # if latlon then set area to bbox based on 1 meter/pixel
     # and double that to make sure with have some extra
@@ -312,51 +319,58 @@ def OptimalParams( argv ):
     # get a vrt file defining the area of interest
     createVrtForAOI( vrtin, year, area )
 
-    ds = gdal.Open( vrtin )
-    gt = ds.GetGeoTransform()
-    '''
-    gt[0] = originX
-    gt[1] = pixelWdith
-    gt[2] = 0
-    gt[3] = originY
-    gt[4] = 0
-    gt[5] = pixelHeight
-    '''
-    width = ds.RasterXSize
-    height = ds.RasterYSize
-    if min(width, height) < size:
-        size = min(width, height)
-
-    xoff = str(int((latlon[1] - gt[0]) / gt[1] - size/2))
-    yoff = str(int((latlon[0] - gt[3]) / gt[5]  - size/2))
-    size = str(int(size))
-    cmd = ['gdal_translate', '-of', 'GTiff', '-srcwin', xoff, yoff,
-           size, size, vrtin, foptimal]
-    runCommand( cmd, verbose )
+    if cached:
+        ds = gdal.Open( vrtin )
+        bbox = getWindowBounds( { 'xoff': 0, 'yoff': 0, 'xsize': ds.RasterXSize,
+                                  'ysize': ds.RasterYSize }, ds.GetGeoTransform() )
+        ds = None
+        conn, cur = getDatabase()
+        results = getCachedWindows( cur, year, bands, boxy,
+                                    CONFIG.get('optimal.chunkrows', 0), bbox )
+        conn.close()
+        agg = aggregateParameters( results )
+    elif latlon is None:
+        results, agg = sampleOptimalParameters( vrtin, samples, size, boxy, bands, nproc,
+                                                year=year, approx=quick )
+    else:
+        # a single window centered on latlon
+        ds = gdal.Open( vrtin )
+        gt = ds.GetGeoTransform()
+        width = ds.RasterXSize
+        height = ds.RasterYSize
+        ds = None
+        size = min(size, width, height)
+        xoff = int((latlon[1] - gt[0]) / gt[1] - size/2)
+        yoff = int((latlon[0] - gt[3]) / gt[5] - size/2)
+        win = { 'n': 0, 'xsize': size, 'ysize': size,
+                'xoff': min(max(0, xoff), width - size),
+                'yoff': min(max(0, yoff), height - size) }
+        win['x'], win['y'] = getWindowCenter( win, gt )
+        win['bounds'] = getWindowBounds( win, gt )
+        if not quick and CONFIG.get('optimal.cache', True):
+            conn, cur = getDatabase()
+            createOptimalCacheTable( cur )
+            conn.close()
+        results = [optimalWindow( (vrtin, win, boxy, bands, None, year, quick) )]
+        agg = aggregateParameters( results )
 
-    opt = getOptimalParameters( boxy, foptimal, bands, verbose, False )
+    if not fgrid is None and agg['n'] > 0:
+        writeParameterGrid( fgrid, vrtin, results, agg )
+        print "Wrote parameter grid to {}".format(fgrid)
 
-    ds = None
     if debug:
         print "Leaving tmp files for {}".format( vrtin )
     else:
         print "Removing tmp files."
-        os.remove( vrtin )
-        if os.path.exists( vrtin + '.in' ):
-            os.remove( vrtin + '.in' )
-        os.remove( foptimal )
-        if os.path.exists( foptimal + '.aux.xml' ):
-            os.remove( foptimal + '.aux.xml' )
-        if os.path.exists( foptimal + '.msk' ):
-            os.remove( foptimal + '.msk' )
-
-    print "   Optimal Parameters    "
-    print "    |  Hs  |  Hr  |   M  "
-    print "----+------+------+------"
-    print "min |  {0:2d}  |  {1:2d}  | {2:4d} ".format(opt['hs_min'], opt['hr_min'], opt['M_min'])
-    print "max |  {0:2d}  |  {1:2d}  | {2:4d} ".format(opt['hs_max'], opt['hr_max'], opt['M_max'])
-    print "avg |  {0:2d}  |  {1:2d}  | {2:4d} ".format(opt['hs_avg'], opt['hr_avg'], opt['M_avg'])
-    print "----+------+------+------"
+        for f in (vrtin, vrtin + '.in', vrtin + '.vrt'):
+            if os.path.exists( f ):
+                os.remove( f )
+
+    if agg['n'] == 0:
+        print "ERROR: could not compute the optimal parameters!"
+        return True
+
+    printSampleResults( results, agg )
 
     return False
 
@@ -376,6 +390,13 @@ Usage: ror_cli segment options
                               of the computed values
        [-x|--isboxy 0|1]    - are objects boxy, used with --optimal
        [-b|--bands 0,1,2,4] - which bands to use, used iwth --optimal
+       [--samples n]        - number of windows to sample across the area
+                              with --optimal, the median of the windows is
+                              used, default: config optimal.samples or 1
+    [--paramgrid file]      - with --optimal write the parameters of each
+                              window to this json grid, with --tiled segment
+                              each tile with the parameters of the nearest
+                              window of the grid
     [-s|--spatialr int]     - spatial radius of neigborhood in pixels
     [-r|--ranger float]     - radiometric radius in multi-spectral space
     [-m|--minsize int]      - minimum segment size in pixels
@@ -391,10 +412,23 @@ Usage: ror_cli segment options
                               to create table to store segments in
     [--debug]               - do not remove tmp files
     [--usetif]              - convert input vrt to tif
-    NOTE: --optimal will take a 1024x1024 image located at the center
-          of --area to compute the optimal parameters. If you want more
-          control over where the the sample is selected, use option
-          optimal-params above and set -s, -r, -m explicitly
+    [--tiled doqq|int]      - split the area into tiles on the DOQQ grid
+                              or of int pixels and segment them in
+                              parallel using nproc processes
+       [--overlap int]      - pixels of overlap between tiles
+    [--inmemory]            - connect the OTB applications in memory and
+                              do not write the intermediate rasters
+    [--cache]               - keep the smoothing and segmentation outputs
+                              in the stage cache and reuse them when the
+                              input and parameters match a previous run
+    [--sweep]               - segment with every combination of -s, -r and
+                              -m which take lists and ranges like 8,12:24:4
+                              and write a shapefile for each combination
+                              plus a summary of segment counts and times
+    NOTE: --optimal will take 1024x1024 windows spread over --area, or
+          one at its center, to compute the optimal parameters. If you
+          want more control over where the the sample is selected, use
+          option optimal-params above and set -s, -r, -m explicitly
     '''
     sys.exit(2)
 
@@ -410,7 +444,10 @@ def Segmentation( argv ):
         opts, args = getopt.getopt(argv, 'hf:a:y:s:r:t:i:p:m:dT:R:j:o:x:b:',
             ['help', 'file', 'area', 'year', 'spatialr', 'ranger', 'thresh',
              'max-iter', 'rangeramp', 'minsize', 'delete', 'tilesize', 'ram',
-             'job', 'optimal', 'boxy', 'bands', 'debug', 'usetif'])
+             'job', 'optimal', 'boxy', 'bands', 'debug', 'usetif',
+             'tiled=', 'overlap=', 'inmemory', 'cache', 'sweep', 'autotune',
+             'calibrate', 'incremental', 'unit=', 'list-changed', 'plan',
+             'samples=', 'paramgrid='])
     except getopt.GetoptError:
         print 'ERROR in Segmentation options!'
         print 'args:', argv
@@ -431,9 +468,23 @@ def Segmentation( argv ):
     minsize   = CONFIG.get('seg.minsize', None)
     tilesize  = CONFIG.get('seg.tilesize', None)
     ram       = CONFIG.get('seg.ram', None)
+    tiled     = CONFIG.get('seg.tiled', None)
+    overlap   = CONFIG.get('seg.overlap', 128)
+    nproc     = CONFIG.get('nproc', 1)
+    inmemory  = CONFIG.get('seg.inmemory', False)
+    cache     = CONFIG.get('seg.cache', False)
+    autotune  = CONFIG.get('seg.autotune', False)
+    sweep     = False
+    calib     = False
+    incremental = False
+    plan      = False
+    listonly  = False
+    unittype  = 'doqq'
     infile    = None
     job       = None
     optimal   = None
+    samples   = CONFIG.get('optimal.samples', 1)
+    paramgrid = None
     boxy      = True
     bands     = [0,1,2,4]
     debug     = False
@@ -460,11 +511,11 @@ def Segmentation( argv ):
         elif opt in ('-b', '--bands'):
             bands = [int(i) for i in arg.split(',')]
         elif opt in ('-s', '--spatialr'):
-            spatialr = int(arg)
+            spatialr = parseSweepArg(arg, int)
         elif opt in ('-r', '--ranger'):
-            ranger = float(arg)
+            ranger = parseSweepArg(arg, float)
         elif opt in ('-m', '--minsize'):
-            minsize = int(arg)
+            minsize = parseSweepArg(arg, int)
         elif opt in ('-d', '--delete'):
             delete = True
         elif opt in ('-t', '--thresh'):
@@ -483,6 +534,39 @@ def Segmentation( argv ):
             debug = True
         elif opt in ('--usetif'):
             usetif = True
+        elif opt == '--tiled':
+            if arg != 'doqq' and not re.match(r'^[0-9]+$', arg):
+                print "\nERROR: --tiled must take value of doqq or int pixels!"
+                Usage()
+            tiled = arg
+        elif opt == '--overlap':
+            overlap = int(arg)
+        elif opt == '--inmemory':
+            inmemory = True
+        elif opt == '--cache':
+            cache = True
+        elif opt == '--sweep':
+            sweep = True
+        elif opt == '--autotune':
+            autotune = True
+        elif opt == '--calibrate':
+            calib = True
+        elif opt == '--incremental':
+            incremental = True
+        elif opt == '--plan':
+            plan = True
+        elif opt == '--list-changed':
+            incremental = True
+            listonly = True
+        elif opt == '--samples':
+            samples = int(arg)
+        elif opt == '--paramgrid':
+            paramgrid = arg
+        elif opt == '--unit':
+            if not arg in ('cousub', 'doqq'):
+                print "\nERROR: --unit must take value of cousub|doqq!"
+                Usage()
+            unittype = arg
 
     # check all args are defined
     chkargs = { 'thresh':thresh, 'rangeramp':rangeramp, 'max-iter':maxiter,
@@ -508,23 +592,77 @@ def Segmentation( argv ):
         print "Please define them in the config file or as args!"
         Usage()
 
+    # -s, -r and -m can be lists when sweeping
+    sweepargs = {'spatialr':spatialr, 'ranger':ranger, 'minsize':minsize}
+    for k in sweepargs:
+        if not type(sweepargs[k]) is list:
+            sweepargs[k] = [sweepargs[k]]
+        elif len(sweepargs[k]) > 1 and not sweep:
+            print "ERROR: '{}' takes a single value without --sweep!".format(k)
+            Usage()
+    if sweep:
+        if not optimal is None:
+            print "ERROR: --sweep can not be used with --optimal!"
+            Usage()
+        if calib:
+            print "ERROR: --sweep can not be used with --calibrate!"
+            Usage()
+        spatialrs = sweepargs['spatialr']
+        rangers   = sweepargs['ranger']
+        minsizes  = sweepargs['minsize']
+    else:
+        spatialr = sweepargs['spatialr'][0]
+        ranger   = sweepargs['ranger'][0]
+        minsize  = sweepargs['minsize'][0]
+
     # generate tmp filenames for LSMS process
     pid        = str(os.getpid())
     home       = CONFIG['projectHomeDir']
-    tmpdirs    = CONFIG.get('tmpdirs', [os.path.join(home, 'tmp')])
-    tmpdir     = tmpdirs[0]
+    tmpdirs    = getTmpdirs()
+
+    # the tmpdir on the least loaded disk with room for the LSMS chain
+    # when it runs here, tiled segmentation, the sweep and the units of
+    # --incremental allocate their own, the allocation ends with the process
+    tmpbytes = 0
+    if tiled is None and not (plan or incremental or sweep or calib):
+        tmpbytes = estimateSegmentTmpBytes( year, area, infile, usetif,
+                        { 'inmemory': inmemory, 'cache': cache, 'delete': delete } )
+    tmpdir     = allocateTmpdir( tmpbytes, 'segment {}'.format(job or pid),
+                                 prefix='tmp-{}-'.format(pid) )['tmpdir']
     vrtin      = os.path.join(tmpdir, 'tmp-{}-areaofinterest.vrt'.format(pid))
     tifin      = os.path.join(tmpdir, 'tmp-{}-areaofinterest.tif'.format(pid))
-    fsmooth    = os.path.join(tmpdir, 'tmp-{}-smooth.tif'.format(pid))
-    fsmoothpos = os.path.join(tmpdir, 'tmp-{}-smoothpos.tif'.format(pid))
-    fsegs      = os.path.join(tmpdir, 'tmp-{}-segs.tif'.format(pid))
-    fmerged    = os.path.join(tmpdir, 'tmp-{}-merged.tif'.format(pid))
-    foptimal   = os.path.join(tmpdir, 'tmp-{}-optimal.tif'.format(pid))
     fsegshp    = os.path.join(home, 'data', year, 'segments', 'segments-{}.shp'.format(job))
 
     t0 = time.time()
     print "Setup time:", t0 - startTime
 
+    if plan:
+        if not infile is None or not optimal is None or sweep:
+            print "ERROR: --plan can not be used with --file, --optimal or --sweep!"
+            Usage()
+        params = { 'spatialr': spatialr, 'ranger': ranger, 'minsize': minsize,
+                   'delete': delete, 'tilesize': tilesize, 'ram': ram,
+                   'inmemory': inmemory, 'cache': cache }
+        planSegmentation( year, area, params, tiled, overlap, nproc )
+        return False
+
+    if incremental:
+        if not infile is None or not optimal is None or sweep:
+            print "ERROR: --incremental can not be used with --file, --optimal or --sweep!"
+            Usage()
+        # segunits imports this module
+        from segunits import segmentChangedUnits
+        params = { 'spatialr': spatialr, 'ranger': ranger, 'minsize': minsize,
+                   'delete': delete, 'thresh': thresh, 'rangeramp': rangeramp,
+                   'maxiter': maxiter, 'tilesize': tilesize, 'ram': ram,
+                   'debug': debug, 'inmemory': inmemory, 'cache': cache,
+                   'autotune': autotune, 'tiled': tiled, 'overlap': overlap,
+                   'nproc': nproc }
+        segmentChangedUnits( year, area, unittype, table.format(year, job), params,
+                             tmpdirs, 'tmp-{}'.format(pid), dryrun=listonly )
+        print 'Done!', time.time() - startTime
+        return False
+
 
     if infile is None:
         # get a vrt file defining the area of interest
@@ -551,28 +689,18 @@ def Segmentation( argv ):
 
     # get the optimal segmentation parameters is requested
     if not optimal is None:
-        ds = gdal.Open( vrtin )
-        width = ds.RasterXSize
-        height = ds.RasterYSize
-        size = 1024
-        if min(width, height) < size:
-            size = min(width, height)
-
-        xoff = str(int(width/2 - size/2))
-        yoff = str(int(height/2 - size/2))
-        size = str(int(size))
-        cmd = ['gdal_translate', '-of', 'GTiff', '-srcwin', xoff, yoff,
-               size, size, vrtin, foptimal]
-        runCommand( cmd, verbose )
-
-        optParams = getOptimalParameters( boxy, foptimal, bands, verbose, False )
-        spatialr = optParams['hs_' + optimal]
-        ranger   = optParams['hr_' + optimal]
-        minsize  = optParams['M_'  + optimal]
-
-        ds = None
-        if not debug:
-            of.remove( foptimal )
+        results, agg = sampleOptimalParameters( vrtin, samples, 1024, boxy, bands, nproc,
+                            year=year if infile is None else None,
+                            approx=CONFIG.get('optimal.approx', False) )
+        if agg['n'] == 0:
+            print "ERROR: could not compute the optimal parameters!"
+            return True
+        printSampleResults( results, agg )
+        spatialr, ranger, minsize = selectParameters( agg['median'], optimal )
+
+        if not paramgrid is None:
+            writeParameterGrid( paramgrid, vrtin, results, agg )
+            print "Wrote parameter grid to {}".format(paramgrid)
 
         t1 = time.time()
         print "Get optimal time:", t1 - t0
@@ -584,46 +712,55 @@ def Segmentation( argv ):
         print "  ranger   (hr): {}".format(ranger)
         print "  minsize   (M): {}".format(minsize)
 
-    print 'Starting smoothing ...'
-    smoothing(vrtin, fsmooth, fsmoothpos, spatialr, ranger, rangeramp, thresh, maxiter, ram)
-
-    t1 = time.time()
-    print "Smoothing time:", t1 - t0
-    t0 = t1
-
-    if delete:
-        minsize1 = minsize
-        fsegs = fmerged
+    params = { 'spatialr': spatialr, 'ranger': ranger, 'minsize': minsize,
+               'delete': delete, 'thresh': thresh, 'rangeramp': rangeramp,
+               'maxiter': maxiter, 'tilesize': tilesize, 'ram': ram,
+               'debug': debug, 'inmemory': inmemory, 'cache': cache,
+               'autotune': autotune }
+    if not paramgrid is None and not tiled is None:
+        params['paramgrid'] = paramgrid
+        params['gridselect'] = optimal
+
+    if calib:
+        calibrate( vrtin, tmpdir, 'tmp-{}'.format(pid), params )
+        if not debug and infile is None:
+            for f in (vrtin, fvrtvrt, tifin):
+                if os.path.exists( f ):
+                    os.remove( f )
+        print 'Done!', time.time() - startTime
+        return False
+
+    if sweep:
+        sweepdir = os.path.join( home, CONFIG.get('seg.shapedir', 'data/segments') )
+        sweepSegmentation( vrtin, sweepdir, job or 'sweep-{}'.format(pid),
+                           tmpdirs, 'tmp-{}'.format(pid), params,
+                           spatialrs, rangers, minsizes, nproc )
+        if not debug and infile is None:
+            for f in (vrtin, fvrtvrt, tifin):
+                if os.path.exists( f ):
+                    os.remove( f )
+        print 'Done!', time.time() - startTime
+        return False
+
+    if tiled is None:
+        workers = 1
+        times = runLSMS( vrtin, fsegshp, tmpdir, 'tmp-{}'.format(pid), params )
     else:
-        minsize1 = 0
-
-    print 'Starting Segmentation ...'
-    segmentit(fsmooth, fsmoothpos, fsegs, spatialr, ranger, minsize1, tilesize, tmpdir)
-
-    t1 = time.time()
-    print "Segmentation time:", t1 - t0
-    t0 = t1
-
-    print 'Starting small area merging ...'
-    if not delete:
-        mergesmall(fsmooth, fsegs, fmerged, minsize, tilesize)
+        workers = nproc or getNumCpus()
+        times = runTiledSegmentation( vrtin, fsegshp, tmpdirs,
+                    'tmp-{}'.format(pid), params, tiled, overlap, nproc )
+        if times is None:
+            print "ERROR: tiled segmentation failed!"
+            return True
 
-        t1 = time.time()
-        print "Merge small area time:", t1 - t0
-        t0 = t1
-
-    print 'Starting vectorization of segments ...'
-    vectorize(fsmooth, fmerged, fsegshp, tilesize)
-
-    t1 = time.time()
-    print "Vectoriztion time:", t1 - t0
-    t0 = t1
+    t0 = time.time()
 
     print 'Adding stats to vectors ...'
-    addShapefileStats(fsegshp)
+    addShapefileStats(fsegshp, nproc)
 
     t1 = time.time()
     print "Add polygon stats time:", t1 - t0
+    times['stats'] = t1 - t0
     t0 = t1
 
     if infile is None:
@@ -632,8 +769,13 @@ def Segmentation( argv ):
 
         t1 = time.time()
         print "Load segments time:", t1 - t0
+        times['load'] = t1 - t0
         t0 = t1
 
+    # learn the cost model for segment --plan
+    recordStageTimes( vrtin, times, workers,
+                      params.get('threads') or max(1, getNumCpus() / workers), fsegshp )
+
     if debug:
         print 'Leaving tmp files in {}.'.format(tmpdir)
     else:
@@ -641,11 +783,6 @@ def Segmentation( argv ):
         try:
             if infile is None:
                 os.remove( vrtin )
-            os.remove( fsmooth )
-            os.remove( fsmoothpos )
-            os.remove( fsegs )
-            if not delete:
-                os.remove( fmerged )
             os.remove( fsegshp )
             if os.path.exists( fvrtvrt ):
                 os.remove( fvrtvrt )
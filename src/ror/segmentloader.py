@@ -0,0 +1,314 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import time
+import uuid
+import struct
+import psycopg2
+from osgeo import ogr, osr
+
+from utils import getDatabase
+from config import *
+
+# binary COPY file header: signature, flags and header extension length
+PGCOPY_HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+
+# EWKB flag to say an SRID follows the geometry type
+EWKB_SRID_FLAG = 0x20000000
+
+# map OGR field types to the column type and binary COPY format
+FIELD_TYPES = {
+    ogr.OFTInteger: ['integer', 'i'],
+    ogr.OFTReal:    ['double precision', 'd'],
+    }
+if hasattr(ogr, 'OFTInteger64'):
+    FIELD_TYPES[ogr.OFTInteger64] = ['bigint', 'q']
+
+
+def splitTableName( table ):
+    '''Return [schema, name] for a table that might be schema qualified.'''
+    parts = table.split('.')
+    if len(parts) == 1:
+        return ['public', parts[0]]
+    return parts[-2:]
+
+
+def toEWKB( geom, srid ):
+    '''Return the geometry as little endian EWKB with the srid embedded.'''
+    wkb = bytes( geom.ExportToWkb( ogr.wkbNDR ) )
+    gtype = struct.unpack('<I', wkb[1:5])[0]
+    return wkb[0] + struct.pack('<II', gtype | EWKB_SRID_FLAG, srid) + wkb[5:]
+
+
+class CopyStream:
+    """
+    Class CopyStream
+
+    A file like object for cursor.copy_expert() that streams the features
+    of an OGR layer in PostgreSQL binary COPY format, one row at a time,
+    so the layer never has to fit in memory.
+
+    Each row is gid, the layer fields in order, and the geometry as
+    EWKB which the PostGIS binary input function accepts.
+    """
+
+    def __init__(self, layer, fields, transform, srid):
+        self._layer = layer
+        self._fields = fields
+        self._transform = transform
+        self._srid = srid
+        self._rows = self._generate()
+        self._buf = ''
+        self._done = False
+        self.count = 0
+
+    def _generate(self):
+        ncols = len(self._fields) + 2
+        yield PGCOPY_HEADER
+        for feature in self._layer:
+            row = [struct.pack('!hii', ncols, 4, feature.GetFID() + 1)]
+            for idx, fmt in self._fields:
+                if not feature.IsFieldSet( idx ):
+                    row.append( struct.pack('!i', -1) )
+                elif fmt == 'i':
+                    row.append( struct.pack('!ii', 4, feature.GetFieldAsInteger( idx )) )
+                elif fmt == 'q':
+                    row.append( struct.pack('!iq', 8, feature.GetFieldAsInteger64( idx )) )
+                elif fmt == 'd':
+                    row.append( struct.pack('!id', 8, feature.GetFieldAsDouble( idx )) )
+                else:
+                    s = feature.GetFieldAsString( idx )
+                    row.append( struct.pack('!i', len(s)) + s )
+
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                row.append( struct.pack('!i', -1) )
+            else:
+                if not self._transform is None:
+                    geom = geom.Clone()
+                    geom.Transform( self._transform )
+                ewkb = toEWKB( geom, self._srid )
+                row.append( struct.pack('!i', len(ewkb)) + ewkb )
+
+            self.count += 1
+            yield ''.join( row )
+        yield PGCOPY_TRAILER
+
+    def read(self, size=-1):
+        chunks = [self._buf]
+        n = len(self._buf)
+        while (size < 0 or n < size) and not self._done:
+            try:
+                chunk = self._rows.next()
+            except StopIteration:
+                self._done = True
+                break
+            chunks.append( chunk )
+            n += len(chunk)
+        data = ''.join( chunks )
+        if size < 0:
+            size = len(data)
+        self._buf = data[size:]
+        return data[:size]
+
+
+def copyToStage( cur, fsegshp, schema, stage, epsg ):
+    '''
+    copyToStage( cur, fsegshp, schema, stage, epsg )
+        cur     - database cursor
+        fsegshp - segment shapefile with its stats already added
+        schema  - schema to create the staging table in
+        stage   - name of the UNLOGGED staging table, it is replaced
+        epsg    - projection to store the geometries in, eg: EPSG:4326
+
+    Stream the shapefile into the staging table with a binary COPY.
+    Returns (count, columns) where columns is a list of [name, type]
+    for the staging table starting with gid and ending with geom.
+    '''
+    verbose = CONFIG.get('verbose', False)
+
+    ds = ogr.Open( fsegshp )
+    if ds is None:
+        print "ERROR: could not open '{}' as shapefile!".format(fsegshp)
+        sys.exit(1)
+    layer = ds.GetLayer()
+
+    srs_s = layer.GetSpatialRef()
+    srs_t = osr.SpatialReference()
+    srs_t.SetFromUserInput( epsg )
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs_t.SetAxisMappingStrategy( osr.OAMS_TRADITIONAL_GIS_ORDER )
+        if not srs_s is None:
+            srs_s.SetAxisMappingStrategy( osr.OAMS_TRADITIONAL_GIS_ORDER )
+    srid = int(srs_t.GetAuthorityCode(None) or 4326)
+
+    transform = None
+    if not srs_s is None and not srs_s.IsSame( srs_t ):
+        transform = osr.CoordinateTransformation( srs_s, srs_t )
+
+    # build the columns from the layer fields
+    defn = layer.GetLayerDefn()
+    fields = []
+    columns = [['gid', 'integer']]
+    for i in range(defn.GetFieldCount()):
+        fdefn = defn.GetFieldDefn(i)
+        coltype, fmt = FIELD_TYPES.get( fdefn.GetType(), ['text', 't'] )
+        fields.append( [i, fmt] )
+        columns.append( ['"{}"'.format(fdefn.GetName().lower()), coltype] )
+    columns.append( ['geom', 'geometry(Geometry, {})'.format(srid)] )
+
+    sql = 'drop table if exists {}.{} cascade'.format(schema, stage)
+    if verbose:
+        print sql
+    cur.execute( sql )
+
+    sql = 'create unlogged table {}.{} ({})'.format(
+        schema, stage, ', '.join([' '.join(c) for c in columns]))
+    if verbose:
+        print sql
+    cur.execute( sql )
+
+    sql = 'copy {}.{} ({}) from stdin with (format binary)'.format(
+        schema, stage, ', '.join([c[0] for c in columns]))
+    if verbose:
+        print sql
+    stream = CopyStream( layer, fields, transform, srid )
+    cur.copy_expert( sql, stream, size=1048576 )
+    ds = None
+
+    return (stream.count, columns)
+
+
+def loadShapefileCopy( fsegshp, table, epsg ):
+    '''
+    loadShapefileCopy( fsegshp, table, epsg )
+        fsegshp - segment shapefile with its stats already added
+        table   - table to load the segments into, it is replaced
+        epsg    - projection to store the geometries in, eg: EPSG:4326
+
+    Load the shapefile with a binary COPY into an UNLOGGED staging table,
+    then add the primary key and GiST index, make it logged and swap it
+    in for table in one transaction. This is much faster than ogr2ogr
+    for millions of segments. Returns the number of rows loaded.
+    '''
+    verbose = CONFIG.get('verbose', False)
+    t0 = time.time()
+
+    schema, name = splitTableName( table )
+    stage = '{}_stage'.format(name)
+
+    conn, cur = getDatabase()
+
+    count, columns = copyToStage( cur, fsegshp, schema, stage, epsg )
+
+    t1 = time.time()
+    print "Copied {} rows in {:.1f} sec, {:.0f} rows/sec".format(
+        count, t1 - t0, count / max(t1 - t0, 0.001))
+
+    sqls = [
+        'alter table {0}.{1} add primary key (gid)',
+        'create index {1}_geom_gist on {0}.{1} using gist (geom)',
+        'alter table {0}.{1} set logged',
+        'analyze {0}.{1}' ]
+    for sql in sqls:
+        sql = sql.format(schema, stage)
+        if verbose:
+            print sql
+        cur.execute( sql )
+
+    # swap the staging table in for the job table
+    conn.set_session( autocommit=False )
+    sqls = [
+        'drop table if exists {0}.{2} cascade',
+        'alter table {0}.{1} rename to {2}',
+        'alter index {0}.{1}_pkey rename to {2}_pkey',
+        'alter index {0}.{1}_geom_gist rename to {2}_geom_gist' ]
+    for sql in sqls:
+        sql = sql.format(schema, stage, name)
+        if verbose:
+            print sql
+        cur.execute( sql )
+    conn.commit()
+    conn.close()
+
+    t2 = time.time()
+    print "Indexed and swapped in {} in {:.1f} sec, {:.0f} rows/sec overall".format(
+        table, t2 - t1, count / max(t2 - t0, 0.001))
+
+    return count
+
+
+def appendShapefileCopy( fsegshp, table, epsg, unit, unitgeom, unitargs ):
+    '''
+    appendShapefileCopy( fsegshp, table, epsg, unit, unitgeom, unitargs )
+        fsegshp  - segment shapefile with its stats already added
+        table    - table to load the segments into, created if needed
+        epsg     - projection to store the geometries in, eg: EPSG:4326
+        unit     - name of the work unit the segments belong to
+        unitgeom - sql expression for the geometry of the unit
+        unitargs - list of query arguments for unitgeom
+
+    Copy the shapefile into a staging table, then in one transaction
+    replace the rows of unit in table with the staged segments whose
+    centroid falls in the unit geometry. Units are segmented with some
+    context around them, so this keeps each segment in exactly one unit.
+    Returns the number of rows kept.
+    '''
+    verbose = CONFIG.get('verbose', False)
+    t0 = time.time()
+
+    schema, name = splitTableName( table )
+    # several workers can be loading into the same table
+    stage = '{}_s{}'.format(name, uuid.uuid4().hex[:8])
+
+    conn, cur = getDatabase()
+
+    count, columns = copyToStage( cur, fsegshp, schema, stage, epsg )
+
+    # create the job table the first time, gid is assigned by the table
+    sqls = [
+        'create table if not exists {0}.{1} (gid serial primary key, {2}, unit text)',
+        'create index if not exists {1}_geom_gist on {0}.{1} using gist (geom)',
+        'create index if not exists {1}_unit_idx on {0}.{1} (unit)' ]
+    for sql in sqls:
+        sql = sql.format(schema, name, ', '.join([' '.join(c) for c in columns[1:]]))
+        if verbose:
+            print sql
+        try:
+            cur.execute( sql )
+        except psycopg2.Error:
+            # another worker created it at the same time
+            pass
+
+    cols = ', '.join([c[0] for c in columns[1:]])
+    conn.set_session( autocommit=False )
+    sql = 'delete from {}.{} where unit = %s'.format(schema, name)
+    cur.execute( sql, (unit,) )
+    sql = '''insert into {0}.{1} ({3}, unit)
+        select {3}, %s from {0}.{2} s
+        where st_intersects(st_centroid(s.geom), {4})'''.format(
+            schema, name, stage, cols, unitgeom)
+    if verbose:
+        print sql
+    cur.execute( sql, [unit] + list(unitargs) )
+    kept = cur.rowcount
+    cur.execute( 'drop table {}.{}'.format(schema, stage) )
+    conn.commit()
+    conn.close()
+
+    print "Loaded {} of {} rows for unit {} in {:.1f} sec".format(
+        kept, count, unit, time.time() - t0)
+
+    return kept
@@ -0,0 +1,241 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import math
+from osgeo import gdal
+
+from utils import getNumCpus
+from tuning import loadHostTuning, getTuningFile, stageTileBytes, TUNING_STAGES
+from config import *
+
+'''
+Estimate the wall time, peak ram and tmp disk of a segment job before
+running it. The pixel count comes from the DOQQs of the area and the
+seconds per megapixel of each stage from the runs recorded for this host
+by recordStageTimes(), or from the calibration if there are no runs yet.
+'''
+
+# stages that run once in the main process, after the LSMS chains
+SERIAL_STAGES = ('stitching', 'stats', 'load')
+
+PLAN_STAGES = TUNING_STAGES + SERIAL_STAGES
+
+
+def getAreaPixels( year, area ):
+    '''Return (megapixels, number of DOQQs, largest DOQQ size) of the area.'''
+    # segmentation imports this module
+    from segmentation import getDoqqsForArea
+
+    mpix = 0.0
+    size = 0
+    files = getDoqqsForArea( year, area )
+    for f in files:
+        ds = gdal.Open( f )
+        if ds is None:
+            print "WARNING: could not open '{}'!".format(f)
+            continue
+        mpix += ds.RasterXSize * ds.RasterYSize / 1.0e6
+        size = max(size, ds.RasterXSize, ds.RasterYSize)
+        ds = None
+
+    return (mpix, len(files), size)
+
+
+def getStageRates( host, workers ):
+    '''
+    getStageRates( host, workers )
+
+    Return (rates, shprate, source) where rates is the seconds per
+    megapixel of each stage, summed over the workers, learned from the
+    recorded runs with the number of workers closest to workers, shprate
+    is the shapefile bytes per megapixel or None and source says where
+    the rates came from. Returns None if there is nothing to learn from.
+    '''
+    runs = host.get('runs', [])
+    if len(runs) > 0:
+        nearest = min([abs(r['workers'] - workers) for r in runs])
+        runs = [r for r in runs if abs(r['workers'] - workers) == nearest]
+        source = '{} runs with {} workers'.format(len(runs), runs[0]['workers'])
+    elif 'calibration' in host:
+        cal = host['calibration']
+        best = [r for r in cal['results'] if r['tilesize'] == cal['best']['tilesize']
+                and r['threads'] == cal['best']['threads']][0]
+        runs = [{ 'mpix': cal['size'] ** 2 / 1.0e6, 'times': best['times'] }]
+        source = 'calibration of {}'.format(cal['date'])
+    else:
+        return None
+
+    rates = {}
+    for stage in PLAN_STAGES:
+        done = [r for r in runs if stage in r['times']]
+        mpix = sum([r['mpix'] for r in done])
+        if mpix > 0:
+            rates[stage] = sum([r['times'][stage] for r in done]) / mpix
+
+    shp = [r for r in runs if 'shpbytes' in r]
+    shprate = None
+    if len(shp) > 0:
+        shprate = sum([r['shpbytes'] for r in shp]) / sum([r['mpix'] for r in shp])
+
+    return (rates, shprate, source)
+
+
+def estimateStageBytes( mpix, bands, params, shprate ):
+    '''
+    estimateStageBytes( mpix, bands, params, shprate )
+
+    Return a dictionary of the tmp disk bytes written by each stage of
+    one LSMS chain over mpix megapixels. The smoothed image is float32
+    per band plus two float32 position bands, the labels are uint32 and
+    LSMSSegmentation writes its tiles to tmpdir before the mosaic.
+    '''
+    pix = mpix * 1.0e6
+    inmemory = params.get('inmemory', False) and not params.get('cache', False)
+
+    est = {}
+    est['smoothing'] = 0 if inmemory else pix * (4*bands + 8)
+    est['segmentation'] = pix * 4 if inmemory else pix * 4 * 2
+    if params.get('delete', False) or inmemory:
+        est['merging'] = 0
+    else:
+        est['merging'] = pix * 4
+    est['vectorization'] = 0 if shprate is None else shprate * mpix
+    return est
+
+
+def estimateStageRam( params, bands ):
+    '''Return a dictionary of the peak MB of each stage of one LSMS chain.'''
+    est = { 'smoothing': params['ram'] }
+    for stage in TUNING_STAGES[1:]:
+        tilesize = params.get('stages', {}).get(stage, {}).get('tilesize', params['tilesize'])
+        # a tile being processed and the next one being read
+        est[stage] = 2 * stageTileBytes( stage, tilesize, bands, params['spatialr'] ) / 1048576
+    return est
+
+
+def _fmtBytes( n ):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n < 1024.0:
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024.0
+    return '{:.1f} PB'.format(n)
+
+
+def _fmtTime( secs ):
+    if secs is None:
+        return '?'
+    if secs < 3600:
+        return '{:.1f} min'.format(secs / 60.0)
+    if secs < 86400 * 2:
+        return '{:.1f} hours'.format(secs / 3600.0)
+    return '{:.1f} days'.format(secs / 86400.0)
+
+
+def planSegmentation( year, area, params, tiled, overlap, nproc ):
+    '''
+    planSegmentation( year, area, params, tiled, overlap, nproc )
+        year    - naip year to segment
+        area    - area of interest, fips code or bbox
+        params  - dictionary of segmentation parameters, see runLSMS()
+        tiled   - None, 'doqq' or tile size in pixels, see runTiledSegmentation()
+        overlap - pixels of overlap between tiles
+        nproc   - number of tiles to process at the same time, 0=all cpus
+
+    Print the estimated wall time, peak ram and tmp disk of each stage
+    of segmenting area and how the wall time scales with nproc in tiled
+    mode. Returns the estimated wall time in seconds or None.
+    '''
+    bands = 4
+    ncpu = getNumCpus()
+    if nproc == 0:
+        nproc = ncpu
+
+    mpix, ndoqqs, doqqsize = getAreaPixels( year, area )
+    print "Area {} of {} has {} DOQQs, {:,.0f} megapixels".format(area, year, ndoqqs, mpix)
+
+    # tiles read a margin of overlap pixels around them
+    ntiles = 1
+    tmpix = mpix
+    if not tiled is None:
+        overlap = max(overlap, 2*params['spatialr'])
+        tsize = doqqsize if tiled == 'doqq' else int(tiled)
+        ntiles = ndoqqs if tiled == 'doqq' else max(1, int(math.ceil(mpix * 1.0e6 / tsize**2)))
+        tmpix = mpix * ((tsize + 2.0*overlap) / tsize) ** 2
+        print "Tiled into about {} tiles of {} pixels, {:,.0f} megapixels with overlap".format(
+            ntiles, tsize, tmpix)
+
+    host = loadHostTuning()
+    workers = 1 if tiled is None else min(nproc, ntiles)
+    rates = getStageRates( host, workers )
+    if rates is None:
+        print "ERROR: no stage timings for this host in {}!".format(getTuningFile())
+        print "Run segment --calibrate or a small segment job first."
+        return None
+    rates, shprate, source = rates
+    print "Cost model from {}".format(source)
+
+    # recorded runs divide the seconds of all their tiles by the pixels of
+    # their input, so their rates already pay for the overlap, the
+    # calibration ran on a single image and does not
+    ratepix = mpix if len(host.get('runs', [])) > 0 else tmpix
+
+    stagebytes = estimateStageBytes( tmpix, bands, params, shprate )
+    stageram = estimateStageRam( params, bands )
+    tilebytes = estimateStageBytes( tmpix / ntiles, bands, params, shprate )
+
+    print
+    print " Stage         |   Wall time  |  Peak RAM  |  Tmp disk  "
+    print "---------------+--------------+------------+------------"
+    total = 0.0
+    for stage in PLAN_STAGES:
+        if stage == 'stitching' and tiled is None:
+            continue
+        if stage == 'merging' and params.get('delete', False):
+            continue
+        secs = None
+        if stage in rates:
+            if stage in SERIAL_STAGES:
+                secs = rates[stage] * mpix
+            else:
+                secs = rates[stage] * ratepix / workers
+            total += secs
+        ram = stageram.get(stage, 0) * (1 if stage in SERIAL_STAGES else workers)
+        if tiled is None or stage in ('vectorization',) + SERIAL_STAGES:
+            disk = stagebytes.get(stage, 0)
+        else:
+            # only the tiles in progress have their rasters on disk
+            disk = tilebytes.get(stage, 0) * workers
+        print " {0:13s} | {1:>12s} | {2:>10s} | {3:>10s} ".format(stage,
+            _fmtTime(secs), _fmtBytes(ram * 1048576), _fmtBytes(disk))
+    print "---------------+--------------+------------+------------"
+    print " {0:13s} | {1:>12s} |".format('total', _fmtTime(total))
+
+    if not tiled is None:
+        print
+        print "Scaling with nproc (rates from the runs with the closest worker count):"
+        print " nproc |   Wall time  |  Peak RAM  "
+        print "-------+--------------+------------"
+        n = 1
+        while n <= ncpu:
+            w = min(n, ntiles)
+            r = getStageRates( host, w )[0]
+            secs = sum([r[s] * (mpix if s in SERIAL_STAGES else ratepix / w)
+                        for s in r if s in PLAN_STAGES])
+            ram = max([stageram[s] for s in TUNING_STAGES]) * w
+            print " {0:5d} | {1:>12s} | {2:>10s} {3}".format(n, _fmtTime(secs),
+                _fmtBytes(ram * 1048576), '*' if n == nproc else '')
+            n = n * 2 if n * 2 <= ncpu or n == ncpu else ncpu
+        print "-------+--------------+------------"
+
+    return total
@@ -0,0 +1,481 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import getopt
+import threading
+import traceback
+
+from utils import getDatabase
+from segunits import UNIT_TYPES, getUnitsForArea, getChangedUnits, segmentUnit
+from tmpalloc import getTmpdirs
+from config import *
+
+'''
+Work queue for segmenting an area of interest on many machines that
+share the same database. Units (see segunits.py) are added to the
+segments.workqueue table and any number of workers on any node lease
+them with FOR UPDATE SKIP LOCKED, keep the lease alive with a heartbeat
+while they segment and load the unit, and then mark it done or put it
+back for a retry. A unit whose heartbeat stops is leased again.
+'''
+
+QUEUE_TABLE = 'segments.workqueue'
+
+# segmentation parameters saved with each unit, the machine specific
+# ones like ram and nproc come from the worker's config and options
+QUEUE_PARAMS = ['spatialr', 'ranger', 'minsize', 'delete', 'thresh',
+                'rangeramp', 'maxiter', 'tilesize', 'tiled', 'overlap']
+
+
+def createQueueTable( cur ):
+    cur.execute('''create table if not exists {0} (
+        id serial primary key,
+        job text not null,
+        year text not null,
+        unittype text not null,
+        unit text not null,
+        params text,
+        status text not null default 'pending',
+        attempts integer not null default 0,
+        worker text,
+        leased timestamp,
+        heartbeat timestamp,
+        finished timestamp,
+        seconds float8,
+        nsegs integer,
+        error text,
+        unique (job, year, unittype, unit))'''.format(QUEUE_TABLE))
+    cur.execute('create index if not exists workqueue_status_idx on {} (status, id)'.format(QUEUE_TABLE))
+
+
+def enqueueUnits( job, year, area, unittype, params, changed=False ):
+    '''
+    enqueueUnits( job, year, area, unittype, params, changed=False )
+
+    Add the units of area to the queue. Units already in the queue are
+    left alone, except with changed where only the units whose inputs or
+    parameters changed since they were loaded are queued, and those that
+    were done or failed before are queued again. Returns the number added.
+    '''
+    if changed:
+        table = CONFIG.get('seg.table', 'segments.y{0}_{1}').format(year, job)
+        units = getChangedUnits( year, area, unittype, table, params )
+        conflict = '''do update set status = 'pending', attempts = 0,
+            params = excluded.params, error = null
+            where {}.status in ('done', 'failed')'''.format(QUEUE_TABLE.split('.')[-1])
+    else:
+        units = getUnitsForArea( year, area, unittype )
+        conflict = 'do nothing'
+
+    conn, cur = getDatabase()
+    createQueueTable( cur )
+
+    sql = '''insert into {} (job, year, unittype, unit, params)
+        values (%s, %s, %s, %s, %s)
+        on conflict (job, year, unittype, unit) {}'''.format(QUEUE_TABLE, conflict)
+    n = 0
+    for unit in units:
+        cur.execute( sql, (job, year, unittype, unit, json.dumps(params)) )
+        n += cur.rowcount
+    conn.close()
+
+    print "Queued {} of {} {} units for job {}".format(n, len(units), unittype, job)
+    return n
+
+
+def leaseUnit( cur, worker, job, stale, maxattempts ):
+    '''
+    leaseUnit( cur, worker, job, stale, maxattempts )
+
+    Lease the next pending unit, or a leased unit whose heartbeat is
+    older than stale seconds, for worker. If job is not None only units
+    of that job are leased. Returns (id, job, year, unittype, unit, params)
+    or None if there is no work.
+    '''
+    # leases that expired after their last attempt will never be retried
+    sql = '''update {} set status = 'failed', error = 'lease expired'
+        where status = 'leased' and attempts >= %s
+          and heartbeat < now() - %s * interval '1 second' '''.format(QUEUE_TABLE)
+    cur.execute( sql, (maxattempts, stale) )
+
+    jobclause = ''
+    args = [worker, stale, maxattempts]
+    if not job is None:
+        jobclause = ' and job = %s '
+        args.append( job )
+
+    sql = '''update {0} q
+        set status = 'leased', worker = %s, leased = now(), heartbeat = now(),
+            attempts = q.attempts + 1, error = null
+        where q.id = (
+            select id from {0}
+            where (status = 'pending'
+                   or (status = 'leased' and heartbeat < now() - %s * interval '1 second'))
+              and attempts < %s {1}
+            order by id
+            for update skip locked
+            limit 1)
+        returning q.id, q.job, q.year, q.unittype, q.unit, q.params'''.format(
+            QUEUE_TABLE, jobclause)
+    cur.execute( sql, args )
+
+    return cur.fetchone()
+
+
+def finishUnit( cur, qid, worker, nsegs, seconds ):
+    sql = '''update {} set status = 'done', finished = now(), nsegs = %s,
+        seconds = %s where id = %s and worker = %s'''.format(QUEUE_TABLE)
+    cur.execute( sql, (nsegs, seconds, qid, worker) )
+
+
+def failUnit( cur, qid, worker, error, maxattempts ):
+    '''Put the unit back in the queue, or fail it if out of attempts.'''
+    sql = '''update {} set
+        status = case when attempts < %s then 'pending' else 'failed' end,
+        error = %s, finished = now()
+        where id = %s and worker = %s'''.format(QUEUE_TABLE)
+    cur.execute( sql, (maxattempts, error, qid, worker) )
+
+
+class Heartbeat(threading.Thread):
+    """
+    Class Heartbeat
+
+    Thread that keeps the lease on a unit alive while the worker is
+    processing it, using its own database connection.
+    """
+
+    def __init__(self, qid, worker, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._qid = qid
+        self._worker = worker
+        self._interval = interval
+        self._done = threading.Event()
+
+    def run(self):
+        conn, cur = getDatabase()
+        sql = 'update {} set heartbeat = now() where id = %s and worker = %s'.format(QUEUE_TABLE)
+        while not self._done.wait( self._interval ):
+            try:
+                cur.execute( sql, (self._qid, self._worker) )
+            except Exception, e:
+                print "WARNING: heartbeat for unit {} failed: {}".format(self._qid, str(e))
+        conn.close()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def runWorker( job, localParams, maxunits, wait, heartbeat, maxattempts ):
+    '''
+    runWorker( job, localParams, maxunits, wait, heartbeat, maxattempts )
+        job         - only work on this job, or None for any job
+        localParams - machine specific parameters like ram and nproc
+        maxunits    - stop after this many units, 0 for no limit
+        wait        - keep polling when the queue is empty instead of exiting
+        heartbeat   - seconds between heartbeats
+        maxattempts - number of times a unit is tried before it fails
+
+    Lease units, segment and load them, then release them until there
+    is no more work. Returns the number of units done.
+    '''
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    tabletmpl = CONFIG.get('seg.table', 'segments.y{0}_{1}')
+    stale = 4 * heartbeat
+
+    conn, cur = getDatabase()
+    createQueueTable( cur )
+
+    print "Worker {} started".format(worker)
+    ndone = 0
+    while maxunits == 0 or ndone < maxunits:
+        row = leaseUnit( cur, worker, job, stale, maxattempts )
+        if row is None:
+            if not wait:
+                break
+            time.sleep( heartbeat )
+            continue
+
+        qid, ujob, year, unittype, unit, params = row
+        params = json.loads( params )
+        params.update( localParams )
+        table = tabletmpl.format(year, ujob)
+        print "Worker {} leased {} unit {} of job {}".format(worker, unittype, unit, ujob)
+
+        hb = Heartbeat( qid, worker, heartbeat )
+        hb.start()
+        t0 = time.time()
+        try:
+            # segmentUnit() allocates its tmpdir once it knows the files
+            nsegs, times = segmentUnit( year, unittype, unit, params, table,
+                                        getTmpdirs(), 'tmp-{}'.format(os.getpid()) )
+            hb.stop()
+            finishUnit( cur, qid, worker, nsegs, time.time() - t0 )
+            print "Worker {} finished unit {} with {} segments in {:.1f} sec".format(
+                worker, unit, nsegs, time.time() - t0)
+        except (Exception, SystemExit), e:
+            hb.stop()
+            traceback.print_exc()
+            failUnit( cur, qid, worker, str(e) or e.__class__.__name__, maxattempts )
+            print "ERROR: worker {} failed unit {}: {}".format(worker, unit, str(e))
+        ndone += 1
+
+    conn.close()
+    print "Worker {} done after {} units".format(worker, ndone)
+
+    return ndone
+
+
+def reportQueueStatus( job ):
+    '''Print the progress of the queue by job and status.'''
+    conn, cur = getDatabase()
+    createQueueTable( cur )
+
+    where = ''
+    args = []
+    if not job is None:
+        where = 'where job = %s'
+        args = [job]
+
+    sql = '''select job, status, count(*), coalesce(sum(nsegs), 0),
+        avg(seconds), max(attempts)
+        from {} {} group by job, status order by job, status'''.format(QUEUE_TABLE, where)
+    cur.execute( sql, args )
+    rows = cur.fetchall()
+
+    print '        Job         |  Status  |  Units |    Segments  | Avg sec | Tries '
+    print '--------------------+----------+--------+--------------+---------+-------'
+    for row in rows:
+        print ' {0:18s} | {1:8s} | {2:6d} | {3:12,d} | {4:7.0f} | {5:5d} '.format(
+            row[0], row[1], row[2], row[3], row[4] or 0.0, row[5])
+    print '--------------------+----------+--------+--------------+---------+-------'
+
+    sql = '''select worker, job, unit, extract(epoch from now() - heartbeat)
+        from {} where status = 'leased' {} order by worker'''.format(
+            QUEUE_TABLE, '' if job is None else 'and job = %s')
+    cur.execute( sql, args )
+    leased = cur.fetchall()
+    if len(leased) > 0:
+        print
+        print 'Active workers:'
+        for row in leased:
+            print '    {0:24s} {1:s} unit {2:s} heartbeat {3:.0f} sec ago'.format(*row)
+
+    # estimate the time left from the average time per unit
+    sql = '''select count(*) filter (where status in ('pending', 'leased')),
+        avg(seconds) filter (where status = 'done')
+        from {} {}'''.format(QUEUE_TABLE, where)
+    cur.execute( sql, args )
+    left, avgsec = cur.fetchone()
+    if left > 0 and not avgsec is None:
+        eta = left * avgsec / max(1, len(leased))
+        print
+        print 'Units left: {}, ETA: {:.1f} hours with {} workers'.format(
+            left, eta / 3600.0, max(1, len(leased)))
+
+    conn.close()
+
+
+def retryFailed( job ):
+    '''Put the failed units back in the queue.'''
+    conn, cur = getDatabase()
+    sql = '''update {} set status = 'pending', attempts = 0
+        where status = 'failed' '''.format(QUEUE_TABLE)
+    args = []
+    if not job is None:
+        sql += ' and job = %s'
+        args = [job]
+    cur.execute( sql, args )
+    print "Requeued {} failed units".format(cur.rowcount)
+    conn.close()
+
+
+def Usage():
+    print '''
+Usage: ror_cli segment-worker options
+    [--enqueue]             - add the units of --area to the queue for --job
+       [-a|--area fips|bbox]   - area of interest to queue
+       [-u|--unit cousub|doqq] - split the area into cousubs or DOQQs
+                                 default: cousub
+       [--changed]             - only queue the units whose DOQQs or
+                                 parameters changed since they were loaded
+       [-y|--year yyyy]        - select year to process
+       [-s|--spatialr int]     - spatial radius of neigborhood in pixels
+       [-r|--ranger float]     - radiometric radius in multi-spectral space
+       [-m|--minsize int]      - minimum segment size in pixels
+       [-d|--delete]           - delete segments smaller than minsize
+       [-t|--thresh float]     - convergence threshold
+       [-p|--rangeramp float]  - range radius coefficient
+       [-i|--max-iter int]     - max interation during convergence
+       [-T|--tilesize int]     - size of tiles in pixels
+       [--tiled doqq|int]      - segment each unit in tiles
+       [--overlap int]         - pixels of overlap between tiles
+    [--status]              - report the progress of the queue
+    [--retry]               - put failed units back in the queue
+    [-j|--job name]         - job to queue, or only work on this job
+    [-R|--ram int(MB)]      - available ram for processing on this node
+    [-n|--nproc int]        - processes for tiled segmentation, 0=all cpus
+    [-x|--max-units int]    - stop after this many units
+    [--wait]                - wait for more work when the queue is empty
+    [--heartbeat int]       - seconds between heartbeats, default: 30
+    [--attempts int]        - tries before a unit fails, default: 3
+    [--inmemory]            - connect the OTB applications in memory
+    [--cache]               - use the stage cache
+    [--autotune]            - pick ram, tile sizes and threads on this node
+    [--debug]               - do not remove tmp files
+    Without --enqueue, --status or --retry this runs a worker.
+    '''
+    sys.exit(2)
+
+
+def SegmentWorker( argv ):
+    '''
+    SegmentWorker( argv )
+
+    Public interface called by ror_cli.py
+    '''
+    try:
+        opts, args = getopt.getopt(argv, 'ha:u:y:s:r:m:dt:p:i:T:j:R:n:x:',
+            ['help', 'enqueue', 'status', 'retry', 'area=', 'unit=', 'year=',
+             'spatialr=', 'ranger=', 'minsize=', 'delete', 'thresh=',
+             'rangeramp=', 'max-iter=', 'tilesize=', 'tiled=', 'overlap=',
+             'job=', 'ram=', 'nproc=', 'max-units=', 'wait', 'heartbeat=',
+             'attempts=', 'changed', 'inmemory', 'cache', 'autotune', 'debug'])
+    except getopt.GetoptError:
+        print 'ERROR in segment-worker options!'
+        print 'args:', argv
+        return True
+
+    area      = CONFIG.get('areaOfInterest', None)
+    year      = CONFIG.get('year', None)
+    params    = { 'spatialr':  CONFIG.get('seg.spatialr', None),
+                  'ranger':    CONFIG.get('seg.ranger', None),
+                  'minsize':   CONFIG.get('seg.minsize', None),
+                  'delete':    False,
+                  'thresh':    CONFIG.get('seg.thresh', None),
+                  'rangeramp': CONFIG.get('seg.rangeramp', None),
+                  'maxiter':   CONFIG.get('seg.max-iter', None),
+                  'tilesize':  CONFIG.get('seg.tilesize', None),
+                  'tiled':     CONFIG.get('seg.tiled', None),
+                  'overlap':   CONFIG.get('seg.overlap', 128) }
+    local     = { 'ram':       CONFIG.get('seg.ram', None),
+                  'nproc':     CONFIG.get('nproc', 1),
+                  'inmemory':  CONFIG.get('seg.inmemory', False),
+                  'cache':     CONFIG.get('seg.cache', False),
+                  'autotune':  CONFIG.get('seg.autotune', False),
+                  'debug':     False }
+    unittype  = 'cousub'
+    changed   = False
+    job       = None
+    mode      = 'work'
+    maxunits  = 0
+    wait      = False
+    heartbeat = 30
+    attempts  = 3
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            Usage()
+        elif opt in ('--enqueue', '--status', '--retry'):
+            mode = opt[2:]
+        elif opt in ('-a', '--area'):
+            area = arg
+        elif opt in ('-u', '--unit'):
+            if not arg in UNIT_TYPES:
+                print "\nERROR: -u|--unit must be one of {}!".format('|'.join(UNIT_TYPES))
+                Usage()
+            unittype = arg
+        elif opt in ('-y', '--year'):
+            year = str(int(arg))
+        elif opt in ('-s', '--spatialr'):
+            params['spatialr'] = int(arg)
+        elif opt in ('-r', '--ranger'):
+            params['ranger'] = float(arg)
+        elif opt in ('-m', '--minsize'):
+            params['minsize'] = int(arg)
+        elif opt in ('-d', '--delete'):
+            params['delete'] = True
+        elif opt in ('-t', '--thresh'):
+            params['thresh'] = float(arg)
+        elif opt in ('-p', '--rangeramp'):
+            params['rangeramp'] = float(arg)
+        elif opt in ('-i', '--max-iter'):
+            params['maxiter'] = int(arg)
+        elif opt in ('-T', '--tilesize'):
+            params['tilesize'] = int(arg)
+        elif opt == '--tiled':
+            params['tiled'] = arg
+        elif opt == '--overlap':
+            params['overlap'] = int(arg)
+        elif opt in ('-j', '--job'):
+            job = arg
+        elif opt in ('-R', '--ram'):
+            local['ram'] = int(arg)
+        elif opt in ('-n', '--nproc'):
+            local['nproc'] = int(arg)
+        elif opt in ('-x', '--max-units'):
+            maxunits = int(arg)
+        elif opt == '--wait':
+            wait = True
+        elif opt == '--changed':
+            changed = True
+        elif opt == '--heartbeat':
+            heartbeat = max(1, int(arg))
+        elif opt == '--attempts':
+            attempts = max(1, int(arg))
+        elif opt == '--inmemory':
+            local['inmemory'] = True
+        elif opt == '--cache':
+            local['cache'] = True
+        elif opt == '--autotune':
+            local['autotune'] = True
+        elif opt == '--debug':
+            local['debug'] = True
+
+    if mode == 'status':
+        reportQueueStatus( job )
+        return False
+
+    if mode == 'retry':
+        retryFailed( job )
+        return False
+
+    if mode == 'enqueue':
+        chkargs = dict(params)
+        chkargs.update({ 'area': area, 'year': year, 'job': job })
+        err = False
+        for k in chkargs:
+            if chkargs[k] is None and not k in ('tiled',):
+                err = True
+                print "ERROR: '{}' is not defined!".format(k)
+        if err:
+            print "Please define them in the config file or as args!"
+            Usage()
+
+        enqueueUnits( job, year, area, unittype,
+                      dict([(k, params[k]) for k in QUEUE_PARAMS]), changed )
+        return False
+
+    if local['ram'] is None:
+        print "ERROR: 'ram' is not defined!"
+        Usage()
+
+    runWorker( job, local, maxunits, wait, heartbeat, attempts )
+
+    return False
@@ -0,0 +1,261 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import math
+import time
+from multiprocessing import Pool
+from osgeo import gdal, ogr
+
+from utils import getNumCpus, unique
+from lsms import smoothing, segmentit, mergesmall, vectorize
+from polygonstats import addShapefileStats
+from tmpalloc import allocateTmpdir, releaseTmpdir
+from segplan import estimateStageBytes
+from config import *
+
+# smallest ram in MB we will give a single sweep run
+MIN_SWEEP_RAM = 1024
+
+
+def parseSweepArg( arg, conv ):
+    '''
+    parseSweepArg( arg, conv )
+        arg  - comma separated list of values and/or start:stop:step
+               ranges where stop is included, eg: 8,12:24:4
+        conv - int or float to convert the values with
+
+    Returns the sorted list of unique values.
+    '''
+    values = []
+    for part in arg.split(','):
+        if ':' in part:
+            r = [conv(x) for x in part.split(':')]
+            if len(r) == 2:
+                r.append(conv(1))
+            if len(r) != 3 or r[2] <= 0:
+                raise ValueError("bad range '{}'".format(part))
+            # count the steps so float ranges keep stop and do not drift
+            n = int(math.floor((r[1] - r[0]) / r[2] + 1e-9))
+            for i in range(n + 1):
+                v = r[0] + i * r[2]
+                values.append( round(v, 9) if conv is float else v )
+        else:
+            values.append(conv(part))
+    return sorted(unique(values))
+
+
+def runSweepTask( task ):
+    '''
+    runSweepTask( task )
+
+    Pool worker that runs one node of the sweep tree. The task is a
+    dictionary with 'stage' of smoothing, segmentation or vectorization,
+    the file names it reads and writes and the parameters it needs.
+    Returns (task, seconds, error) where error is None on success.
+    '''
+    t0 = time.time()
+    p = task['params']
+    try:
+        if task['stage'] == 'smoothing':
+            smoothing(task['in'], task['smooth'], task['smoothpos'],
+                      task['spatialr'], task['ranger'], p['rangeramp'],
+                      p['thresh'], p['maxiter'], p['ram'])
+
+        elif task['stage'] == 'segmentation':
+            segmentit(task['smooth'], task['smoothpos'], task['segs'],
+                      task['spatialr'], task['ranger'], task['minsize1'],
+                      p['tilesize'], task['tmpdir'])
+
+        else:
+            fmerged = task['segs']
+            if not p.get('delete', False):
+                fmerged = task['merged']
+                mergesmall(task['smooth'], task['segs'], fmerged,
+                           task['minsize'], p['tilesize'])
+            vectorize(task['smooth'], fmerged, task['shp'], p['tilesize'])
+            addShapefileStats( task['shp'] )
+
+            ds = ogr.Open( task['shp'] )
+            task['count'] = ds.GetLayer().GetFeatureCount()
+            ds = None
+
+            if not p.get('debug', False) and fmerged != task['segs']:
+                os.remove( fmerged )
+
+    except Exception, e:
+        return (task, time.time() - t0, str(e))
+
+    return (task, time.time() - t0, None)
+
+
+def _sweepName( hs, hr, m ):
+    name = 'hs{}-hr{:g}'.format(hs, hr)
+    if not m is None:
+        name += '-m{}'.format(m)
+    return name
+
+
+def sweepSegmentation( fin, outdir, job, tmpdirs, prefix, params,
+                       spatialrs, rangers, minsizes, nproc ):
+    '''
+    sweepSegmentation( fin, outdir, job, tmpdirs, prefix, params,
+                       spatialrs, rangers, minsizes, nproc )
+        fin       - input image or vrt to segment
+        outdir    - directory for the shapefiles and the summary
+        job       - job name used to name the outputs
+        tmpdirs   - list of tmp dirs, each (hs, hr) gets the least loaded one
+        prefix    - prefix for the tmp file names, eg: tmp-1234
+        params    - dictionary of segmentation parameters, see runLSMS()
+        spatialrs - list of spatialr (hs) values to try
+        rangers   - list of ranger (hr) values to try
+        minsizes  - list of minsize (M) values to try
+        nproc     - max number of runs at the same time, 0=all cpus
+
+    Segment fin with every combination of the parameters. The runs are
+    scheduled as a tree so each (hs, hr) smoothing runs once and all the
+    minsize variants reuse it, and in merge mode also share a single
+    segmentation. A child is started as soon as its parent is done and
+    at most nproc runs with params['ram'] split between them go at once.
+    The tmpdir of each (hs, hr) is allocated up front for all of its
+    rasters, see allocateTmpdir(), and released when the sweep is done.
+
+    Writes <job>-hs<hs>-hr<hr>-m<M>.shp for each combination and a
+    <job>-summary.csv of segment counts and stage times into outdir and
+    returns the summary rows.
+    '''
+    delete = params.get('delete', False)
+    debug = params.get('debug', False)
+
+    if nproc == 0:
+        nproc = getNumCpus()
+    njobs = max(1, min(nproc, params['ram'] / MIN_SWEEP_RAM))
+    tparams = dict(params)
+    tparams['ram'] = max(MIN_SWEEP_RAM, params['ram'] / njobs)
+
+    if not os.path.exists( outdir ):
+        os.makedirs( outdir )
+
+    ncombo = len(spatialrs) * len(rangers) * len(minsizes)
+    print "Sweeping {} combinations with {} runs at a time ...".format(ncombo, njobs)
+
+    # tmp rasters of one (hs, hr), in delete mode every minsize has its
+    # own segmentation, in merge mode its own merged raster of which up to
+    # njobs exist at once
+    ds = gdal.Open( fin )
+    mpix = ds.RasterXSize * ds.RasterYSize / 1.0e6
+    bands = ds.RasterCount
+    ds = None
+    stagebytes = estimateStageBytes( mpix, bands, params, None )
+    branchbytes = stagebytes['smoothing'] + \
+                  stagebytes['merging'] * (1 if delete else min(len(minsizes), njobs)) + \
+                  stagebytes['segmentation'] * (len(minsizes) if delete else 1)
+
+    pool = Pool( njobs )
+    pending = []
+    tmpfiles = []
+    allocs = []
+    summary = []
+    failed = 0
+
+    def submit( task ):
+        pending.append( pool.apply_async( runSweepTask, (task,) ) )
+
+    for hs in spatialrs:
+        for hr in rangers:
+            # our own allocations never finish while we wait, so no waiting
+            name = '{}-{}'.format(prefix, _sweepName(hs, hr, None))
+            allocs.append( allocateTmpdir( branchbytes, name, tmpdirs, 0, name + '-' ) )
+            tmpdir = allocs[-1]['tmpdir']
+            base = os.path.join( tmpdir, name )
+            task = { 'stage': 'smoothing', 'in': fin, 'params': tparams,
+                     'spatialr': hs, 'ranger': hr, 'tmpdir': tmpdir,
+                     'smooth': base + '-smooth.tif',
+                     'smoothpos': base + '-smoothpos.tif',
+                     'times': {} }
+            tmpfiles.extend( [task['smooth'], task['smoothpos']] )
+            submit( task )
+
+    while len(pending) > 0:
+        time.sleep( 1 )
+        for r in [r for r in pending if r.ready()]:
+            pending.remove( r )
+            task, secs, error = r.get()
+            name = _sweepName( task['spatialr'], task['ranger'], task.get('minsize') )
+            if not error is None:
+                print "ERROR: sweep {} {} failed: {}".format(task['stage'], name, error)
+                failed += 1
+                continue
+
+            print "Sweep {} {} done in {:.1f} sec".format(task['stage'], name, secs)
+            times = dict(task['times'])
+            times[task['stage']] = secs
+
+            if task['stage'] == 'smoothing':
+                # in merge mode every minsize shares one segmentation
+                for m in (minsizes if delete else [0]):
+                    child = dict(task)
+                    child['stage'] = 'segmentation'
+                    child['minsize1'] = m
+                    child['segs'] = task['smooth'].replace( '-smooth.tif',
+                                        '-m{}-segs.tif'.format(m) )
+                    child['times'] = times
+                    tmpfiles.append( child['segs'] )
+                    submit( child )
+
+            elif task['stage'] == 'segmentation':
+                for m in ([task['minsize1']] if delete else minsizes):
+                    child = dict(task)
+                    child['stage'] = 'vectorization'
+                    child['minsize'] = m
+                    child['merged'] = task['segs'].replace( '-segs.tif',
+                                          '-{}-merged.tif'.format(m) )
+                    child['shp'] = os.path.join( outdir, '{}-{}.shp'.format(
+                                          job, _sweepName(task['spatialr'], task['ranger'], m)) )
+                    child['times'] = times
+                    submit( child )
+
+            else:
+                summary.append( [task['spatialr'], task['ranger'], task['minsize'],
+                    task['count'], times.get('smoothing', 0.0),
+                    times.get('segmentation', 0.0), secs, task['shp']] )
+
+    pool.close()
+    pool.join()
+
+    if not debug:
+        for f in tmpfiles:
+            if os.path.exists( f ):
+                os.remove( f )
+    for alloc in allocs:
+        releaseTmpdir( alloc )
+
+    summary.sort()
+    fsummary = os.path.join( outdir, '{}-summary.csv'.format(job) )
+    fh = open( fsummary, 'wb' )
+    fh.write( 'spatialr,ranger,minsize,segments,smoothing,segmentation,vectorization,shapefile\n' )
+    for row in summary:
+        fh.write( '{},{:g},{},{},{:.1f},{:.1f},{:.1f},{}\n'.format(*row) )
+    fh.close()
+
+    print
+    print "  Hs  |   Hr   |   M   |  Segments  | Smooth | Segment | Vector "
+    print "------+--------+-------+------------+--------+---------+--------"
+    for row in summary:
+        print " {0:4d} | {1:6g} | {2:5d} | {3:10,d} | {4:6.0f} | {5:7.0f} | {6:6.0f} ".format(*row[:7])
+    print "------+--------+-------+------------+--------+---------+--------"
+    print "Summary written to {}".format(fsummary)
+    if failed > 0:
+        print "WARNING: {} sweep runs failed!".format(failed)
+
+    return summary
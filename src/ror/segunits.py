@@ -0,0 +1,367 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import math
+import time
+import json
+import hashlib
+from osgeo import gdal
+
+from utils import getDatabase, runCommand, getNumCpus
+from segmentation import getDoqqsForArea, createVrtForFiles
+from lsms import runLSMS
+from tiledsegmentation import runTiledSegmentation, removeShapefile, QQ_DEG
+from polygonstats import addShapefileStats
+from segmentloader import appendShapefileCopy, splitTableName
+from tuning import recordStageTimes
+from segplan import estimateStageBytes
+from tmpalloc import allocateTmpdir, releaseTmpdir
+from config import *
+
+'''
+A unit is a piece of an area of interest that can be segmented on its
+own and loaded into the job table without touching the other units.
+A unit is either a cousub FIPS code or a DOQQ name like
+m_3411701_ne_11_1_20140604. Each unit owns the segments whose centroid
+is in the cousub geometry or in the quarter quadrangle cell of the DOQQ.
+'''
+
+UNIT_TYPES = ('cousub', 'doqq')
+
+# degrees of neighboring DOQQs to include around a DOQQ unit
+DOQQ_CONTEXT = 0.005
+
+# table with the inputs each unit of a job table was segmented from
+UNIT_STATE_TABLE = 'segments.unitstate'
+
+# segmentation parameters that change the segments of a unit, the
+# ram, tile sizes and threads only change how fast we get them
+SIGNATURE_PARAMS = ['spatialr', 'ranger', 'minsize', 'delete', 'thresh',
+                    'rangeramp', 'maxiter', 'tiled', 'overlap']
+
+
+def getUnitsForArea( year, area, unittype ):
+    '''Return the list of units of unittype that cover area.'''
+    if unittype == 'doqq':
+        files = getDoqqsForArea( year, area )
+        return sorted( [os.path.basename(f)[:-4] for f in files] )
+
+    conn, cur = getDatabase()
+    sql = 'select geoid from census.cousub where geoid like %s order by geoid'
+    cur.execute( sql, (area + '%',) )
+    units = [row[0] for row in cur]
+    conn.close()
+
+    return units
+
+
+def getQQCell( cur, year, unit ):
+    '''
+    getQQCell( cur, year, unit )
+
+    Return [xmin, ymin, xmax, ymax] of the quarter quadrangle cell of a
+    DOQQ. The DOQQ footprints overlap their neighbors, so we snap the
+    footprint centroid to the quarter quad grid to get cells that do not.
+    '''
+    sql = '''select st_x(st_centroid(geom)), st_y(st_centroid(geom))
+        from naipbbox{0} where filename like %s limit 1'''.format(year)
+    cur.execute( sql, (unit + '%',) )
+    row = cur.fetchone()
+    if row is None:
+        raise RuntimeError("DOQQ unit {} not found in naipbbox{}!".format(unit, year))
+
+    x = math.floor(row[0] / QQ_DEG) * QQ_DEG
+    y = math.floor(row[1] / QQ_DEG) * QQ_DEG
+
+    return [x, y, x + QQ_DEG, y + QQ_DEG]
+
+
+def getUnitGeometry( cur, year, unittype, unit ):
+    '''
+    getUnitGeometry( cur, year, unittype, unit )
+
+    Return (sql, args) of an sql expression for the geometry that owns
+    the segments of the unit.
+    '''
+    srid = CONFIG.get('naip.projection', 'EPSG:4326').split(':')[-1]
+    if unittype == 'cousub':
+        sql = '(select geom from census.cousub where geoid = %s limit 1)'
+        return (sql, [unit])
+
+    sql = 'st_makeenvelope(%s, %s, %s, %s, {})'.format(int(srid))
+    return (sql, getQQCell( cur, year, unit ))
+
+
+def getUnitFiles( year, unittype, unit, geomargs ):
+    '''
+    getUnitFiles( year, unittype, unit, geomargs )
+
+    Return the DOQQ files that are segmented for the unit. For a DOQQ
+    unit these include the neighbors around it for context, geomargs is
+    its quarter quad cell from getUnitGeometry().
+    '''
+    if unittype == 'cousub':
+        return getDoqqsForArea( year, unit )
+
+    x0, y0, x1, y1 = geomargs
+    d = DOQQ_CONTEXT
+    area = '{0:.6f},{1:.6f},{2:.6f},{3:.6f}'.format(x0-d, y0-d, x1+d, y1+d)
+    return getDoqqsForArea( year, area )
+
+
+def getFileStates( files ):
+    '''Return [path, size, mtime] of each file, sorted by path.'''
+    states = []
+    for f in sorted( files ):
+        st = os.stat( f )
+        states.append( [f, st.st_size, int(st.st_mtime)] )
+    return states
+
+
+def unitSignature( filestates, params ):
+    '''Return a signature of the inputs and parameters of a unit.'''
+    sparams = [[k, params.get(k)] for k in SIGNATURE_PARAMS]
+    return hashlib.sha1( repr([filestates, sparams]) ).hexdigest()
+
+
+def createUnitStateTable( cur ):
+    cur.execute('''create table if not exists {} (
+        segtable text not null,
+        unit text not null,
+        unittype text not null,
+        year text not null,
+        signature text not null,
+        files text,
+        params text,
+        nsegs integer,
+        seconds float8,
+        updated timestamp default now(),
+        primary key (segtable, unit))'''.format(UNIT_STATE_TABLE))
+
+
+def getUnitStates( cur, table ):
+    '''Return a dictionary of unit: signature for the units of table.'''
+    createUnitStateTable( cur )
+    sql = 'select unit, signature from {} where segtable = %s'.format(UNIT_STATE_TABLE)
+    cur.execute( sql, (table,) )
+    return dict([(row[0], row[1]) for row in cur])
+
+
+def saveUnitState( cur, table, year, unittype, unit, signature, filestates,
+                   params, nsegs, seconds ):
+    createUnitStateTable( cur )
+    sql = '''insert into {} (segtable, unit, unittype, year, signature, files,
+            params, nsegs, seconds, updated)
+        values (%s, %s, %s, %s, %s, %s, %s, %s, %s, now())
+        on conflict (segtable, unit) do update set
+            unittype = excluded.unittype, year = excluded.year,
+            signature = excluded.signature, files = excluded.files,
+            params = excluded.params, nsegs = excluded.nsegs,
+            seconds = excluded.seconds, updated = now()'''.format(UNIT_STATE_TABLE)
+    sparams = dict([(k, params.get(k)) for k in SIGNATURE_PARAMS])
+    cur.execute( sql, (table, unit, unittype, year, signature,
+                       json.dumps(filestates), json.dumps(sparams),
+                       nsegs, seconds) )
+
+
+def removeVrt( fvrt ):
+    for f in (fvrt, fvrt + '.in', fvrt + '.vrt', fvrt + '.aux.xml'):
+        if os.path.exists( f ):
+            os.remove( f )
+
+
+def estimateUnitTmpBytes( files, unittype, geomargs, params ):
+    '''
+    estimateUnitTmpBytes( files, unittype, geomargs, params )
+
+    Return the tmp bytes of the LSMS chain over a unit with the DOQQ
+    files from getUnitFiles(), see estimateStageBytes(). A DOQQ unit is
+    its cell plus the overlap, a cousub unit all of its files. Tiled
+    runs allocate a tmpdir per tile, so they need none here.
+    '''
+    if len(files) == 0 or not params.get('tiled') is None:
+        return 0
+
+    if unittype == 'cousub':
+        mpix = 0.0
+        for f in files:
+            ds = gdal.Open( f )
+            if not ds is None:
+                mpix += ds.RasterXSize * ds.RasterYSize / 1.0e6
+            ds = None
+    else:
+        x0, y0, x1, y1 = geomargs
+        ds = gdal.Open( files[0] )
+        gt = ds.GetGeoTransform()
+        ds = None
+        overlap = 2 * params.get('overlap', 128)
+        mpix = ((x1 - x0) / abs(gt[1]) + overlap) * ((y1 - y0) / abs(gt[5]) + overlap) / 1.0e6
+
+    return sum(estimateStageBytes( mpix, 4, params, None ).values())
+
+
+def segmentUnit( year, unittype, unit, params, table, tmpdirs, prefix ):
+    '''
+    segmentUnit( year, unittype, unit, params, table, tmpdirs, prefix )
+        year     - naip year to segment
+        unittype - 'cousub' or 'doqq'
+        unit     - cousub FIPS code or DOQQ name
+        params   - dictionary of segmentation parameters, see runLSMS(),
+                   plus tiled, overlap and nproc for tiled segmentation
+        table    - job table to replace the segments of the unit in
+        tmpdirs  - tmpdirs to allocate the tmp files in, see getTmpdirs()
+        prefix   - prefix for the tmp file names, eg: tmp-1234
+
+    Segment a single unit, add the polygon stats and replace its rows in
+    table. The tmpdir is allocated for the bytes of the unit once its
+    files are known, see estimateUnitTmpBytes(), and raises RuntimeError
+    if no tmpdir has room. The signature of the unit inputs and
+    parameters is saved in UNIT_STATE_TABLE so later runs can skip it if
+    nothing changed. Returns (number of segments kept, dictionary of
+    stage times).
+    '''
+    verbose = CONFIG.get('verbose', False)
+    epsg = CONFIG.get('naip.projection', 'EPSG:4326')
+    debug = params.get('debug', False)
+
+    t0 = time.time()
+    conn, cur = getDatabase()
+    geomsql, geomargs = getUnitGeometry( cur, year, unittype, unit )
+    conn.close()
+
+    files = getUnitFiles( year, unittype, unit, geomargs )
+    filestates = getFileStates( files )
+    signature = unitSignature( filestates, params )
+
+    unitprefix = '{}-{}'.format(prefix, unit)
+    alloc = allocateTmpdir( estimateUnitTmpBytes( files, unittype, geomargs, params ),
+                            'unit {} {}'.format(unittype, unit), tmpdirs,
+                            prefix=unitprefix + '-' )
+    try:
+        tmpdir  = alloc['tmpdir']
+        fvrt    = os.path.join(tmpdir, unitprefix + '-unit.vrt')
+        fcrop   = os.path.join(tmpdir, unitprefix + '-crop.vrt')
+        fsegshp = os.path.join(tmpdir, unitprefix + '-segments.shp')
+
+        createVrtForFiles( fvrt, files )
+
+        if unittype == 'cousub':
+            fin = fvrt
+        else:
+            # crop the context down to the overlap around the cell
+            x0, y0, x1, y1 = geomargs
+            ds = gdal.Open( fvrt )
+            d = params.get('overlap', 128) * abs(ds.GetGeoTransform()[1])
+            ds = None
+            cmd = ['gdal_translate', '-of', 'VRT', '-projwin', str(x0-d), str(y1+d),
+                   str(x1+d), str(y0-d), fvrt, fcrop]
+            runCommand( cmd, verbose )
+            fin = fcrop
+
+        if params.get('tiled') is None:
+            times = runLSMS( fin, fsegshp, tmpdir, unitprefix, params )
+        else:
+            times = runTiledSegmentation( fin, fsegshp, tmpdirs, unitprefix, params,
+                        params['tiled'], params.get('overlap', 128),
+                        params.get('nproc', 1) )
+            if times is None:
+                raise RuntimeError("tiled segmentation of unit {} failed!".format(unit))
+
+        t1 = time.time()
+        addShapefileStats( fsegshp, params.get('nproc', 1) )
+        times['stats'] = time.time() - t1
+
+        t1 = time.time()
+        kept = appendShapefileCopy( fsegshp, table, epsg, unit, geomsql, geomargs )
+        times['load'] = time.time() - t1
+
+        # the inputs are recorded from before we read them, so a file that
+        # changed while we worked on it makes the unit change again
+        conn, cur = getDatabase()
+        saveUnitState( cur, table, year, unittype, unit, signature, filestates,
+                       params, kept, time.time() - t0 )
+        conn.close()
+
+        workers = 1 if params.get('tiled') is None else (params.get('nproc') or getNumCpus())
+        recordStageTimes( fin, times, workers,
+                          params.get('threads') or max(1, getNumCpus() / workers), fsegshp )
+
+        if not debug:
+            removeVrt( fvrt )
+            removeVrt( fcrop )
+            removeShapefile( fsegshp )
+    finally:
+        releaseTmpdir( alloc )
+
+    return (kept, times)
+
+
+def getChangedUnits( year, area, unittype, table, params ):
+    '''
+    getChangedUnits( year, area, unittype, table, params )
+
+    Return the units of area whose input files or segmentation parameters
+    changed since they were loaded into table, or were never loaded.
+    '''
+    conn, cur = getDatabase()
+    states = getUnitStates( cur, table )
+
+    changed = []
+    for unit in getUnitsForArea( year, area, unittype ):
+        if not unit in states:
+            changed.append( unit )
+            continue
+        geomsql, geomargs = getUnitGeometry( cur, year, unittype, unit )
+        files = getUnitFiles( year, unittype, unit, geomargs )
+        if unitSignature( getFileStates( files ), params ) != states[unit]:
+            changed.append( unit )
+    conn.close()
+
+    return changed
+
+
+def segmentChangedUnits( year, area, unittype, table, params, tmpdirs, prefix, dryrun=False ):
+    '''
+    segmentChangedUnits( year, area, unittype, table, params, tmpdirs, prefix, dryrun=False )
+
+    Segment only the units of area that changed, see getChangedUnits(),
+    and replace their rows in table. With dryrun just list them.
+    Returns the number of units segmented.
+    '''
+    schema, name = splitTableName( table )
+    conn, cur = getDatabase()
+    sql = '''select column_name from information_schema.columns
+        where table_schema = %s and table_name = %s'''
+    cur.execute( sql, (schema, name) )
+    columns = [row[0] for row in cur]
+    conn.close()
+    if len(columns) > 0 and not 'unit' in columns:
+        print "ERROR: {} was not segmented by units, drop it or use a new job!".format(table)
+        return 0
+
+    changed = getChangedUnits( year, area, unittype, table, params )
+    print "{} {} units changed in {}".format(len(changed), unittype, area)
+    if dryrun:
+        for unit in changed:
+            print "  {}".format(unit)
+        return 0
+
+    n = 0
+    for unit in changed:
+        n += 1
+        print "Segmenting unit {} ({} of {}) ...".format(unit, n, len(changed))
+        kept, times = segmentUnit( year, unittype, unit, params, table, tmpdirs, prefix )
+        print "Unit {} done with {} segments in {:.1f} sec".format(unit, kept, sum(times.values()))
+
+    return n
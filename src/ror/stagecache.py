@@ -0,0 +1,287 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import socket
+import hashlib
+from contextlib import contextmanager
+from osgeo import gdal
+from config import *
+
+'''
+Content addressed cache for the outputs of the segmentation stages.
+
+Each stage output is stored in <seg.cachedir>/<key>/ where key is a sha1
+of the stage name, the key or signature of its input and the parameters
+that change its output. So jobs that share upstream stages with a
+previous job can reuse their outputs. The least recently used entries
+are evicted when the cache grows over seg.cachesize MB.
+
+An entry a job gets from or puts in the cache is pinned with a
+.pin-<host>-<pid> file in it until the job calls cacheUnpin(), so the
+smoothing a run still has to merge and vectorize and the entries other
+jobs are reading are never evicted. Pins of dead processes are ignored.
+'''
+
+CACHE_LOCK = '.lock'
+CACHE_PIN = '.pin-'
+
+# pins of other hosts older than this are ignored, we can not check if
+# their process still exists
+CACHE_PIN_HOURS = 24
+
+
+def getCacheDir():
+    home = CONFIG['projectHomeDir']
+    return os.path.join( home, CONFIG.get('seg.cachedir', 'data/cache') )
+
+
+def _getFileList( fin, seen ):
+    # expand vrt files into the files they reference
+    ds = gdal.Open( fin )
+    if ds is None:
+        return []
+    files = []
+    for f in ds.GetFileList() or []:
+        if f in seen:
+            continue
+        seen.add( f )
+        if f.lower().endswith('.vrt'):
+            files.extend( _getFileList( f, seen ) )
+        else:
+            files.append( f )
+    return files
+
+
+def inputSignature( fin ):
+    '''
+    inputSignature( fin )
+
+    Return a signature for an input image that is stable across runs.
+    The tmp vrt files we build change name every run so they are not
+    part of it, instead we use the image size, geotransform, band count
+    and the path, size and mtime of every real file it reads from.
+    '''
+    ds = gdal.Open( fin )
+    parts = [ds.RasterXSize, ds.RasterYSize, ds.RasterCount,
+             list(ds.GetGeoTransform())]
+    ds = None
+
+    # a vrt changes name every run, any other input is a real file
+    files = _getFileList( fin, set([fin]) )
+    if not fin.lower().endswith('.vrt'):
+        files.append( fin )
+
+    for f in sorted( set(files) ):
+        st = os.stat( f )
+        parts.append( [f, st.st_size, int(st.st_mtime)] )
+
+    return hashlib.sha1( repr(parts) ).hexdigest()
+
+
+def cacheKey( stage, *args ):
+    '''Return the cache key for stage given its input and parameters.'''
+    return hashlib.sha1( repr([stage] + list(args)) ).hexdigest()
+
+
+@contextmanager
+def _cacheLock():
+    # serializes pinning against eviction
+    cachedir = getCacheDir()
+    if not os.path.exists( cachedir ):
+        try:
+            os.makedirs( cachedir )
+        except OSError:
+            pass
+    fh = open( os.path.join( cachedir, CACHE_LOCK ), 'a' )
+    fcntl.flock( fh, fcntl.LOCK_EX )
+    try:
+        yield cachedir
+    finally:
+        fcntl.flock( fh, fcntl.LOCK_UN )
+        fh.close()
+
+
+def _pinName():
+    return '{}{}-{}'.format(CACHE_PIN, socket.gethostname(), os.getpid())
+
+
+def _pinAlive( path, pin ):
+    host, pid = pin[len(CACHE_PIN):].rsplit('-', 1)
+    if host == socket.gethostname():
+        try:
+            os.kill( int(pid), 0 )
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+    try:
+        return time.time() - os.path.getmtime( os.path.join( path, pin ) ) < CACHE_PIN_HOURS * 3600
+    except OSError:
+        return False
+
+
+def _isPinned( path ):
+    return len([f for f in os.listdir( path )
+                if f.startswith( CACHE_PIN ) and _pinAlive( path, f )]) > 0
+
+
+def _pin( path ):
+    open( os.path.join( path, _pinName() ), 'a' ).close()
+
+
+def cacheGet( key, names ):
+    '''
+    cacheGet( key, names )
+
+    Return the paths of the files in names for the cache entry key or
+    None if it is not in the cache. The entry is pinned until
+    cacheUnpin().
+    '''
+    with _cacheLock() as cachedir:
+        path = os.path.join( cachedir, key )
+        files = [os.path.join( path, n ) for n in names]
+        for f in files:
+            if not os.path.exists( f ):
+                return None
+
+        # mark it as recently used
+        try:
+            os.utime( path, None )
+        except OSError:
+            pass
+        _pin( path )
+
+    return files
+
+
+def cacheUnpin( keys ):
+    '''Remove the pins of this process from the cache entries keys.'''
+    cachedir = getCacheDir()
+    for key in keys:
+        try:
+            os.remove( os.path.join( cachedir, key, _pinName() ) )
+        except OSError:
+            pass
+
+
+def cachePut( key, files, names ):
+    '''
+    cachePut( key, files, names )
+        key   - cache key of the stage output
+        files - the files the stage wrote
+        names - names to store the files under in the cache entry
+
+    Move files into the cache and return their new paths, the entry is
+    pinned until cacheUnpin(). Then evict old entries if the cache is
+    over its size budget.
+    '''
+    cachedir = getCacheDir()
+    path = os.path.join( cachedir, key )
+    tmppath = path + '.tmp-' + str(os.getpid())
+
+    if not os.path.exists( tmppath ):
+        os.makedirs( tmppath )
+    for f, n in zip(files, names):
+        shutil.move( f, os.path.join( tmppath, n ) )
+
+    # rename is atomic so readers never see a partial entry,
+    # if another process already cached it we use that one
+    with _cacheLock():
+        try:
+            os.rename( tmppath, path )
+        except OSError:
+            shutil.rmtree( tmppath, True )
+        _pin( path )
+
+    cacheEvict( CONFIG.get('seg.cachesize', 102400), [key] )
+
+    return [os.path.join( path, n ) for n in names]
+
+
+def cacheEvict( budget, keep=[] ):
+    '''
+    cacheEvict( budget, keep=[] )
+        budget - cache size budget in MB
+        keep   - keys that must not be evicted
+
+    Remove the least recently used cache entries that are not pinned
+    until the cache is under the budget. Returns the number of MB freed.
+    '''
+    if not os.path.exists( getCacheDir() ):
+        return 0
+    with _cacheLock() as cachedir:
+        return _evict( cachedir, budget, keep )
+
+
+def _evict( cachedir, budget, keep ):
+    # call with the cache lock held
+    verbose = CONFIG.get('verbose', False)
+
+    entries = []
+    total = 0
+    for key in os.listdir( cachedir ):
+        path = os.path.join( cachedir, key )
+        if not os.path.isdir( path ) or '.tmp-' in key:
+            continue
+        size = 0
+        for f in os.listdir( path ):
+            size += os.path.getsize( os.path.join( path, f ) )
+        entries.append( [os.path.getmtime( path ), size, key] )
+        total += size
+
+    freed = 0
+    limit = budget * 1024 * 1024
+    for mtime, size, key in sorted( entries ):
+        if total <= limit:
+            break
+        if key in keep or _isPinned( os.path.join( cachedir, key ) ):
+            continue
+        if verbose:
+            print "Evicting cache entry {} ({} MB)".format(key, size/1048576)
+        shutil.rmtree( os.path.join( cachedir, key ), True )
+        total -= size
+        freed += size
+
+    return freed / 1048576
+
+
+def _test():
+    import tempfile
+    import numpy as np
+
+    # a tif rewritten in place must get a new signature
+    tmpdir = tempfile.mkdtemp()
+    ftif = os.path.join( tmpdir, 'test.tif' )
+    sigs = []
+    for v in (1, 2):
+        ds = gdal.GetDriverByName('GTiff').Create( ftif, 16, 16, 1, gdal.GDT_Byte )
+        ds.SetGeoTransform( [0, 1, 0, 0, 0, -1] )
+        ds.GetRasterBand(1).WriteArray( np.zeros((16, 16), dtype=np.uint8) + v )
+        ds = None
+        # the rewrite can be in the same second as the first write
+        os.utime( ftif, (v, v) )
+        sigs.append( inputSignature( ftif ) )
+    shutil.rmtree( tmpdir, True )
+
+    if sigs[0] == sigs[1]:
+        print 'ERROR: inputSignature() did not change when the tif changed!'
+    else:
+        print 'Unit tests passed!'
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,458 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import glob
+import math
+import time
+from multiprocessing import Pool
+from osgeo import gdal, ogr
+
+from utils import runCommand, getNumCpus, unique
+from lsms import runLSMS
+from tuning import autoTune, applyTuning
+from tmpalloc import allocateTmpdir, releaseTmpdir
+from segplan import estimateStageBytes
+from config import *
+
+# a DOQQ covers a 3.75 minute quarter quadrangle
+QQ_DEG = 0.0625
+
+# largest side in pixels of the coverage mask, see getCoverage()
+COVERAGE_SIZE = 1024
+
+
+def getPixelBreaks( n, tilesize ):
+    '''Return pixel offsets splitting n pixels into tiles of tilesize.'''
+    breaks = range(0, n, tilesize)
+    breaks.append(n)
+    return breaks
+
+
+def getDoqqBreaks( n, origin, res ):
+    '''
+    getDoqqBreaks( n, origin, res )
+        n      - number of pixels along this axis
+        origin - geotransform origin for this axis
+        res    - geotransform pixel size for this axis (negative for y)
+
+    Return pixel offsets where the quarter quadrangle grid lines cross
+    this axis so each tile lines up with the nominal extent of a DOQQ.
+    '''
+    lo = min(origin, origin + n*res)
+    hi = max(origin, origin + n*res)
+    breaks = [0, n]
+    k = int(math.floor(lo / QQ_DEG)) + 1
+    while k * QQ_DEG < hi:
+        p = int(round((k * QQ_DEG - origin) / res))
+        if 0 < p < n:
+            breaks.append(p)
+        k += 1
+    return sorted(unique(breaks))
+
+
+def getTileWindows( width, height, xbreaks, ybreaks, overlap ):
+    '''
+    getTileWindows( width, height, xbreaks, ybreaks, overlap )
+
+    Return a list of tiles. Each tile has a core [cx0, cy0, cx1, cy1] in
+    pixels, the cores partition the image, and a window (xoff, yoff,
+    xsize, ysize) which is the core expanded by overlap pixels.
+    '''
+    tiles = []
+    for j in range(len(ybreaks)-1):
+        for i in range(len(xbreaks)-1):
+            cx0, cx1 = xbreaks[i], xbreaks[i+1]
+            cy0, cy1 = ybreaks[j], ybreaks[j+1]
+            x0 = max(0, cx0 - overlap)
+            y0 = max(0, cy0 - overlap)
+            x1 = min(width, cx1 + overlap)
+            y1 = min(height, cy1 + overlap)
+            tiles.append({ 'n': len(tiles),
+                           'xoff': x0, 'yoff': y0,
+                           'xsize': x1 - x0, 'ysize': y1 - y0,
+                           'core': [cx0, cy0, cx1, cy1] })
+    return tiles
+
+
+def getCoverage( ds, size=COVERAGE_SIZE ):
+    '''
+    getCoverage( ds, size=COVERAGE_SIZE )
+
+    Return (mask, sx, sy), the mask of ds averaged down to at most size
+    pixels on a side and the pixels of ds per mask pixel in x and y.
+    GDAL reads it from the mask overviews when the DOQQs have them, eg:
+    the COGs of naip-process --cog, instead of from every pixel. The
+    average is read as float so a single pixel of data keeps it above 0,
+    but the overviews can still have lost a sliver of data at an edge,
+    see tileHasData().
+    '''
+    mask = ds.GetRasterBand(1).GetMaskBand()
+    scale = max(1.0, max(ds.RasterXSize, ds.RasterYSize) / float(size))
+    bx = max(1, int(ds.RasterXSize / scale))
+    by = max(1, int(ds.RasterYSize / scale))
+    data = mask.ReadAsArray( 0, 0, ds.RasterXSize, ds.RasterYSize,
+                             buf_xsize=bx, buf_ysize=by,
+                             buf_type=gdal.GDT_Float32,
+                             resample_alg=gdal.GRIORA_Average )
+    return (data, ds.RasterXSize / float(bx), ds.RasterYSize / float(by))
+
+
+def tileHasData( ds, tile, coverage=None ):
+    '''
+    tileHasData( ds, tile, coverage=None )
+
+    Return True if any pixel in the tile window is not masked out. With
+    the coverage from getCoverage() no pixels of ds are read, except for
+    a tile without coverage next to coverage, it is checked at full
+    resolution in case the overviews lost the data at its edge.
+    '''
+    if not coverage is None:
+        data, sx, sy = coverage
+        if data is None:
+            return True
+        x0 = int(tile['xoff'] / sx)
+        y0 = int(tile['yoff'] / sy)
+        x1 = max(x0 + 1, int(math.ceil((tile['xoff'] + tile['xsize']) / sx)))
+        y1 = max(y0 + 1, int(math.ceil((tile['yoff'] + tile['ysize']) / sy)))
+        if data[y0:y1, x0:x1].max() > 0:
+            return True
+        if data[max(0, y0-1):y1+1, max(0, x0-1):x1+1].max() == 0:
+            return False
+
+        mask = ds.GetRasterBand(1).GetMaskBand()
+        data = mask.ReadAsArray( tile['xoff'], tile['yoff'],
+                                 tile['xsize'], tile['ysize'] )
+        return data is None or data.max() > 0
+
+    mask = ds.GetRasterBand(1).GetMaskBand()
+    data = mask.ReadAsArray( tile['xoff'], tile['yoff'],
+                             tile['xsize'], tile['ysize'],
+                             buf_xsize=64, buf_ysize=64 )
+    return data is None or data.max() > 0
+
+
+def getCoreBounds( tile, gt ):
+    '''Return the tile core as [xmin, ymin, xmax, ymax] in map units.'''
+    cx0, cy0, cx1, cy1 = tile['core']
+    xa = gt[0] + cx0*gt[1]
+    xb = gt[0] + cx1*gt[1]
+    ya = gt[3] + cy0*gt[5]
+    yb = gt[3] + cy1*gt[5]
+    return [min(xa, xb), min(ya, yb), max(xa, xb), max(ya, yb)]
+
+
+def removeShapefile( fshp ):
+    for f in glob.glob( os.path.splitext(fshp)[0] + '.*' ):
+        os.remove( f )
+
+
+def segmentTile( job ):
+    '''
+    segmentTile( job )
+        job - (fin, tile, tmpdirs, prefix, params, threads)
+
+    Pool worker that cuts the tile window out of fin as a vrt and runs
+    the LSMS chain on it in the tmpdir of tmpdirs that allocateTmpdir()
+    picks for the tile. Returns (tile, shapefile, times) where shapefile
+    is None if the tile failed.
+    '''
+    fin, tile, tmpdirs, prefix, params, threads = job
+    verbose = CONFIG.get('verbose', False)
+
+    # keep ITK from starting a thread per cpu in every worker
+    if threads > 0:
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+
+    mpix = tile['xsize'] * tile['ysize'] / 1.0e6
+    try:
+        alloc = allocateTmpdir( sum(estimateStageBytes( mpix, 4, params, None ).values()),
+                                '{} tile {}'.format(prefix, tile['n']), tmpdirs,
+                                prefix=prefix + '-' )
+    except RuntimeError, e:
+        print "ERROR: tile {} failed: {}".format(tile['n'], str(e))
+        return (tile, None, {})
+    tmpdir = alloc['tmpdir']
+
+    ftile = os.path.join(tmpdir, '{}-tile.vrt'.format(prefix))
+    fshp  = os.path.join(tmpdir, '{}-segments.shp'.format(prefix))
+
+    cmd = ['gdal_translate', '-of', 'VRT', '-srcwin',
+           str(tile['xoff']), str(tile['yoff']),
+           str(tile['xsize']), str(tile['ysize']), fin, ftile]
+    runCommand( cmd, verbose )
+
+    try:
+        times = runLSMS( ftile, fshp, tmpdir, prefix, params )
+    except Exception, e:
+        print "ERROR: tile {} failed: {}".format(tile['n'], str(e))
+        fshp = None
+        times = {}
+
+    if not params.get('debug', False) and os.path.exists( ftile ):
+        os.remove( ftile )
+
+    # the tile shapefile stays until stitching but is small
+    releaseTmpdir( alloc )
+
+    return (tile, fshp, times)
+
+
+def _writeFeature( layer, defn, geom, fields ):
+    feature = ogr.Feature( defn )
+    feature.SetGeometry( geom )
+    for i in range(len(fields)):
+        if not fields[i] is None:
+            feature.SetField( i, fields[i] )
+    layer.CreateFeature( feature )
+    feature = None
+
+
+def mergeSeamSegments( layer, defn, seams, cellsize ):
+    '''
+    mergeSeamSegments( layer, defn, seams, cellsize )
+        layer    - output layer to write the stitched segments to
+        defn     - layer definition of the output layer
+        seams    - list of [tile number, geometry, fields] for segments
+                   that cross the core boundary of the tile that owns them
+        cellsize - grid cell size in map units used to find neighbors
+
+    Segments from different tiles that cover mostly the same pixels are
+    the same object cut differently by each tile, so they get unioned
+    into a single segment. Returns the number of segments removed.
+    '''
+    parent = range(len(seams))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # bucket envelopes on a coarse grid so we only test nearby pairs
+    grid = {}
+    for i in range(len(seams)):
+        xmin, xmax, ymin, ymax = seams[i][1].GetEnvelope()
+        for gx in range(int(math.floor(xmin/cellsize)), int(math.floor(xmax/cellsize))+1):
+            for gy in range(int(math.floor(ymin/cellsize)), int(math.floor(ymax/cellsize))+1):
+                grid.setdefault((gx, gy), []).append(i)
+
+    tested = set()
+    for members in grid.itervalues():
+        for a in range(len(members)):
+            for b in range(a+1, len(members)):
+                i, j = members[a], members[b]
+                if seams[i][0] == seams[j][0] or (i, j) in tested:
+                    continue
+                tested.add((i, j))
+                gi = seams[i][1]
+                gj = seams[j][1]
+                if not gi.Intersects( gj ):
+                    continue
+                inter = gi.Intersection( gj )
+                if inter is None or inter.Area() <= 0.5*min(gi.Area(), gj.Area()):
+                    continue
+                parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(len(seams)):
+        groups.setdefault(find(i), []).append(i)
+
+    for members in groups.itervalues():
+        # keep the attributes of the largest piece
+        members.sort(key=lambda i: seams[i][1].Area(), reverse=True)
+        geom = seams[members[0]][1]
+        for i in members[1:]:
+            geom = geom.Union( seams[i][1] )
+        _writeFeature( layer, defn, geom, seams[members[0]][2] )
+
+    return len(seams) - len(groups)
+
+
+def stitchTiles( results, gt, cellsize, fsegshp ):
+    '''
+    stitchTiles( results, gt, cellsize, fsegshp )
+        results  - list of (tile, shapefile, times) from segmentTile
+        gt       - geotransform of the image that was tiled
+        cellsize - grid cell size in map units used to find neighbors
+        fsegshp  - shapefile to write the stitched segments to
+
+    Each segment is kept only by the tile whose core contains its
+    centroid, so the overlaps are not duplicated. Kept segments that
+    cross a core boundary are stitched with mergeSeamSegments().
+    Returns the number of segments written.
+    '''
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists( fsegshp ):
+        driver.DeleteDataSource( fsegshp )
+
+    first = ogr.Open( results[0][1] )
+    firstLayer = first.GetLayer()
+    dsout = driver.CreateDataSource( fsegshp )
+    lout = dsout.CreateLayer( os.path.splitext(os.path.basename(fsegshp))[0],
+                              firstLayer.GetSpatialRef(), ogr.wkbPolygon )
+    fdefn = firstLayer.GetLayerDefn()
+    nfields = fdefn.GetFieldCount()
+    for i in range(nfields):
+        lout.CreateField( fdefn.GetFieldDefn(i) )
+    first = None
+    defn = lout.GetLayerDefn()
+
+    count = 0
+    seams = []
+    for tile, fshp, times in results:
+        x0, y0, x1, y1 = getCoreBounds( tile, gt )
+        ds = ogr.Open( fshp )
+        layer = ds.GetLayer()
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None or geom.IsEmpty():
+                continue
+            c = geom.Centroid()
+            if not (x0 <= c.GetX() < x1 and y0 < c.GetY() <= y1):
+                continue
+            fields = [feature.GetField(i) for i in range(nfields)]
+            exmin, exmax, eymin, eymax = geom.GetEnvelope()
+            if exmin < x0 or exmax > x1 or eymin < y0 or eymax > y1:
+                seams.append([tile['n'], geom.Clone(), fields])
+            else:
+                _writeFeature( lout, defn, geom, fields )
+                count += 1
+        ds = None
+
+    nmerged = mergeSeamSegments( lout, defn, seams, cellsize )
+    count += len(seams) - nmerged
+    print "Stitched {} seam segments into {}".format(len(seams), len(seams) - nmerged)
+
+    dsout = None
+
+    return count
+
+
+def runTiledSegmentation( fin, fsegshp, tmpdirs, prefix, params, tiling, overlap, nproc ):
+    '''
+    runTiledSegmentation( fin, fsegshp, tmpdirs, prefix, params, tiling, overlap, nproc )
+        fin     - input image or vrt to segment
+        fsegshp - output shapefile for the segment polygons
+        tmpdirs - list of tmp dirs, each tile gets the least loaded one
+        prefix  - prefix for the tmp file names, eg: tmp-1234
+        params  - dictionary of segmentation parameters, see runLSMS()
+        tiling  - 'doqq' to tile on the DOQQ grid or tile size in pixels
+        overlap - pixels of overlap added around each tile
+        nproc   - number of tiles to process at the same time, 0=all cpus
+
+    Split fin into overlapping tiles, run the LSMS chain on the tiles in
+    a process pool and stitch the tiles back into fsegshp. With a json
+    parameter grid in params['paramgrid'], see writeParameterGrid(), each
+    tile is segmented with the spatialr, ranger and minsize of the grid
+    window nearest to its center, params['gridselect'] picks min, max or
+    avg, default avg.
+
+    Returns a dictionary of stage times summed over the tiles or None
+    if any tile failed.
+    '''
+    ds = gdal.Open( fin )
+    width = ds.RasterXSize
+    height = ds.RasterYSize
+    gt = ds.GetGeoTransform()
+
+    if tiling == 'doqq':
+        xbreaks = getDoqqBreaks( width, gt[0], gt[1] )
+        ybreaks = getDoqqBreaks( height, gt[3], gt[5] )
+    else:
+        xbreaks = getPixelBreaks( width, int(tiling) )
+        ybreaks = getPixelBreaks( height, int(tiling) )
+
+    grid = None
+    if params.get('paramgrid'):
+        # optimalsample imports this module
+        from optimalsample import loadParameterGrid, gridParameters
+        grid = loadParameterGrid( params['paramgrid'] )
+        select = params.get('gridselect') or 'avg'
+        params = dict(params)
+        params['spatialr'] = max([int(round(w['hs_' + select])) for w in grid['windows']])
+
+    # segments smaller than the overlap are never cut by the tile edge
+    overlap = max(overlap, 2*params['spatialr'])
+
+    coverage = getCoverage( ds )
+    tiles = [t for t in getTileWindows( width, height, xbreaks, ybreaks, overlap )
+             if tileHasData( ds, t, coverage )]
+    ds = None
+
+    if len(tiles) == 0:
+        print "ERROR: no tiles with data to segment!"
+        return None
+
+    ncpu = getNumCpus()
+    if nproc == 0:
+        nproc = ncpu
+    nproc = min(nproc, len(tiles))
+    threads = max(1, ncpu / nproc)
+
+    if params.get('autotune', False):
+        size = (max([t['xsize'] for t in tiles]), max([t['ysize'] for t in tiles]))
+        tparams = applyTuning( params, autoTune( fin, params, nproc, size ) )
+        threads = tparams['threads']
+    else:
+        # the ram budget is shared by the workers
+        tparams = dict(params)
+        tparams['ram'] = max(256, int(params['ram'] / nproc))
+
+    print "Segmenting {} tiles of {} with {} processes ...".format(
+        len(tiles), tiling, nproc)
+
+    jobs = []
+    for t in tiles:
+        jparams = tparams
+        if not grid is None:
+            xmin, ymin, xmax, ymax = getCoreBounds( t, gt )
+            jparams = dict(tparams)
+            jparams['spatialr'], jparams['ranger'], jparams['minsize'] = gridParameters(
+                grid, (xmin + xmax) / 2.0, (ymin + ymax) / 2.0, select )
+        jobs.append((fin, t, tmpdirs, '{}-t{}'.format(prefix, t['n']),
+                     jparams, threads))
+
+    results = []
+    failed = False
+    pool = Pool( nproc )
+    for r in pool.imap_unordered( segmentTile, jobs ):
+        if r[1] is None:
+            failed = True
+        else:
+            results.append( r )
+        print "Tile {} done ({} of {})".format(r[0]['n'], len(results), len(tiles))
+    pool.close()
+    pool.join()
+
+    times = {}
+    if not failed:
+        for r in results:
+            for k in r[2]:
+                times[k] = times.get(k, 0.0) + r[2][k]
+
+        t0 = time.time()
+        results.sort(key=lambda r: r[0]['n'])
+        cellsize = 4 * overlap * abs(gt[1])
+        count = stitchTiles( results, gt, cellsize, fsegshp )
+        times['stitching'] = time.time() - t0
+        print "Stitching time:", times['stitching'], "segments:", count
+
+    if not params.get('debug', False):
+        for r in results:
+            removeShapefile( r[1] )
+
+    if failed:
+        return None
+
+    return times
@@ -0,0 +1,258 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import socket
+from contextlib import contextmanager
+from config import *
+
+'''
+Hand out the configured tmpdirs to the jobs of naip-process, segment and
+optimal-params by disk load instead of always the first one or by
+worker number.
+
+Each tmpdir has a ledger of the jobs using it and the tmp bytes they
+expect to write, shared by all the processes through an flock. A job
+gets the tmpdir on the disk with the fewest jobs that has room for its
+bytes on top of the bytes in flight and tmpalloc.minfree. Tmpdirs on the
+same file system share its free space and jobs. A job that fits nowhere
+waits up to tmpalloc.wait seconds for other jobs to finish and is then
+refused. An allocation ends when it is released or its process exits.
+
+The bytes a job already wrote are gone from the free space, so only the
+rest of its bytes count as in flight. That needs the prefix of its file
+names in the tmpdir, a job without one counts all of its bytes for its
+whole life, which can keep other jobs waiting for room that is there.
+'''
+
+TMP_LEDGER = '.tmpalloc.json'
+TMP_LOCK = '.tmpalloc.lock'
+
+# seconds between tries while waiting for room
+TMP_POLL = 10
+
+# allocations of other hosts older than this are dropped, we can not
+# check if their process still exists
+TMP_STALE_HOURS = 24
+
+_allocations = 0
+
+
+def getTmpdirs():
+    '''Return the configured tmpdirs, creating any that do not exist.'''
+    home = CONFIG['projectHomeDir']
+    tmpdirs = CONFIG.get('tmpdirs', [os.path.join(home, 'tmp')])
+    for d in tmpdirs:
+        try:
+            if not os.path.exists( d ):
+                os.makedirs( d )
+        except OSError:
+            pass
+    return tmpdirs
+
+
+def _pidAlive( pid ):
+    try:
+        os.kill( pid, 0 )
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _entryAlive( entry ):
+    if entry['host'] == socket.gethostname():
+        return _pidAlive( entry['pid'] )
+    return time.time() - entry['time'] < TMP_STALE_HOURS * 3600
+
+
+def _readLedger( tmpdir ):
+    # call with the lock of tmpdir held, drops the entries of dead jobs
+    fledger = os.path.join( tmpdir, TMP_LEDGER )
+    if not os.path.exists( fledger ):
+        return {}
+    try:
+        entries = json.load( open( fledger ) )
+    except ValueError:
+        print "WARNING: ignoring bad tmp ledger '{}'!".format(fledger)
+        return {}
+    return dict([(k, e) for k, e in entries.items() if _entryAlive( e )])
+
+
+def _writeLedger( tmpdir, entries ):
+    fledger = os.path.join( tmpdir, TMP_LEDGER )
+    ftmp = '{}.{}'.format(fledger, os.getpid())
+    fh = open( ftmp, 'wb' )
+    json.dump( entries, fh, indent=2, sort_keys=True )
+    fh.close()
+    os.rename( ftmp, fledger )
+
+
+@contextmanager
+def _lockedLedgers( tmpdirs ):
+    # lock in sorted order so two processes can not deadlock
+    locks = []
+    try:
+        for d in sorted( tmpdirs ):
+            fh = open( os.path.join( d, TMP_LOCK ), 'a' )
+            fcntl.flock( fh, fcntl.LOCK_EX )
+            locks.append( fh )
+        yield dict([(d, _readLedger( d )) for d in tmpdirs])
+    finally:
+        for fh in locks:
+            fcntl.flock( fh, fcntl.LOCK_UN )
+            fh.close()
+
+
+def _writtenBytes( tmpdir, names, prefix ):
+    # bytes of the files and dirs in tmpdir whose name starts with prefix
+    nbytes = 0
+    for n in names:
+        if not n.startswith( prefix ):
+            continue
+        f = os.path.join( tmpdir, n )
+        try:
+            if os.path.isdir( f ):
+                for dirpath, dirs, files in os.walk( f ):
+                    nbytes += sum([os.path.getsize(os.path.join(dirpath, x)) for x in files])
+            else:
+                nbytes += os.path.getsize( f )
+        except OSError:
+            pass
+    return nbytes
+
+
+def _inflightBytes( tmpdir, entries ):
+    # the bytes the jobs of tmpdir have yet to write
+    names = None
+    inflight = 0
+    for e in entries.values():
+        if e.get('prefix') is None:
+            inflight += e['bytes']
+            continue
+        if names is None:
+            names = os.listdir( tmpdir )
+        inflight += max(0, e['bytes'] - _writtenBytes( tmpdir, names, e['prefix'] ))
+    return inflight
+
+
+def _diskStates( ledgers ):
+    # free bytes and the bytes and jobs in flight of each file system
+    disks = {}
+    for d, entries in ledgers.items():
+        dev = os.stat( d ).st_dev
+        if not dev in disks:
+            st = os.statvfs( d )
+            disks[dev] = { 'free': st.f_bavail * st.f_frsize, 'inflight': 0, 'jobs': 0 }
+        disks[dev]['inflight'] += _inflightBytes( d, entries )
+        disks[dev]['jobs'] += len(entries)
+    return disks
+
+
+def getTmpdirStates( tmpdirs=None ):
+    '''
+    getTmpdirStates( tmpdirs=None )
+
+    Return a list with the path, free bytes, bytes in flight and number
+    of jobs of the file system of each tmpdir.
+    '''
+    if tmpdirs is None:
+        tmpdirs = getTmpdirs()
+    with _lockedLedgers( tmpdirs ) as ledgers:
+        disks = _diskStates( ledgers )
+    states = []
+    for d in tmpdirs:
+        disk = disks[os.stat( d ).st_dev]
+        states.append({ 'tmpdir': d, 'free': disk['free'],
+                        'inflight': disk['inflight'], 'jobs': disk['jobs'] })
+    return states
+
+
+def allocateTmpdir( nbytes, label, tmpdirs=None, wait=None, prefix=None ):
+    '''
+    allocateTmpdir( nbytes, label, tmpdirs=None, wait=None, prefix=None )
+        nbytes  - tmp bytes the job expects to write at most
+        label   - what the job is, for the ledger
+        tmpdirs - tmpdirs to pick from, default all, see getTmpdirs()
+        wait    - seconds to wait for room, default tmpalloc.wait
+        prefix  - start of the names of all the tmp files of the job, so
+                  the bytes it already wrote are not counted twice
+
+    Return an allocation, a dictionary with the 'tmpdir' to use, for
+    releaseTmpdir(). Raises RuntimeError if no tmpdir has room for nbytes.
+    '''
+    global _allocations
+
+    if tmpdirs is None:
+        tmpdirs = getTmpdirs()
+    if wait is None:
+        wait = CONFIG.get('tmpalloc.wait', 3600)
+    minfree = CONFIG.get('tmpalloc.minfree', 1024) * 1048576
+    nbytes = int(nbytes)
+
+    t0 = time.time()
+    while True:
+        with _lockedLedgers( tmpdirs ) as ledgers:
+            disks = _diskStates( ledgers )
+            fits = []
+            for d in tmpdirs:
+                disk = disks[os.stat( d ).st_dev]
+                room = disk['free'] - disk['inflight'] - minfree
+                if room >= nbytes:
+                    fits.append( (disk['jobs'], -room, d) )
+
+            if len(fits) > 0:
+                tmpdir = min(fits)[2]
+                _allocations += 1
+                key = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), _allocations)
+                ledgers[tmpdir][key] = { 'bytes': nbytes, 'label': label,
+                                         'prefix': prefix,
+                                         'host': socket.gethostname(),
+                                         'pid': os.getpid(), 'time': time.time() }
+                _writeLedger( tmpdir, ledgers[tmpdir] )
+                return { 'tmpdir': tmpdir, 'key': key, 'bytes': nbytes }
+
+            busy = sum([disk['jobs'] for disk in disks.values()])
+
+        # only wait if finishing jobs can make room
+        if busy == 0 or time.time() - t0 + TMP_POLL > wait:
+            raise RuntimeError("no tmpdir has room for {:.1f} MB for {}!".format(
+                nbytes / 1048576.0, label))
+        time.sleep( TMP_POLL )
+
+
+def releaseTmpdir( alloc ):
+    '''Release an allocation of allocateTmpdir().'''
+    if alloc is None:
+        return
+    with _lockedLedgers( [alloc['tmpdir']] ) as ledgers:
+        entries = ledgers[alloc['tmpdir']]
+        entries.pop( alloc['key'], None )
+        _writeLedger( alloc['tmpdir'], entries )
+
+
+@contextmanager
+def tmpdirFor( nbytes, label, tmpdirs=None, wait=None, prefix=None ):
+    '''
+    with tmpdirFor( nbytes, label ) as tmpdir:
+
+    Allocate a tmpdir for the body of the with, see allocateTmpdir().
+    '''
+    alloc = allocateTmpdir( nbytes, label, tmpdirs, wait, prefix )
+    try:
+        yield alloc['tmpdir']
+    finally:
+        releaseTmpdir( alloc )
@@ -0,0 +1,333 @@
+'''
+--------------------------------------------------------------------
+    This file is part of the raster object recognition project.
+
+    https://github.com/woodbri/raster-object-recognition
+
+    MIT License. See LICENSE file for details.
+
+    Copyright 2017, Stephen Woodbridge
+--------------------------------------------------------------------
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+from multiprocessing import Pool
+from osgeo import gdal
+
+from utils import getNumCpus, runCommand
+from config import *
+
+'''
+Pick the OTB ram, tile size and ITK thread count for the LSMS stages
+from the free memory, the number of cpus, the size of the raster and
+the number of workers sharing the machine, instead of using seg.ram and
+seg.tilesize as is.
+
+The calibration times a few tile size and thread combinations on a
+sample window of a real image and keeps the best one for the host in
+<seg.tuningdir>/<hostname>.json. The auto tuning uses it as the upper
+bound for the tile size and thread count when it exists. The choices
+made by the auto tuning and the stage timings of finished runs, which
+segplan.py learns its cost model from, are recorded in the same file.
+'''
+
+TUNING_STAGES = ('smoothing', 'segmentation', 'merging', 'vectorization')
+
+# fraction of the free memory the OTB applications may use
+TUNE_MEM_FRACTION = 0.75
+
+# tile sizes are multiples of this, in pixels
+MIN_TILESIZE = 256
+MAX_TILESIZE = 4096
+
+# smallest ram in MB we give a worker
+MIN_TUNE_RAM = 256
+
+# number of auto tuning choices and run timings to keep in the host file
+TUNE_HISTORY = 50
+
+# size of the sample window and the tile sizes tried by the calibration
+CALIBRATE_SIZE = 2048
+CALIBRATE_TILESIZES = [256, 512, 1024, 2048]
+
+
+def getFreeMemory():
+    '''Return the available memory in MB or None if it is not known.'''
+    try:
+        info = {}
+        for line in open('/proc/meminfo'):
+            parts = line.split()
+            info[parts[0].rstrip(':')] = int(parts[1])
+    except (IOError, IndexError, ValueError):
+        return None
+
+    if 'MemAvailable' in info:
+        return info['MemAvailable'] / 1024
+    # older kernels do not report MemAvailable
+    return (info.get('MemFree', 0) + info.get('Cached', 0) + info.get('Buffers', 0)) / 1024
+
+
+def getTuningFile():
+    home = CONFIG['projectHomeDir']
+    tdir = os.path.join( home, CONFIG.get('seg.tuningdir', 'data/tuning') )
+    return os.path.join( tdir, '{}.json'.format(socket.gethostname()) )
+
+
+def loadHostTuning():
+    '''Return the tuning data saved for this host or {}.'''
+    ftuning = getTuningFile()
+    if not os.path.exists( ftuning ):
+        return {}
+    try:
+        return json.load( open( ftuning ) )
+    except ValueError:
+        print "WARNING: ignoring bad tuning file '{}'!".format(ftuning)
+        return {}
+
+
+def saveHostTuning( data ):
+    '''Write the tuning data for this host, replacing the file atomicly.'''
+    ftuning = getTuningFile()
+    if not os.path.exists( os.path.dirname( ftuning ) ):
+        os.makedirs( os.path.dirname( ftuning ) )
+    ftmp = '{}.{}'.format(ftuning, os.getpid())
+    fh = open( ftmp, 'wb' )
+    json.dump( data, fh, indent=2, sort_keys=True )
+    fh.close()
+    os.rename( ftmp, ftuning )
+
+
+def stageTileBytes( stage, tilesize, bands, spatialr ):
+    '''
+    stageTileBytes( stage, tilesize, bands, spatialr )
+
+    Rough number of bytes an OTB stage holds in memory for one tile.
+    The smoothed image and the positions are float32, the labels uint32,
+    and LSMSSegmentation reads a margin of spatialr around each tile and
+    keeps its region adjacency in memory too.
+    '''
+    if stage == 'segmentation':
+        n = (tilesize + 2*spatialr) ** 2
+        return n * (4*bands + 4*2 + 4*4)
+    if stage == 'merging':
+        return tilesize ** 2 * (4*bands + 4*3)
+    # vectorization keeps the polygons of the tile as well
+    return tilesize ** 2 * (4*bands + 4*2) * 2
+
+
+def _pickTilesize( stage, budget, size, bands, spatialr, limit ):
+    tilesize = MIN_TILESIZE
+    while tilesize * 2 <= min(limit, MAX_TILESIZE):
+        # no point in tiles bigger than the raster
+        if tilesize >= size:
+            break
+        # half the budget, OTB streams the next tile while writing one
+        if stageTileBytes( stage, tilesize * 2, bands, spatialr ) > budget * 1048576 / 2:
+            break
+        tilesize *= 2
+    return tilesize
+
+
+def autoTune( fin, params, nworkers, size=None ):
+    '''
+    autoTune( fin, params, nworkers, size=None )
+        fin      - input image or vrt that will be segmented
+        params   - dictionary of segmentation parameters, see runLSMS()
+        nworkers - number of LSMS chains running at the same time
+        size     - (width, height) to tune for instead of the size of fin,
+                   eg: the size of the tiles in tiled segmentation
+
+    Return a dictionary with the threads per worker and the ram and
+    tilesize for each stage. The memory budget of a worker is its share
+    of the free memory, or of params['ram'] if the free memory is not
+    known. The choice is recorded for the host.
+    '''
+    ds = gdal.Open( fin )
+    bands = ds.RasterCount
+    if size is None:
+        size = (ds.RasterXSize, ds.RasterYSize)
+    ds = None
+
+    nworkers = max(1, nworkers)
+    ncpu = getNumCpus()
+    free = getFreeMemory()
+    total = int(free * TUNE_MEM_FRACTION) if not free is None else params['ram']
+    budget = max(MIN_TUNE_RAM, total / nworkers)
+
+    host = loadHostTuning()
+    best = host.get('calibration', {}).get('best', {})
+    threads = max(1, ncpu / nworkers)
+    if 'threads' in best:
+        threads = max(1, min(threads, best['threads']))
+    limit = best.get('tilesize', MAX_TILESIZE)
+
+    stages = {}
+    for stage in TUNING_STAGES:
+        tilesize = _pickTilesize( stage, budget, max(size), bands,
+                                  params['spatialr'], limit )
+        stages[stage] = { 'ram': budget, 'tilesize': tilesize }
+
+    tuning = { 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'input': fin,
+               'width': size[0], 'height': size[1], 'bands': bands,
+               'ncpu': ncpu, 'free': free, 'workers': nworkers,
+               'threads': threads, 'stages': stages }
+
+    print "Auto tuning for {} workers, {} MB free, {} cpus:".format(nworkers, free, ncpu)
+    print "  threads per worker: {}".format(threads)
+    for stage in TUNING_STAGES:
+        print "  {0:14s} ram: {1:6d} MB  tilesize: {2:5d}".format(
+            stage, stages[stage]['ram'], stages[stage]['tilesize'])
+
+    # several workers can tune at once, a lost record is not a problem
+    try:
+        host['autotune'] = (host.get('autotune', []) + [tuning])[-TUNE_HISTORY:]
+        saveHostTuning( host )
+    except (IOError, OSError), e:
+        print "WARNING: could not record the tuning: {}".format(str(e))
+
+    return tuning
+
+
+def applyTuning( params, tuning ):
+    '''Return a copy of params using the stage settings of tuning.'''
+    tparams = dict(params)
+    tparams['stages'] = tuning['stages']
+    tparams['threads'] = tuning['threads']
+    tparams['ram'] = tuning['stages']['smoothing']['ram']
+    tparams['tilesize'] = tuning['stages']['segmentation']['tilesize']
+    return tparams
+
+
+def recordStageTimes( fin, times, workers, threads, fshp=None ):
+    '''
+    recordStageTimes( fin, times, workers, threads, fshp=None )
+        fin     - image or vrt that was segmented
+        times   - dictionary of stage times, summed over the workers
+        workers - number of LSMS chains that ran at the same time
+        threads - ITK threads of each chain
+        fshp    - the segment shapefile, to learn its size per pixel
+
+    Save the stage timings of a finished run for the cost model.
+    '''
+    ds = gdal.Open( fin )
+    run = { 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'mpix': ds.RasterXSize * ds.RasterYSize / 1.0e6,
+            'bands': ds.RasterCount, 'workers': workers,
+            'threads': threads, 'times': times }
+    ds = None
+
+    if not fshp is None:
+        base = os.path.splitext( fshp )[0]
+        run['shpbytes'] = sum([os.path.getsize( base + ext )
+                               for ext in ('.shp', '.shx', '.dbf')
+                               if os.path.exists( base + ext )])
+
+    try:
+        host = loadHostTuning()
+        host['runs'] = (host.get('runs', []) + [run])[-TUNE_HISTORY:]
+        saveHostTuning( host )
+    except (IOError, OSError), e:
+        print "WARNING: could not record the stage times: {}".format(str(e))
+
+
+def _calibrateRun( job ):
+    # runs in a new process so ITK picks up the thread count
+    fin, tmpdir, prefix, params, tilesize, threads = job
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+
+    # lsms imports this module
+    from lsms import runLSMS
+    from tiledsegmentation import removeShapefile
+
+    fshp = os.path.join( tmpdir, '{}-segments.shp'.format(prefix) )
+    tparams = dict(params)
+    tparams.pop( 'stages', None )
+    tparams.update({ 'tilesize': tilesize, 'threads': threads, 'autotune': False,
+                     'inmemory': False, 'cache': False, 'debug': False })
+    try:
+        times = runLSMS( fin, fshp, tmpdir, prefix, tparams )
+    except Exception, e:
+        print "ERROR: calibration run failed: {}".format(str(e))
+        times = None
+    removeShapefile( fshp )
+
+    return times
+
+
+def calibrate( fin, tmpdir, prefix, params ):
+    '''
+    calibrate( fin, tmpdir, prefix, params )
+        fin    - input image or vrt to take the sample window from
+        tmpdir - directory for the sample and the tmp files
+        prefix - prefix for the tmp file names, eg: tmp-1234
+        params - dictionary of segmentation parameters, see runLSMS()
+
+    Time the LSMS chain on a CALIBRATE_SIZE window from the center of fin
+    for each tile size in CALIBRATE_TILESIZES and for all and half of the
+    cpus, then save the fastest as the best configuration for this host.
+    Returns the calibration record.
+    '''
+    verbose = CONFIG.get('verbose', False)
+
+    ds = gdal.Open( fin )
+    width = ds.RasterXSize
+    height = ds.RasterYSize
+    ds = None
+
+    size = min(CALIBRATE_SIZE, width, height)
+    fsample = os.path.join( tmpdir, '{}-calibrate.tif'.format(prefix) )
+    cmd = ['gdal_translate', '-of', 'GTiff', '-srcwin',
+           str(int(width/2 - size/2)), str(int(height/2 - size/2)),
+           str(size), str(size), fin, fsample]
+    runCommand( cmd, verbose )
+
+    ncpu = getNumCpus()
+    tilesizes = [t for t in CALIBRATE_TILESIZES if t <= size] or [MIN_TILESIZE]
+    configs = [(t, n) for t in tilesizes for n in sorted(set([ncpu, max(1, ncpu/2)]))]
+
+    results = []
+    for tilesize, threads in configs:
+        print "Calibrating tilesize {} with {} threads ...".format(tilesize, threads)
+        pool = Pool( 1 )
+        times = pool.apply( _calibrateRun, ((fsample, tmpdir, prefix, params,
+                                             tilesize, threads),) )
+        pool.close()
+        pool.join()
+        if times is None:
+            continue
+        results.append({ 'tilesize': tilesize, 'threads': threads,
+                         'times': times, 'total': sum(times.values()) })
+
+    if os.path.exists( fsample ):
+        os.remove( fsample )
+
+    if len(results) == 0:
+        print "ERROR: every calibration run failed!"
+        return None
+
+    best = min(results, key=lambda r: r['total'])
+    record = { 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'input': fin,
+               'size': size, 'ncpu': ncpu, 'free': getFreeMemory(),
+               'params': dict([(k, params[k]) for k in ('spatialr', 'ranger', 'minsize', 'ram')]),
+               'results': results,
+               'best': { 'tilesize': best['tilesize'], 'threads': best['threads'],
+                         'mpixpersec': size * size / 1.0e6 / max(best['total'], 0.001) } }
+
+    print
+    print " Tilesize | Threads |  Seconds "
+    print "----------+---------+----------"
+    for r in results:
+        print " {0:8d} | {1:7d} | {2:8.1f} {3}".format(r['tilesize'], r['threads'],
+            r['total'], '*' if r is best else '')
+    print "----------+---------+----------"
+
+    host = loadHostTuning()
+    host['calibration'] = record
+    saveHostTuning( host )
+    print "Calibration saved to {}".format(getTuningFile())
+
+    return record
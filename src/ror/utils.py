@@ -15,6 +15,7 @@ import sys
 import re
 import subprocess
 import psycopg2
+from multiprocessing import cpu_count
 from config import *
 
 DEVNULL = open(os.devnull, 'w')
@@ -47,6 +48,17 @@ def runCommand(cmd, verbose):
 
 
 
+def getNumCpus():
+    '''Return the number of cpus on this host, or config ncpu if unknown.'''
+    ncpu = CONFIG.get('ncpu', 1) # get a good default number
+    try:
+        ncpu = cpu_count()
+    except NotImplementedError:
+        pass
+    return ncpu
+
+
+
 def getDatabase():
 
     try:
@@ -43,12 +43,44 @@ Usage: ror_cli [-h|--help]
             [-l|--limit n]   - limit number of files to process (for debugging)
             [-f|--files file [file ...]] process this list of files, default
                              is all downloaded files not already processed
+                             the processes take the next DOQQ as soon as
+                             they are free, largest first, and write the
+                             status of each DOQQ to naipfetched<year>,
+                             targets are written to a partial name and
+                             renamed once valid, a restart removes the
+                             partial and tmp files of dead workers and
+                             requeues only their DOQQs
+            [-p|--pipeline name] - subprocess (default) runs the gdal tools
+                             through tmp files, inprocess uses the gdal
+                             bindings and /vsimem, compare runs both and
+                             prints the time of each per DOQQ
+            [-c|--cpus n]    - total cpus to use, default all
+            [-m|--memory MB] - total memory to use, default 75% of free
+            [-t|--threads n] - gdal threads per process for warping and
+                             compression, default cpus / nproc, if neither
+                             -n or -t is given the fastest benchmark split
+            [-b|--benchmark] - time each split of the cpus into processes
+                             x threads on -l n DOQQs (default cpus) or the
+                             -f files and save the fastest for this host
+            [--cog]          - write cloud optimized geotiffs with the
+                             overviews and mask in one pass, needs gdal 3.1
+            [--validate]     - also check every processed DOQQ decodes
+                             before starting, the startup clean up of
+                             dead workers only looks for missing targets
 
        optimal-params    - compute the optimal paramters for segmentation
             [-l|--latlog lat,lon]   - center location to use
             [-s|--size 512]         - pixel size of window to check
                                       default: 512
-            [-a|--area bbox]        - small bbox of area to check
+            [-a|--area bbox]        - area to check, fips code or bbox
+            [-n|--samples n]        - number of windows to sample across
+                                      --area, default: 1 at the center
+            [-g|--grid file]        - write the parameters of each window
+                                      to a json grid for --paramgrid
+            [-c|--cached]           - only aggregate the cached windows of
+                                      --area without reading any pixels
+            [-q|--quick]            - fast approximate parameters from random
+                                      pixel samples with confidence intervals
             [-i|--isboxy 1|0]       - are objects square|rectangle or not
             [-b|--bands 0,1,2,4]    - which bands to use, zero based numbers
                                       default: 0,1,2,4  (R,G,B,IR)
@@ -66,6 +98,12 @@ Usage: ror_cli [-h|--help]
                                       of the computed values
                [-x|--isboxy 0|1]    - are objects boxy, used with --optimal
                [-b|--bands 0,1,2,4] - which bands to use, used iwth --optimal
+               [--samples n]        - windows to sample across the area, the
+                                      median of the windows is used
+            [--paramgrid file]      - with --optimal write the parameters of
+                                      each window to this json grid, with
+                                      --tiled segment each tile with the
+                                      parameters of the nearest grid window
             [-s|--spatialr int]     - spatial radius (hs) of neigborhood in pixels
             [-r|--ranger float]     - radiometric radius (hr) in multi-spectral space
             [-m|--minsize int]      - minimum segment size in pixels (M)
@@ -81,10 +119,53 @@ Usage: ror_cli [-h|--help]
                                       to create table to store segments in
             [--debug]               - do not remove tmp files
             [--usetif]              - convert input vrt to tif
-            NOTE: --optimal will take a 1024x1024 image located at the center
-                  of --area to compute the optimal parameters. If you want more
-                  control over where the the sample is selected, use option
-                  optimal-params above and set -s, -r, -m explicitly
+            [--tiled doqq|int]      - split the area into tiles on the DOQQ
+                                      grid or of int pixels and segment
+                                      them in parallel using nproc processes
+               [--overlap int]      - pixels of overlap between tiles
+            [--inmemory]            - connect the OTB applications in memory
+                                      and do not write intermediate rasters
+            [--cache]               - reuse smoothing and segmentation outputs
+                                      from the stage cache when the input and
+                                      parameters match a previous run
+            [--sweep]               - segment with every combination of -s, -r
+                                      and -m which take lists and ranges like
+                                      8,12:24:4, writes a shapefile for each
+                                      and a summary of segment counts, times
+            [--autotune]            - pick ram, tile sizes and ITK threads for
+                                      each stage from free memory, cpus, the
+                                      image size and number of processes
+            [--calibrate]           - time tile sizes and threads on a sample
+                                      of the area and save the best for this
+                                      host, used as limits by --autotune
+            [--incremental]         - only segment the DOQQs or cousubs of the
+                                      area whose files or parameters changed
+                                      since the last run and replace just
+                                      their segments in the job table
+               [--unit doqq|cousub] - units to check, default: doqq
+               [--list-changed]     - only list the changed units
+            [--plan]                - estimate the wall time, peak ram and tmp
+                                      disk of each stage and how they scale
+                                      with nproc from the stage timings of
+                                      previous runs on this host
+            NOTE: --optimal will take 1024x1024 windows spread over --area, or
+                  one at its center, to compute the optimal parameters. If you
+                  want more control over where the the sample is selected, use
+                  option optimal-params above and set -s, -r, -m explicitly
+
+       segment-worker    - segment the units of a job queued in the database,
+                           run it on any number of nodes
+            [--enqueue]             - queue the cousub or DOQQ units of -a
+                                      for -j with the segment parameters
+               [-u|--unit cousub|doqq] - size of the units, default: cousub
+               [--changed]          - only queue units that changed
+            [--status]              - report the queue progress and workers
+            [--retry]               - put failed units back in the queue
+            [-j|--job name]         - only work on units of this job
+            [-R|--ram int(MB)]      - available ram on this node
+            [-x|--max-units int]    - stop after this many units
+            [--wait]                - wait for more work when queue is empty
+            see: ror_cli segment-worker --help for all options
 
        train             - train some or all of training area and save data
 
@@ -116,6 +197,8 @@ def Main(argv):
         OptimalParams( argv[1:] )
     elif argv[0] == 'segment':
         Segmentation( argv[1:] )
+    elif argv[0] == 'segment-worker':
+        SegmentWorker( argv[1:] )
     elif argv[0] == 'train':
         pass
     elif argv[0] == 'search':